@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+
+"""
+Batches of small files: many files behind one frame header.
+
+Sending a tiny file on its own costs an open, a header and (on the server)
+a create, which for hundreds of thousands of files is most of the work.
+A batch frame instead carries up to BATCH_MAX_FILES files, BATCH_MAX_BYTES
+in all, as a run of entries:
+  2 bytes  name length
+  n bytes  name (a relative path; the server creates missing directories)
+  8 bytes  size
+  size bytes of file data
+"""
+
+import os
+
+BATCH_FILE_MAX = 65536           # larger files get frames of their own
+BATCH_MAX_BYTES = 1 << 20        # payload a client puts in one batch
+BATCH_MAX_FILES = 1024
+MAX_BATCH_PAYLOAD = 1 << 24      # largest batch payload a server accepts
+
+def read_small_file(path):
+    """Reads a file if it is small enough for a batch.
+
+    Returns its bytes, None if it is too big (it has to go on its own), or
+    raises FileNotFoundError.  One open, one read and one close: no stat.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, BATCH_FILE_MAX + 1)
+        if len(data) > BATCH_FILE_MAX:
+            return None
+        # A short read of a regular file means we hit the end, but a file
+        # that is growing (or a FIFO) may have more.
+        rest = os.read(fd, BATCH_FILE_MAX + 1 - len(data))
+        if rest:
+            data += rest
+            if len(data) > BATCH_FILE_MAX:
+                return None
+        return data
+    finally:
+        os.close(fd)
+
+def encode_entry(name, data):
+    """The bytes in front of one file's data in a batch."""
+    name_bytes = name.encode()
+    return len(name_bytes).to_bytes(2, 'big') + name_bytes + len(data).to_bytes(8, 'big')
+
+def is_relative_path(name):
+    """Whether name stays below the current directory (no absolute path, no "..")."""
+    return bool(name) and not os.path.isabs(name) and ".." not in name.split("/") and "\0" not in name
+
+def make_parent_dirs(name, made_dirs):
+    """Creates the directories name lives in, unless made_dirs says they are already there."""
+    directory = os.path.dirname(name)
+    if directory and directory not in made_dirs:
+        os.makedirs(directory, exist_ok=True)
+        made_dirs.add(directory)
+
+def _create(name):
+    """Opens name for writing from scratch."""
+    try:
+        return os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644) # the usual case: a new file
+    except FileExistsError:
+        return os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+def write_batch(payload, count, made_dirs):
+    """Writes the count files in a batch payload, each with a single write().
+
+    made_dirs remembers the directories already created on this connection,
+    so each one costs a makedirs() only once.  Returns the files' sizes.
+    """
+    view = memoryview(payload)
+    sizes = []
+    i = 0
+    for _ in range(count):
+        if i + 10 > len(view):
+            raise ValueError(f"batch of {count} files ends early")
+        name_length = int.from_bytes(view[i:i+2], 'big')
+        name = bytes(view[i+2:i+2+name_length]).decode()
+        i += 2 + name_length
+        size = int.from_bytes(view[i:i+8], 'big')
+        i += 8
+        if i + size > len(view):
+            raise ValueError(f"batch entry {name} runs past the end of its batch")
+        # Batches may only create files below the server's directory.
+        if not is_relative_path(name):
+            raise ValueError(f"refusing to write {name!r} from a batch")
+        make_parent_dirs(name, made_dirs)
+        fd = _create(name)
+        try:
+            data = view[i:i+size]
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        sizes.append(size)
+        i += size
+    if i != len(view):
+        raise ValueError(f"{len(view) - i} stray bytes after a batch of {count} files")
+    return sizes
@@ -0,0 +1,382 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks for the transfer stack.
+
+Three suites, each a sweep whose results are printed as one JSON document
+(so two runs, say before and after a change, can be put side by side with
+bench/compare.py):
+
+  micro       BufferedWriter.write() into /dev/null and BufferedReader.read()
+              from a cached file, for a range of piece and buffer sizes
+  socketpair  FramedWriter -> socketpair -> FramedReader, the reader in a
+              forked child; per-file latency is the time from write_file()
+              being called to the reader having the file on disk
+  loopback    file_client.py and file_server.py as real processes on
+              127.0.0.1, across server engines and client stream counts
+
+Every transfer runs over a workload of generated files: "tiny" (thousands
+of files under 2 KiB), "small" (16-64 KiB), "mixed" (log-uniform sizes up
+to 8 MiB) and "huge" (two 64 MiB files).  --scale shrinks or grows them.
+
+Usage: bench/bench.py [--suites micro,socketpair,loopback] [--scale 1]
+                      [--workloads tiny,small,mixed,huge] [--output file]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import resource
+import platform
+import tempfile
+import threading
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO, os.path.join(REPO, "lib")]
+from buffers import BufferedWriter, BufferedReader
+from framing import FramedWriter, FramedReader, COMPACT_VERSION, write_all
+import params
+
+# --- Workloads ---
+
+def workload_sizes(name, scale):
+    """The file sizes of a workload (a fixed seed, so every run gets the same files)."""
+    rng = random.Random(name)
+    if name == "tiny":
+        return [rng.randint(64, 2048) for _ in range(max(1, int(2000 * scale)))]
+    if name == "small":
+        return [rng.randint(16384, 65536) for _ in range(max(1, int(400 * scale)))]
+    if name == "mixed":
+        return [int(2 ** rng.uniform(10, 23)) for _ in range(max(1, int(100 * scale)))]
+    if name == "huge":
+        return [max(1, int((64 << 20) * scale))] * 2
+    raise ValueError(f"unknown workload {name}")
+
+def make_workload(root, name, scale):
+    """Creates a workload's files under root/name. Returns [(relative path, size)]."""
+    files = []
+    for i, size in enumerate(workload_sizes(name, scale)):
+        path = f"{name}/d{i // 500}/f{i}.bin"
+        os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(root, path), "wb") as f:
+            f.write(os.urandom(size))
+        files.append((path, size))
+    return files
+
+def check_received(dest, files):
+    """Whether every file arrived whole (by size; the transfers verify content themselves)."""
+    for path, size in files:
+        try:
+            if os.stat(os.path.join(dest, path)).st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+# --- Measurements ---
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def rates(total_bytes, files, seconds):
+    return {"seconds": round(seconds, 4),
+            "mb_per_s": round(total_bytes / seconds / 1e6, 2) if seconds else None,
+            "files_per_s": round(files / seconds, 1) if seconds else None}
+
+def cpu_seconds(usage):
+    return round(usage.ru_utime + usage.ru_stime, 4)
+
+class Quiet:
+    """Sends fd 2 to /dev/null for a while: the transfer code logs every file."""
+    def __enter__(self):
+        self.saved = os.dup(2)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 2)
+        os.close(devnull)
+
+    def __exit__(self, *exc):
+        os.dup2(self.saved, 2)
+        os.close(self.saved)
+
+def progress(message):
+    os.write(2, f"bench: {message}\n".encode())
+
+# --- Micro benchmarks ---
+
+def bench_writer(buffer_size, piece_size, mutable, total_bytes):
+    """BufferedWriter.write() of piece_size pieces into /dev/null."""
+    count = max(1, min(total_bytes // piece_size, 500000))
+    piece = bytearray(piece_size) if mutable else bytes(piece_size)
+    fd = os.open(os.devnull, os.O_WRONLY)
+    writer = BufferedWriter(fd, buffer_size)
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(count):
+        writer.write(piece)
+    writer.flush()
+    seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+    writer.close()
+    result = {"ops_per_s": round(count / seconds), "cpu_s": round(cpu, 4)}
+    result.update(rates(count * piece_size, 0, seconds))
+    del result["files_per_s"]
+    return result
+
+def bench_reader(buffer_size, read_size, path, total_bytes):
+    """BufferedReader.read() of read_size pieces from a file in the page cache."""
+    count = max(1, min(total_bytes // read_size, 500000))
+    fd = os.open(path, os.O_RDONLY)
+    reader = BufferedReader(fd, buffer_size)
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(count):
+        reader.read(read_size)
+    seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+    reader.close()
+    result = {"ops_per_s": round(count / seconds), "cpu_s": round(cpu, 4)}
+    result.update(rates(count * read_size, 0, seconds))
+    del result["files_per_s"]
+    return result
+
+def run_micro(work, scale, buffer_sizes):
+    results = []
+    total_bytes = max(1 << 20, int((64 << 20) * scale))
+    source = os.path.join(work, "micro.bin")
+    with open(source, "wb") as f:
+        f.write(os.urandom(total_bytes))
+    for buffer_size in buffer_sizes:
+        for piece_size in (16, 108, 4096, 65536):
+            for mutable in (False, True):
+                name = f"micro/write/buffer={buffer_size}/piece={piece_size}/{'bytearray' if mutable else 'bytes'}"
+                progress(name)
+                result = {"name": name, "suite": "micro", "buffer_size": buffer_size, "piece_size": piece_size}
+                result.update(bench_writer(buffer_size, piece_size, mutable, total_bytes))
+                results.append(result)
+            name = f"micro/read/buffer={buffer_size}/piece={piece_size}"
+            progress(name)
+            result = {"name": name, "suite": "micro", "buffer_size": buffer_size, "piece_size": piece_size}
+            result.update(bench_reader(buffer_size, piece_size, source, total_bytes))
+            results.append(result)
+    os.unlink(source)
+    return results
+
+# --- FramedWriter -> socketpair -> FramedReader ---
+
+def run_socketpair_once(src, dest, files, buffer_size, header_version):
+    """One transfer with the reader in a forked child. Returns the measurements."""
+    left, right = socket.socketpair()
+    times_r, times_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            left.close()
+            os.close(times_r)
+            os.chdir(dest)
+            with Quiet():
+                reader = FramedReader(BufferedReader(right.detach(), buffer_size))
+                done = []
+                while reader.read_next_file():
+                    done.append(time.monotonic())
+                reader.close()
+            write_all(times_w, json.dumps(done).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    right.close()
+    os.close(times_w)
+
+    cwd = os.getcwd()
+    os.chdir(src)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    starts = []
+    try:
+        with Quiet():
+            start = time.monotonic()
+            writer = FramedWriter(BufferedWriter(left.detach(), buffer_size), header_version=header_version)
+            for path, _ in files:
+                starts.append(time.monotonic())
+                writer.write_file(path)
+            writer.close()
+    finally:
+        os.chdir(cwd)
+    writer_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    data = bytearray()
+    while True:
+        piece = os.read(times_r, 65536)
+        if not piece:
+            break
+        data += piece
+    os.close(times_r)
+    _, status, reader_usage = os.wait4(pid, 0)
+    done = json.loads(data) if status == 0 and data else []
+
+    latencies = [(end - begin) * 1000 for begin, end in zip(starts, done)]
+    result = rates(sum(size for _, size in files), len(files), (done[-1] if done else time.monotonic()) - start)
+    result.update({
+        "p50_ms": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "writer_cpu_s": round(cpu_seconds(writer_usage) - cpu_seconds(usage), 4),
+        "reader_cpu_s": cpu_seconds(reader_usage),
+        "reader_peak_rss_kb": reader_usage.ru_maxrss,
+        "ok": status == 0 and len(done) == len(files) and check_received(dest, files),
+    })
+    return result
+
+def run_socketpair(work, workloads, buffer_sizes):
+    results = []
+    src = os.path.join(work, "src")
+    for workload, files in workloads.items():
+        for buffer_size in buffer_sizes:
+            for header_version in (1, COMPACT_VERSION):
+                name = f"socketpair/{workload}/buffer={buffer_size}/header=v{header_version}"
+                progress(name)
+                dest = os.path.join(work, "dest")
+                shutil.rmtree(dest, ignore_errors=True)
+                os.makedirs(dest)
+                result = {"name": name, "suite": "socketpair", "workload": workload,
+                          "buffer_size": buffer_size, "header_version": header_version}
+                result.update(run_socketpair_once(src, dest, files, buffer_size, header_version))
+                results.append(result)
+    return results
+
+# --- file_client.py and file_server.py over loopback ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def run_loopback_once(src, dest, files, engine, streams, recursive, workload):
+    """Starts a server, sends the files with the client, then stops the server. Returns the measurements."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO, os.path.join(REPO, "lib")]))
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-u", os.path.join(REPO, "file_server.py"), "-l", str(port),
+                               "-e", engine], cwd=dest, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    # Wait for "... listening on port ..." before the clock starts, then
+    # keep draining its output so it never blocks on a full pipe.
+    for line in server.stdout:
+        if b"listening" in line:
+            break
+    drain = threading.Thread(target=server.stdout.read, daemon=True)
+    drain.start()
+
+    args = [sys.executable, os.path.join(REPO, "file_client.py"), "-s", f"127.0.0.1:{port}", "-n", str(streams)]
+    args += ["-R", workload] if recursive else [path for path, _ in files]
+    start = time.monotonic()
+    client = subprocess.Popen(args, cwd=src, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, client_status, client_usage = os.wait4(client.pid, 0)
+    client.returncode = 0 # reaped above
+    # A stopping server still lets connected clients finish, so once it
+    # has exited every file is on disk.
+    os.kill(server.pid, signal.SIGTERM)
+    _, _, server_usage = os.wait4(server.pid, 0)
+    server.returncode = 0
+    seconds = time.monotonic() - start
+    drain.join()
+    server.stdout.close()
+
+    result = rates(sum(size for _, size in files), len(files), seconds)
+    result.update({
+        "client_cpu_s": cpu_seconds(client_usage),
+        "server_cpu_s": cpu_seconds(server_usage),
+        "client_peak_rss_kb": client_usage.ru_maxrss,
+        "server_peak_rss_kb": server_usage.ru_maxrss,
+        "ok": client_status == 0 and check_received(dest, files),
+    })
+    return result
+
+def run_loopback(work, workloads, engines, stream_counts):
+    results = []
+    src = os.path.join(work, "src")
+    for workload, files in workloads.items():
+        for engine in engines:
+            for streams in stream_counts:
+                for recursive in (False, True):
+                    name = f"loopback/{workload}/{engine}/streams={streams}{'/recursive' if recursive else ''}"
+                    progress(name)
+                    dest = os.path.join(work, "dest")
+                    shutil.rmtree(dest, ignore_errors=True)
+                    os.makedirs(dest)
+                    result = {"name": name, "suite": "loopback", "workload": workload, "engine": engine,
+                              "streams": streams, "recursive": recursive}
+                    result.update(run_loopback_once(src, dest, files, engine, streams, recursive, workload))
+                    results.append(result)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    switchesVarDefaults = (
+        (('-S', '--suites'), 'suites', "micro,socketpair,loopback"),
+        (('-w', '--workloads'), 'workloads', "tiny,small,mixed,huge"),
+        (('-x', '--scale'), 'scale', "1"),                        # multiplies file counts (and huge file sizes)
+        (('-b', '--bufferSizes'), 'bufferSizes', "4096,65536,1048576"),
+        (('-n', '--streams'), 'streams', "1,4"),                  # client connections (loopback)
+        (('-e', '--engines'), 'engines', "threads,async"),        # server engines (loopback)
+        (('-o', '--output'), 'output', "-"),                      # where the JSON goes ("-": stdout)
+        (('-d', '--workDir'), 'workDir', tempfile.gettempdir()),  # put it on the disk you care about
+        (('-?', '--usage'), "usage", False),
+    )
+    paramMap = params.parseParams(switchesVarDefaults)
+    if paramMap["usage"]:
+        print(__doc__)
+        sys.exit(1)
+    try:
+        suites = paramMap["suites"].split(",")
+        scale = float(paramMap["scale"])
+        buffer_sizes = [int(size) for size in paramMap["bufferSizes"].split(",")]
+        stream_counts = [int(streams) for streams in paramMap["streams"].split(",")]
+        engines = paramMap["engines"].split(",")
+        names = paramMap["workloads"].split(",")
+        for name in names:
+            workload_sizes(name, scale) # rejects names we don't know
+    except ValueError as e:
+        os.write(2, f"Error: bad benchmark parameters ({e})\n".encode())
+        sys.exit(1)
+
+    work = tempfile.mkdtemp(prefix="transfer-bench-", dir=paramMap["workDir"])
+    results = []
+    try:
+        if "micro" in suites:
+            results += run_micro(work, scale, buffer_sizes)
+        if "socketpair" in suites or "loopback" in suites:
+            progress(f"creating workloads in {work}")
+            workloads = {name: make_workload(os.path.join(work, "src"), name, scale) for name in names}
+            if "socketpair" in suites:
+                results += run_socketpair(work, workloads, buffer_sizes)
+            if "loopback" in suites:
+                results += run_loopback(work, workloads, engines, stream_counts)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        "meta": {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "scale": scale, "started": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=1) + "\n"
+    if paramMap["output"] == "-":
+        sys.stdout.write(text)
+    else:
+        with open(paramMap["output"], "w") as f:
+            f.write(text)
+    failed = [result["name"] for result in results if result.get("ok") is False]
+    if failed:
+        os.write(2, f"Error: {len(failed)} run(s) lost files: {', '.join(failed)}\n".encode())
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+
+"""
+Puts two bench/bench.py reports side by side.
+
+Usage: bench/compare.py <old.json> <new.json>
+
+Every run present in both is listed with its old and new numbers and the
+change; rates (MB/s, files/s, ops/s) are better higher, times, CPU and
+memory better lower.
+"""
+
+import sys
+import json
+
+# (metric, True if bigger is better)
+METRICS = (
+    ("mb_per_s", True), ("files_per_s", True), ("ops_per_s", True),
+    ("p50_ms", False), ("p99_ms", False),
+    ("cpu_s", False), ("writer_cpu_s", False), ("reader_cpu_s", False),
+    ("client_cpu_s", False), ("server_cpu_s", False),
+    ("reader_peak_rss_kb", False), ("client_peak_rss_kb", False), ("server_peak_rss_kb", False),
+)
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report["meta"], {result["name"]: result for result in report["results"]}
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        sys.exit(1)
+    old_meta, old = load(sys.argv[1])
+    new_meta, new = load(sys.argv[2])
+    print(f"old: {old_meta.get('commit')} ({old_meta.get('started')})   new: {new_meta.get('commit')} ({new_meta.get('started')})")
+    for name in old:
+        if name not in new:
+            continue
+        print(name)
+        for metric, higher_is_better in METRICS:
+            before, after = old[name].get(metric), new[name].get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            better = change > 0 if higher_is_better else change < 0
+            verdict = "" if abs(change) < 5 else ("  better" if better else "  worse")
+            print(f"  {metric:20} {before:>12} -> {after:<12} {change:+7.1f}%{verdict}")
+    only_old = sorted(set(old) - set(new))
+    only_new = sorted(set(new) - set(old))
+    if only_old:
+        print(f"only in {sys.argv[1]}: {', '.join(only_old)}")
+    if only_new:
+        print(f"only in {sys.argv[2]}: {', '.join(only_new)}")
+
+if __name__ == "__main__":
+    main()
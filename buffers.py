@@ -3,25 +3,57 @@
 
 import os
 
+# The kernel limit on how many buffers one writev() call may take
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
 class BufferedWriter:
     def __init__(self, fd, buffer_size=4096):
         self.fd = fd
-        self.buffer = bytearray()
+        # Instead of one growing bytearray we keep a queue of memoryviews and
+        # send them all with a single writev() when flushing.
+        self.pending = []
+        self.pending_bytes = 0
         self.buffer_size = buffer_size
+        # Every write to fd goes through this (profiling swaps in a timed one)
+        self.writev = os.writev
 
     def write(self, data):
-        self.buffer.extend(data)
-        if len(self.buffer) >= self.buffer_size:
+        view = memoryview(data).cast('B')
+        if not view:
+            return
+        if not view.readonly and len(view) < self.buffer_size:
+            # The caller may reuse a mutable buffer after we return, so small
+            # pieces of it are copied.  Immutable bytes are queued as-is.
+            view = memoryview(bytes(view))
+        self.pending.append(view)
+        self.pending_bytes += len(view)
+        if self.pending_bytes >= self.buffer_size or not view.readonly:
+            # A large mutable buffer is written out before we return.
             self.flush()
 
     def flush(self):
-        if self.buffer:
-            # Use a loop for a "reliable write"
-            data_to_write = self.buffer
-            while data_to_write:
-                bytes_written = os.write(self.fd, data_to_write)
-                data_to_write = data_to_write[bytes_written:]
-            self.buffer.clear()
+        # Use a loop for a "reliable write"
+        pending = self.pending
+        while pending:
+            bytes_written = self.writev(self.fd, pending[:IOV_MAX])
+            self.pending_bytes -= bytes_written
+            # Drop the buffers that went out completely and advance into the
+            # first one that went out partially -- no bytes are copied.
+            done = 0
+            while done < len(pending) and bytes_written >= len(pending[done]):
+                bytes_written -= len(pending[done])
+                done += 1
+            del pending[:done]
+            if bytes_written:
+                pending[0] = pending[0][bytes_written:]
+
+    def discard(self):
+        """Forgets everything not yet written (the connection is broken anyway)."""
+        self.pending.clear()
+        self.pending_bytes = 0
 
     def close(self):
         self.flush()
@@ -32,22 +64,100 @@ class BufferedWriter:
 class BufferedReader:
     def __init__(self, fd, buffer_size=4096):
         self.fd = fd
-        self.buffer = b""
         self.buffer_size = buffer_size
+        # A preallocated ring buffer.  Bytes are never shifted around inside it:
+        # 'start' is where the oldest unread byte lives and 'count' is how many
+        # unread bytes follow it (possibly wrapping around the end).
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.count = 0
+        # Every read from fd goes through this (metrics and profiling swap in counted ones)
+        self.readv = os.readv
+
+    def buffered(self):
+        """Returns how many bytes are sitting in the buffer, already read from fd."""
+        return self.count
+
+    def resize(self, buffer_size):
+        """Swaps in a ring of a new size, keeping the unread bytes (at most buffer_size of them)."""
+        unread = self.count
+        if buffer_size < unread:
+            raise ValueError(f"{unread} unread bytes don't fit in {buffer_size}")
+        buffer = bytearray(buffer_size)
+        self._take(memoryview(buffer), unread)
+        self.buffer_size = buffer_size
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.count = unread
+
+    def _fill(self):
+        """Reads as much as fits into the free part of the ring with a single readv()."""
+        capacity = self.buffer_size
+        if self.count == 0:
+            self.start = 0 # empty: rewind so the free space is one contiguous region
+        tail = (self.start + self.count) % capacity
+        if self.count and tail == self.start:
+            return 0 # full
+        if tail >= self.start:
+            # free space is [tail, end) followed by [0, start)
+            regions = [self.view[tail:]]
+            if self.start:
+                regions.append(self.view[:self.start])
+        else:
+            regions = [self.view[tail:self.start]]
+        bytes_read = self.readv(self.fd, regions)
+        self.count += bytes_read
+        return bytes_read
+
+    def _take(self, dest, n):
+        """Copies n buffered bytes into the memoryview dest and consumes them."""
+        first = min(n, self.buffer_size - self.start)
+        dest[:first] = self.view[self.start:self.start + first]
+        if n > first: # the unread bytes wrap around the end of the ring
+            dest[first:n] = self.view[:n - first]
+        self.start = (self.start + n) % self.buffer_size
+        self.count -= n
+
+    def peek(self, n):
+        """Returns up to n bytes without consuming them: whatever is buffered,
+        after one read from fd if nothing is (b"" at EOF)."""
+        if not self.count:
+            self._fill()
+        n = min(n, self.count)
+        first = min(n, self.buffer_size - self.start)
+        return bytes(self.view[self.start:self.start + first]) + bytes(self.view[:n - first])
+
+    def readinto(self, dest):
+        """Fills the writable buffer dest, returning how many bytes were stored (short only at EOF)."""
+        dest = memoryview(dest).cast('B')
+        wanted = len(dest)
+        filled = 0
+        while filled < wanted:
+            if not self.count and wanted - filled >= self.buffer_size:
+                # Big request and nothing buffered: read straight into the
+                # caller's memory instead of bouncing through the ring.
+                bytes_read = self.readv(self.fd, [dest[filled:]])
+                if not bytes_read: # End of file
+                    break
+                filled += bytes_read
+                continue
+            if self.count < wanted - filled:
+                # Top up the free space (which may wrap around) before copying out
+                if not self._fill() and not self.count: # End of file
+                    break
+            n = min(wanted - filled, self.count)
+            self._take(dest[filled:], n)
+            filled += n
+        return filled
 
     def read(self, bytes_to_read):
         """Reads a specific number of bytes."""
-        result = bytearray()
-        while len(result) < bytes_to_read:
-            if not self.buffer:
-                self.buffer = os.read(self.fd, self.buffer_size)
-                if not self.buffer: # End of file
-                    break
-            
-            chunk_size = min(bytes_to_read - len(result), len(self.buffer))
-            result.extend(self.buffer[:chunk_size])
-            self.buffer = self.buffer[chunk_size:]
+        result = bytearray(bytes_to_read)
+        filled = self.readinto(result)
+        del result[filled:]
         return bytes(result)
 
     def close(self):
-        os.close(self.fd)
\ No newline at end of file
+        os.close(self.fd)
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+
+"""
+End-to-end checksums for the framing protocol.
+
+A checksummed payload is followed by a trailer: optionally one digest per
+CHECKSUM_BLOCK_SIZE bytes of the file, then one digest of all of it.  Both
+sides compute the digests as the bytes stream past, so nothing is read
+twice; the receiver compares its own with the trailer before the file is
+allowed into place.  crc32 is cheap and catches accidents, blake2b is
+strong enough to trust.
+
+Per-block digests don't make a bad file any less bad, but they say where
+it went wrong, so a resumable upload can keep everything before that.
+"""
+
+import zlib
+import hashlib
+
+CHECKSUM_NONE = 0
+CHECKSUM_CRC32 = 1
+CHECKSUM_BLAKE2B = 2
+CHECKSUM_NAMES = {"none": CHECKSUM_NONE, "crc32": CHECKSUM_CRC32, "blake2b": CHECKSUM_BLAKE2B}
+CHECKSUM_PER_BLOCK = 0x80   # set in the header's algorithm byte: the trailer has block digests too
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+class _Crc32:
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+def _new_digest(algorithm):
+    if algorithm == CHECKSUM_CRC32:
+        return _Crc32()
+    if algorithm == CHECKSUM_BLAKE2B:
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(f"unknown checksum algorithm {algorithm}")
+
+def digest_size(algorithm):
+    if algorithm == CHECKSUM_CRC32:
+        return 4
+    if algorithm == CHECKSUM_BLAKE2B:
+        return 32
+    raise ValueError(f"unknown checksum algorithm {algorithm}")
+
+def trailer_size(algorithm, per_block, length):
+    """How long the trailer of a length-byte payload is."""
+    blocks = -(-length // CHECKSUM_BLOCK_SIZE) if per_block else 0 # round up
+    return (blocks + 1) * digest_size(algorithm)
+
+class StreamChecksum:
+    """The digests of one payload, fed with its bytes in order."""
+    def __init__(self, algorithm, per_block=False):
+        self.algorithm = algorithm
+        self.per_block = per_block
+        self.whole = _new_digest(algorithm)
+        self.block = _new_digest(algorithm) if per_block else None
+        self.block_used = 0   # bytes in the current block so far
+        self.block_digests = []
+
+    def update(self, data):
+        self.whole.update(data)
+        if not self.per_block:
+            return
+        view = memoryview(data)
+        while view:
+            piece = view[:CHECKSUM_BLOCK_SIZE - self.block_used]
+            self.block.update(piece)
+            self.block_used += len(piece)
+            view = view[len(piece):]
+            if self.block_used == CHECKSUM_BLOCK_SIZE:
+                self._end_block()
+
+    def _end_block(self):
+        self.block_digests.append(self.block.digest())
+        self.block = _new_digest(self.algorithm)
+        self.block_used = 0
+
+    def trailer(self):
+        """The trailer for everything fed so far."""
+        if self.per_block and self.block_used:
+            self._end_block() # the short last block
+        return b"".join(self.block_digests) + self.whole.digest()
+
+    def verify(self, trailer):
+        """Compares our digests with the sender's trailer.
+
+        Returns None if they agree, otherwise the offset (in the payload) of
+        the first block that differs (0 without per-block digests).
+        """
+        ours = self.trailer()
+        if ours == bytes(trailer):
+            return None
+        size = digest_size(self.algorithm)
+        for i in range(0, min(len(ours), len(trailer)) - size, size):
+            if ours[i:i+size] != trailer[i:i+size]:
+                return (i // size) * CHECKSUM_BLOCK_SIZE
+        return 0
+
+class ChecksummedOutput:
+    """Passes a payload through to an output, checksumming it on the way.
+
+    Every byte has to be seen, so splice() is off for checksummed payloads.
+    """
+    zero_copy_ok = False
+
+    def __init__(self, output, checksum):
+        self.output = output
+        self.checksum = checksum
+
+    @property
+    def written(self):
+        return self.output.written
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.output.write(data)
+
+    def close(self, complete):
+        self.output.close(complete)
+
+    def close_behind(self, complete, done):
+        self.output.close_behind(complete, done)
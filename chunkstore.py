@@ -0,0 +1,407 @@
+#! /usr/bin/env python3
+
+"""
+Content-addressed deduplication: files as lists of chunks, chunks kept by hash.
+
+A file is cut into chunks wherever a rolling "gear" hash of the last 64
+bytes has its top 16 bits clear, so about every 64 KiB (16 KiB to 256 KiB).
+Because the cut points depend only on nearby content, an insertion early
+in a file moves only the chunk it lands in; every later chunk (and so its
+SHA-256) stays the same.
+
+A deduplicated upload starts with the file's recipe: the SHA-256 and
+length of every chunk, in order (36 bytes each).  The server answers
+"NEED <k>" followed by k 4-byte chunk numbers, the chunks it has no copy
+of, and the client sends just those chunks' bytes, in that order.
+
+The server keeps chunks in a ChunkStore: one file per chunk under
+objects/, named by its hash, plus an append-only index of what is there.
+The index is replayed into memory at startup and evicts the least recently
+used objects once the store grows past its size limit.  A file that was
+uploaded whole before (same recipe) is copied from the store instead of
+being rebuilt.  The store keeps copies of its own, never links to files
+users can write to.
+
+Another server process sharing the store may evict any object at any
+time, so nothing is pinned: a stored chunk is copied into the new file
+(and its hash checked) as soon as the recipe arrives, and one that is
+gone or doesn't match is simply asked of the client.
+"""
+
+import os
+import bisect
+import collections
+import hashlib
+import mmap
+import struct
+import threading
+import fcntl
+from delta import copy_range
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # the pure Python chunker finds the same cut points, just slower
+
+CHUNK_MIN = 16384
+CHUNK_MAX = 262144
+CUT_MASK = 0xFFFF << 48      # top 16 bits clear: a cut about every 64 KiB
+GEAR_WINDOW = 64             # bytes that still count in the 64-bit gear hash
+RECIPE_ENTRY_SIZE = 36       # 32-byte SHA-256 + 4-byte length
+MAX_RECIPE_CHUNKS = 1 << 20  # largest recipe a server accepts (64 GiB at the average chunk size)
+DEDUP_MIN_SIZE = 65536       # smaller files are simply sent whole
+CHUNK_SCAN_SIZE = 1 << 21    # bytes the numpy chunker hashes per pass
+
+# The same table on every machine: it decides where files are cut.
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), 'big') for i in range(256)]
+MASK64 = (1 << 64) - 1
+
+# --- Chunking ---
+
+def _cut_points_python(data, size):
+    """Every position p where the gear hash of the 64 bytes before p allows a cut (in order)."""
+    cuts = []
+    start = 0
+    while start < size:
+        # Only positions at least CHUNK_MIN past the last cut matter, so the
+        # hash starts GEAR_WINDOW bytes before the first one.
+        end = min(start + CHUNK_MAX, size)
+        position = start + CHUNK_MIN - GEAR_WINDOW
+        h = 0
+        for byte in data[position:end]:
+            h = ((h << 1) + GEAR[byte]) & MASK64
+            position += 1
+            if not h & CUT_MASK and position - start >= CHUNK_MIN:
+                break
+        else:
+            position = end
+        cuts.append(position)
+        start = position
+    return cuts
+
+def _cut_points_numpy(data, size):
+    """Like _cut_points_python(), but hashes every position with numpy first.
+
+    The gear hash forgets a byte after 64 shifts, so the hash at i is
+    sum(GEAR[x[i-j]] << j for j < 64), which doubling builds in six steps:
+    H2k[i] = Hk[i] + (Hk[i-k] << k).
+    """
+    gear = numpy.array(GEAR, dtype=numpy.uint64)
+    candidates = []
+    for start in range(0, size, CHUNK_SCAN_SIZE):
+        first = max(start - (GEAR_WINDOW - 1), 0)
+        end = min(start + CHUNK_SCAN_SIZE, size)
+        h = gear[numpy.frombuffer(data, numpy.uint8, end - first, first)]
+        for k in (1, 2, 4, 8, 16, 32):
+            h = h[k:] + (h[:-k] << numpy.uint64(k))
+        # h[t] now is the hash of the 64 bytes ending at first + 63 + t.
+        hits = numpy.flatnonzero((h & numpy.uint64(CUT_MASK)) == 0) + first + GEAR_WINDOW
+        candidates.extend(hits.tolist())
+    cuts = []
+    start = 0
+    while start < size:
+        end = min(start + CHUNK_MAX, size)
+        i = bisect.bisect_left(candidates, start + CHUNK_MIN)
+        position = candidates[i] if i < len(candidates) and candidates[i] <= end else end
+        cuts.append(position)
+        start = position
+    return cuts
+
+def file_recipe(fd, size):
+    """Cuts fd into chunks. Returns [(sha256, offset, length)] for every chunk in order."""
+    if size == 0:
+        return []
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as data:
+        if numpy is not None and size > CHUNK_MIN:
+            cuts = _cut_points_numpy(data, size)
+        else:
+            cuts = _cut_points_python(data, size)
+        recipe = []
+        start = 0
+        for cut in cuts:
+            recipe.append((hashlib.sha256(data[start:cut]).digest(), start, cut - start))
+            start = cut
+    return recipe
+
+def encode_recipe(recipe):
+    return b"".join(digest + length.to_bytes(4, 'big') for digest, _, length in recipe)
+
+def parse_recipe(data):
+    """The recipe as sent: [(sha256, length)]."""
+    return [(bytes(data[i:i+32]), int.from_bytes(data[i+32:i+36], 'big'))
+            for i in range(0, len(data) - RECIPE_ENTRY_SIZE + 1, RECIPE_ENTRY_SIZE)]
+
+# --- The store ---
+
+INDEX_ADD = 1   # an object is (still) there; the last ADD of a key is its last use
+INDEX_DROP = 2  # an object was evicted
+INDEX_RECORD = struct.Struct(">B32sQ")
+
+class ChunkStore:
+    """Objects (chunks, and whole files) kept by hash, least recently used evicted first.
+
+    One store may be shared by all the worker threads of a server, and by
+    several server processes; each keeps its own view of the index.
+    """
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.objects = collections.OrderedDict() # hash -> size, least recently used first
+        self.total = 0
+        self.index_path = os.path.join(root, "index")
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._load()
+        self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_inode = os.fstat(self.index_fd).st_ino
+        with self.lock:
+            self._evict()
+        print(f"Dedup store: {root} ({len(self.objects)} objects, {self.total} of {max_bytes} bytes)")
+
+    def _load(self):
+        """Replays the index into memory, compacting it when it is mostly stale records."""
+        lock_fd = os.open(os.path.join(self.root, "index.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX) # one process compacts at a time
+            try:
+                with open(self.index_path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            usable = len(data) - len(data) % INDEX_RECORD.size # a torn last record is dropped
+            for op, key, size in INDEX_RECORD.iter_unpack(memoryview(data)[:usable]):
+                self.objects.pop(key, None)
+                if op == INDEX_ADD:
+                    self.objects[key] = size
+            self.total = sum(self.objects.values())
+            records = usable // INDEX_RECORD.size
+            if records > 2 * len(self.objects) + 1024:
+                temp_path = self.index_path + ".tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(b"".join(INDEX_RECORD.pack(INDEX_ADD, key, size) for key, size in self.objects.items()))
+                os.rename(temp_path, self.index_path)
+        finally:
+            os.close(lock_fd)
+
+    def _record(self, op, key, size):
+        """Appends one index record. Called with the lock held."""
+        # Another process may have compacted (replaced) the index since we opened it.
+        try:
+            if os.stat(self.index_path).st_ino != self.index_inode:
+                os.close(self.index_fd)
+                self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                self.index_inode = os.fstat(self.index_fd).st_ino
+        except FileNotFoundError:
+            pass
+        os.write(self.index_fd, INDEX_RECORD.pack(op, key, size))
+
+    def _evict(self):
+        """Drops least recently used objects until the store fits. Called with the lock held."""
+        for key in list(self.objects):
+            if self.total <= self.max_bytes:
+                break
+            size = self.objects.pop(key)
+            self.total -= size
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+            self._record(INDEX_DROP, key, 0)
+
+    def path(self, key):
+        name = key.hex()
+        return os.path.join(self.root, "objects", name[:2], name[2:])
+
+    def _remember(self, key, size):
+        with self.lock:
+            if key in self.objects:
+                self.total -= self.objects.pop(key)
+            self.objects[key] = size
+            self.total += size
+            self._record(INDEX_ADD, key, size)
+            self._evict()
+
+    def _used(self, key):
+        with self.lock:
+            if key in self.objects:
+                self.objects.move_to_end(key)
+                self._record(INDEX_ADD, key, self.objects[key])
+
+    def _forget(self, key, bad=False):
+        """Drops object key: evicted by another process (or deleted by hand), or bad."""
+        with self.lock:
+            if key in self.objects:
+                self.total -= self.objects.pop(key)
+            if bad:
+                try:
+                    os.unlink(self.path(key))
+                except FileNotFoundError:
+                    pass
+                self._record(INDEX_DROP, key, 0)
+
+    def read_chunk(self, key, length):
+        """Chunk key's bytes, if we have it and it still hashes to key (None if not). Counts as a use."""
+        if key not in self.objects:
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read(length + 1)
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        if len(data) != length or hashlib.sha256(data).digest() != key:
+            os.write(2, f"Dedup store: dropping damaged chunk {key.hex()}\n".encode())
+            self._forget(key, bad=True)
+            return None
+        self._used(key)
+        return data
+
+    def copy_file(self, key, fd, size):
+        """Copies whole-file object key into fd, if we have it at that size. Returns whether it did; a use."""
+        if key not in self.objects:
+            return False
+        try:
+            src_fd = os.open(self.path(key), os.O_RDONLY)
+        except FileNotFoundError:
+            self._forget(key)
+            return False
+        try:
+            if os.fstat(src_fd).st_size != size or copy_range(src_fd, fd, size, 0, 0) < size:
+                self._forget(key, bad=True)
+                return False
+        finally:
+            os.close(src_fd)
+        self._used(key)
+        return True
+
+    def add_chunk(self, key, data):
+        """Stores a chunk (whose hash has been checked)."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, path)
+        self._remember(key, len(data))
+
+    def add_file(self, key, fd):
+        """Keeps a copy of a finished file (open as fd), so the next identical upload is just a copy.
+
+        A copy, not a link: the uploaded file is the user's to write into.
+        copy_file_range() makes it cheap, and free where blocks can be shared.
+        """
+        size = os.fstat(fd).st_size
+        if size > self.max_bytes // 4:
+            return # it would push most of the chunks out of the store
+        path = self.path(key)
+        if os.path.exists(path):
+            self._used(key)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        temp_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            copied = copy_range(fd, temp_fd, size, 0, 0)
+        finally:
+            os.close(temp_fd)
+        if copied < size:
+            os.unlink(temp_path)
+            return
+        os.rename(temp_path, path)
+        self._remember(key, size)
+
+class DedupFile:
+    """Server side of one deduplicated upload (an output for FramedReader and FrameParser).
+
+    The file is assembled in a temporary file: chunks the store has are
+    copied in right away, chunks the client sends are written wherever the
+    recipe uses them, and the result is renamed into place.  Without a
+    store, every distinct chunk has to be sent.
+    """
+    def __init__(self, store, filename, total_size, recipe_bytes):
+        self.store = store
+        self.filename = filename
+        self.recipe = parse_recipe(recipe_bytes)
+        if sum(length for _, length in self.recipe) != total_size:
+            raise ValueError(f"recipe for {filename} doesn't add up to {total_size} bytes")
+        if any(not 0 < length <= CHUNK_MAX for _, length in self.recipe):
+            raise ValueError(f"recipe for {filename} has a chunk of a bad size")
+        self.file_key = hashlib.sha256(recipe_bytes).digest()
+        self.temp_path = f"{filename}.dedup-{os.urandom(8).hex()}"
+        self.needed = []     # chunk numbers the client must send, in order
+        self.received = 0    # how many of those have arrived
+        self.sent_bytes = 0
+        self.fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644) # read back by add_file
+        try:
+            self._fill(total_size)
+        except BaseException:
+            os.close(self.fd)
+            os.unlink(self.temp_path)
+            raise
+
+    def _fill(self, total_size):
+        """Puts in what the store has, and notes which chunks the client must send."""
+        # Where each distinct chunk goes in the file.
+        self.offsets = collections.defaultdict(list)
+        offset = 0
+        for key, length in self.recipe:
+            self.offsets[key].append(offset)
+            offset += length
+        # The same file again: one copy and nothing to send.
+        if self.store is not None and self.store.copy_file(self.file_key, self.fd, total_size):
+            return
+        os.ftruncate(self.fd, total_size)
+        seen = set()
+        for number, (key, length) in enumerate(self.recipe):
+            if key in seen:
+                continue
+            seen.add(key)
+            data = self.store.read_chunk(key, length) if self.store is not None else None
+            if data is None:
+                self.needed.append(number)
+            else:
+                self._write_everywhere(key, data)
+
+    def need_reply(self):
+        """The "NEED <k>" line and chunk numbers the client waits for."""
+        return f"NEED {len(self.needed)}\n".encode() + b"".join(n.to_bytes(4, 'big') for n in self.needed)
+
+    def next_chunk_length(self):
+        """Length of the next chunk the client will send (None: all of them are in)."""
+        if self.received == len(self.needed):
+            return None
+        return self.recipe[self.needed[self.received]][1]
+
+    def add_chunk(self, data):
+        """Takes the next chunk the client sent, checks it, and writes it everywhere it belongs."""
+        key, length = self.recipe[self.needed[self.received]]
+        if len(data) != length or hashlib.sha256(data).digest() != key:
+            raise ValueError(f"chunk {self.needed[self.received]} of {self.filename} doesn't match its hash")
+        self._write_everywhere(key, data)
+        if self.store is not None:
+            self.store.add_chunk(key, data)
+        self.received += 1
+        self.sent_bytes += length
+
+    def _write_everywhere(self, key, data):
+        for offset in self.offsets[key]:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view, offset = view[written:], offset + written
+
+    def close(self, complete):
+        try:
+            if complete:
+                if self.store is not None:
+                    self.store.add_file(self.file_key, self.fd)
+                os.close(self.fd)
+                self.fd = None
+                os.rename(self.temp_path, self.filename)
+                os.write(2, f"Dedup: {self.filename} ({len(self.recipe)} chunks, {len(self.needed)} sent, "
+                            f"{self.sent_bytes} bytes received)\n".encode())
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+            if os.path.exists(self.temp_path):
+                os.unlink(self.temp_path)
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+
+"""
+Payload compression for the framing protocol.
+
+A compressed payload is sent as a series of blocks, each one a 4-byte
+big-endian length followed by that many compressed bytes, and ended by a
+zero-length block.  That way neither side has to know the compressed size
+up front, and memory stays flat no matter how big the file is.
+
+Blocks are either pieces of one compressed stream, or (in block mode)
+compressed independently of each other so that several threads can work on
+one file at once.
+"""
+
+import zlib
+import lzma
+
+# Codec numbers as carried in the header
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_NAMES = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+
+SAMPLE_SIZE = 65536        # bytes read (and compressed) per step
+BLOCK_SIZE = 262144        # input bytes per independently compressed block
+MIN_COMPRESS_SIZE = 1024   # smaller payloads aren't worth the block overhead
+WORTHWHILE_RATIO = 0.9     # a sample must shrink below this to bother
+MAX_BLOCK_SIZE = 1 << 24   # largest compressed block a reader accepts
+INFLATE_LIMIT = 1 << 20    # largest piece of output inflate() hands back at once
+
+def codec_name(codec):
+    for name, number in CODEC_NAMES.items():
+        if number == codec:
+            return name
+    return f"codec {codec}"
+
+def make_compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(6)
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=3)
+    raise ValueError(f"unknown compression codec {codec}")
+
+def make_decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    raise ValueError(f"unknown compression codec {codec}")
+
+def compress_block(codec, data):
+    """Compresses one block on its own, so blocks can be done in parallel.
+
+    zlib and lzma both release the GIL while they work, which is what lets a
+    thread pool run several of these on different cores at once.
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=3)
+    raise ValueError(f"unknown compression codec {codec}")
+
+def worth_compressing(sample):
+    """Adaptive check: does a quick zlib pass over the sample shrink it enough?"""
+    return len(zlib.compress(sample, 1)) < len(sample) * WORTHWHILE_RATIO
+
+def block_prefix(length):
+    """The 4-byte length in front of every compressed block."""
+    return length.to_bytes(4, 'big')
+
+def parse_block_prefix(prefix):
+    length = int.from_bytes(prefix, 'big')
+    if length > MAX_BLOCK_SIZE:
+        raise ValueError(f"compressed block of {length} bytes is too large")
+    return length
+
+def inflate(decompressor, data, limit):
+    """Decompresses one block, yielding the output in pieces of at most INFLATE_LIMIT bytes.
+
+    Raises ValueError as soon as the output would pass limit bytes (what is
+    left of the size the header declared), so a small block that inflates
+    to gigabytes is stopped at the first piece too many.
+    """
+    for out in _inflate_pieces(decompressor, data):
+        limit -= len(out)
+        if limit < 0:
+            raise ValueError("compressed payload inflates past its declared size")
+        yield out
+
+def _inflate_pieces(decompressor, data):
+    if isinstance(decompressor, lzma.LZMADecompressor):
+        out = decompressor.decompress(data, max_length=INFLATE_LIMIT)
+        while out:
+            yield out
+            if decompressor.eof or decompressor.needs_input:
+                break
+            out = decompressor.decompress(b"", max_length=INFLATE_LIMIT)
+        return
+    out = decompressor.decompress(data, INFLATE_LIMIT)
+    while out:
+        yield out
+        # A full piece may mean more output is waiting even with no input left.
+        if len(out) < INFLATE_LIMIT and not decompressor.unconsumed_tail:
+            break
+        out = decompressor.decompress(decompressor.unconsumed_tail, INFLATE_LIMIT)
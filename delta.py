@@ -0,0 +1,300 @@
+#! /usr/bin/env python3
+
+"""
+Delta transfers: sending only what changed in a file the server already has.
+
+This is the rsync algorithm.  The server cuts its copy of the file into
+blocks and sends back a signature for each one: a cheap rolling checksum
+(Adler-32) and a strong hash (16-byte blake2b).  The client slides a
+block-sized window over its own version of the file, one byte at a time,
+and looks the window's checksum up among those signatures.  A window whose
+strong hash matches too becomes a reference to the server's block, and
+whatever lies between matches is sent as literal bytes.
+
+The delta payload is a series of ops, each starting with a 9-byte op header:
+  DELTA_COPY:    1-byte op, 4-byte first block, 4-byte block count
+  DELTA_LITERAL: 1-byte op, 8-byte length, then that many literal bytes
+  DELTA_END:     1-byte op, 8 zero bytes; the end of the payload
+"""
+
+import os
+import errno
+import mmap
+import zlib
+from resume import block_digest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None # the pure Python scan gives the same answers, just slower
+
+DELTA_COPY = 1
+DELTA_LITERAL = 2
+DELTA_END = 3
+OP_SIZE = 9
+
+DELTA_MIN_SIZE = 65536      # smaller files are simply sent whole
+DELTA_MIN_BLOCK = 2048
+DELTA_MAX_BLOCK = 1 << 17
+SIGNATURE_SIZE = 20         # 4-byte Adler-32 + 16-byte blake2b
+SCAN_WINDOW = 1 << 20       # most windows checksummed in one numpy pass
+ADLER_MOD = 65521
+
+def choose_block_size(size):
+    """About the square root of the file size (as rsync does), as a power of two."""
+    block_size = DELTA_MIN_BLOCK
+    while block_size < DELTA_MAX_BLOCK and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+def encode_op(op, first=0, second=0):
+    """An op header: DELTA_COPY(first block, count), DELTA_LITERAL(length) or DELTA_END."""
+    if op == DELTA_COPY:
+        return bytes([op]) + first.to_bytes(4, 'big') + second.to_bytes(4, 'big')
+    return bytes([op]) + first.to_bytes(8, 'big')
+
+def parse_op(data):
+    """Unpacks an op header into (op, first, second), as encode_op() took them."""
+    op = data[0]
+    if op == DELTA_COPY:
+        return op, int.from_bytes(data[1:5], 'big'), int.from_bytes(data[5:9], 'big')
+    if op in (DELTA_LITERAL, DELTA_END):
+        return op, int.from_bytes(data[1:9], 'big'), 0
+    raise ValueError(f"unknown delta op {op}")
+
+# --- Server side: signatures of the copy we have ---
+
+def signature_reply(filename):
+    """The answer to a signature query: "SIGS <block size> <count>" and count signatures.
+
+    A file we don't have (or can't read) has no blocks: "SIGS 0 0".
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return b"SIGS 0 0\n"
+    try:
+        block_size = choose_block_size(os.fstat(fd).st_size)
+        signatures = bytearray()
+        offset = 0
+        while True:
+            block = os.pread(fd, block_size, offset)
+            if len(block) < block_size: # a short last block is just sent as a literal
+                break
+            signatures += zlib.adler32(block).to_bytes(4, 'big') + block_digest(block)
+            offset += block_size
+    except OSError:
+        return b"SIGS 0 0\n"
+    finally:
+        os.close(fd)
+    os.write(2, f"Signatures: {filename} ({offset // block_size} blocks of {block_size} bytes)\n".encode())
+    return f"SIGS {block_size} {offset // block_size}\n".encode() + signatures
+
+def copy_range(src_fd, dst_fd, length, src_offset, dst_offset):
+    """Copies length bytes between two files at the given offsets. Returns how many were copied.
+
+    copy_file_range() keeps the bytes in the kernel (and on some
+    filesystems shares them instead of copying); where it can't be used we
+    fall back to pread()/pwrite().
+    """
+    copied = 0
+    while copied < length:
+        if copy_range.kernel_ok:
+            try:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied, src_offset + copied, dst_offset + copied)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copy_range.kernel_ok = False
+                continue
+        else:
+            data = os.pread(src_fd, min(length - copied, 1 << 20), src_offset + copied)
+            n = len(data)
+            view, position = memoryview(data), dst_offset + copied
+            while view:
+                written = os.pwrite(dst_fd, view, position)
+                view, position = view[written:], position + written
+        if n == 0: # the source ended early
+            break
+        copied += n
+    return copied
+copy_range.kernel_ok = hasattr(os, "copy_file_range")
+
+class DeltaFile:
+    """Rebuilds a file from our old copy and a delta (an output for FramedReader).
+
+    The new version goes to a temporary file, which replaces the old one
+    only once every byte is in.
+    """
+    zero_copy_ok = True
+
+    def __init__(self, filename, block_size, total_size):
+        self.filename = filename
+        self.block_size = block_size
+        self.total_size = total_size
+        self.basis_fd = os.open(filename, os.O_RDONLY)
+        self.basis_size = os.fstat(self.basis_fd).st_size
+        self.temp_path = f"{filename}.delta-{os.urandom(8).hex()}"
+        try:
+            self.fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            os.close(self.basis_fd)
+            raise
+        self.position = 0
+        self.written = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            bytes_written = os.pwrite(self.fd, view, self.position)
+            self.advance(bytes_written)
+            view = view[bytes_written:]
+
+    def advance(self, n):
+        self.position += n
+        self.written += n
+
+    def copy_blocks(self, first, count):
+        """Copies count of our old blocks, starting at block first, to the end of the new file."""
+        offset = first * self.block_size
+        length = count * self.block_size
+        if offset + length > self.basis_size:
+            raise ValueError(f"delta for {self.filename} refers past the end of our copy")
+        if copy_range(self.basis_fd, self.fd, length, offset, self.position) < length:
+            raise ValueError(f"our copy of {self.filename} shrank during a delta")
+        self.advance(length)
+
+    def close(self, complete):
+        os.close(self.basis_fd)
+        os.close(self.fd)
+        if complete and self.position == self.total_size:
+            os.rename(self.temp_path, self.filename)
+        else:
+            os.unlink(self.temp_path)
+
+# --- Client side: matching our file against the server's blocks ---
+
+def parse_signatures(data):
+    """Turns the server's signatures into {weak checksum: {strong hash: block number}}."""
+    table = {}
+    for index in range(len(data) // SIGNATURE_SIZE):
+        record = data[index * SIGNATURE_SIZE:(index + 1) * SIGNATURE_SIZE]
+        strong_hashes = table.setdefault(int.from_bytes(record[:4], 'big'), {})
+        strong_hashes.setdefault(bytes(record[4:]), index) # identical blocks: any one will do
+    return table
+
+def _rolling_candidates(data, block_size, table):
+    """Yields (position, weak checksum) of every window whose checksum is in table.
+
+    After a match, send() the position to carry on from instead of calling
+    next(); the checksum is then started afresh there.
+    """
+    last = len(data) - block_size
+    position = 0
+    while position <= last:
+        weak = zlib.adler32(data[position:position + block_size])
+        a, b = weak & 0xffff, weak >> 16
+        while True:
+            if weak in table:
+                jump = yield position, weak
+                if jump is not None:
+                    position = jump
+                    break
+            if position == last:
+                return
+            # Roll the window one byte: drop the first, add the next.
+            old, new = data[position], data[position + block_size]
+            a = (a - old + new) % ADLER_MOD
+            b = (b - block_size * old + a - 1) % ADLER_MOD
+            weak = b << 16 | a
+            position += 1
+
+def _numpy_candidates(data, block_size, table):
+    """Like _rolling_candidates(), but checksums whole stretches of windows with numpy.
+
+    With prefix sums S (of the bytes x) and T (of i * x[i]), the Adler-32 of
+    the window at k is a = 1 + S[k+n] - S[k] and
+    b = n + (k+n) * (S[k+n] - S[k]) - (T[k+n] - T[k]), both mod 65521.
+    """
+    known = numpy.sort(numpy.fromiter(table, dtype=numpy.int64, count=len(table)))
+    last = len(data) - block_size
+    position = 0
+    stretch = block_size
+    while position <= last:
+        # Right after a match the next block very often matches too, so that
+        # one window is checked on its own before a whole stretch is done.
+        weak = zlib.adler32(data[position:position + block_size])
+        if weak in table:
+            jump = yield position, weak
+            if jump is not None:
+                position, stretch = jump, block_size
+                continue
+        # Then ever longer stretches: short ones near edits, long ones
+        # through data the server has never seen.
+        start = position + 1
+        if start > last:
+            return
+        stretch = min(stretch * 2, SCAN_WINDOW)
+        end = min(last + 1, start + stretch)
+        n = end - start
+        x = numpy.frombuffer(data, numpy.uint8, n + block_size - 1, start).astype(numpy.int64)
+        s = numpy.concatenate(([0], numpy.cumsum(x)))
+        t = numpy.concatenate(([0], numpy.cumsum(x * numpy.arange(len(x)))))
+        sums = s[block_size:block_size + n] - s[:n]
+        a = (1 + sums) % ADLER_MOD
+        b = (block_size + (numpy.arange(n) + block_size) * sums - (t[block_size:block_size + n] - t[:n])) % ADLER_MOD
+        weaks = b << 16 | a
+        found = numpy.minimum(numpy.searchsorted(known, weaks), len(known) - 1)
+        hits = numpy.flatnonzero(known[found] == weaks)
+
+        position = end
+        for hit, weak in zip((hits + start).tolist(), weaks[hits].tolist()):
+            jump = yield hit, weak
+            if jump is not None:
+                position, stretch = jump, block_size
+                break
+
+def compute_delta(fd, size, block_size, table):
+    """Yields the ops that rebuild the first size bytes of fd out of the server's blocks.
+
+    Ops are (DELTA_COPY, first block, count) and (DELTA_LITERAL, offset,
+    length), where offset and length locate the literal bytes in fd.
+    Consecutive matching blocks become one DELTA_COPY.
+    """
+    if size < block_size or not table:
+        if size:
+            yield DELTA_LITERAL, 0, size
+        return
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as data:
+        scan = _numpy_candidates if numpy is not None else _rolling_candidates
+        candidates = scan(data, block_size, table)
+        literal_start = 0 # our bytes from here up to the next match go as a literal
+        run = None        # [first, count] of the copy run being built
+        try:
+            position, weak = next(candidates)
+            while True:
+                index = table[weak].get(block_digest(data[position:position + block_size]))
+                if index is None: # same checksum, different bytes
+                    position, weak = next(candidates)
+                    continue
+                if position > literal_start:
+                    if run is not None:
+                        yield DELTA_COPY, run[0], run[1]
+                        run = None
+                    yield DELTA_LITERAL, literal_start, position - literal_start
+                if run is not None and index == run[0] + run[1]:
+                    run[1] += 1
+                else:
+                    if run is not None:
+                        yield DELTA_COPY, run[0], run[1]
+                    run = [index, 1]
+                literal_start = position + block_size
+                position, weak = candidates.send(literal_start)
+        except StopIteration:
+            pass
+        finally:
+            candidates.close()
+        if run is not None:
+            yield DELTA_COPY, run[0], run[1]
+        if literal_start < size:
+            yield DELTA_LITERAL, literal_start, size - literal_start
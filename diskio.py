@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+"""
+How received files are laid out on disk, and how much of them stays in the page cache.
+
+Every header says how big its file will be before the first payload byte
+arrives, so the server can:
+  - preallocate: posix_fallocate() the whole file up front, so the
+    filesystem hands it one run of extents instead of growing it a buffer
+    at a time and interleaving it with every other upload (fragmentation).
+    A disk that hasn't the room fails the upload at once, not gigabytes in.
+    The size is the client's word for it, so only plain frames (whose
+    every byte must arrive) are preallocated, and never into the last
+    PREALLOCATE_RESERVE of the filesystem: a header alone can't fill it.
+  - drop behind: for files of --dropBehind bytes or more, advise the kernel
+    the file is written sequentially, and every DROP_WINDOW bytes tell it
+    (POSIX_FADV_DONTNEED) that the pages written so far won't be needed.
+    The first advice on a range only starts writing it back, so each range
+    is advised again until it is DROP_LAG behind the writes, by which time
+    its pages are clean and get dropped: a multi-GB upload doesn't push
+    everything else out of the page cache.
+  - go direct: files of --directIO bytes or more are written with O_DIRECT
+    from page-aligned buffers, bypassing the page cache
+    altogether.  Only the tail, less than a buffer's worth, goes through
+    the cache.  Filesystems without O_DIRECT (tmpfs) get a normal file.
+
+Preallocation grows the file to its full size at once, so a file that
+doesn't arrive complete is cut back to what did arrive.
+"""
+
+import os
+import errno
+import fcntl
+
+PREALLOCATE_MIN_SIZE = 1 << 20   # smaller files are left to delayed allocation
+PREALLOCATE_RESERVE = 0.05       # fraction of the filesystem preallocation never takes
+DEFAULT_DROP_BEHIND = 64 << 20   # files this big don't stay in the page cache
+DROP_WINDOW = 8 << 20            # bytes written between two DONTNEED advices
+DROP_LAG = 32 << 20              # how far behind the writes a range is advised again (writeback takes a while)
+DIRECT_ALIGNMENT = 4096          # O_DIRECT offsets, lengths and buffers are multiples of this
+DIRECT_BUFFER_SIZE = 1 << 20     # bytes collected before each O_DIRECT write
+
+# Errors that mean the disk can't take the file (anything else: no preallocation here)
+_NO_ROOM = (errno.ENOSPC, errno.EFBIG, errno.EDQUOT)
+
+class DropBehind:
+    """Keeps a big file's written pages from piling up in the page cache."""
+
+    def __init__(self, fd, start=0):
+        self.fd = fd
+        self.dropped = start              # pages before this were dropped
+        self.next = start + DROP_WINDOW   # where to advise next
+
+    def wrote(self, end):
+        """The file is written up to offset end."""
+        if end >= self.next:
+            # Pages still being written back stay; the next advice gets them.
+            os.posix_fadvise(self.fd, self.dropped, end - self.dropped, os.POSIX_FADV_DONTNEED)
+            self.dropped = max(self.dropped, end - DROP_LAG)
+            self.next = end + DROP_WINDOW
+
+    def done(self, end):
+        if end > self.dropped:
+            os.posix_fadvise(self.fd, self.dropped, end - self.dropped, os.POSIX_FADV_DONTNEED)
+
+class DiskPolicy:
+    """Preallocation, page cache advice and O_DIRECT for the files the server writes."""
+
+    def __init__(self, preallocate=True, drop_behind=DEFAULT_DROP_BEHIND, direct=None):
+        self.preallocate = preallocate and hasattr(os, "posix_fallocate")
+        self.drop_behind = drop_behind if hasattr(os, "posix_fadvise") else None # None: never
+        self.direct = direct if hasattr(os, "O_DIRECT") else None                  # None: never
+
+    def describe(self):
+        """One line for the log saying what we'll do."""
+        return (f"Disk: preallocation {'on' if self.preallocate else 'off'}, "
+                f"drop-behind {'from ' + str(self.drop_behind) + ' bytes' if self.drop_behind else 'off'}, "
+                f"O_DIRECT {'from ' + str(self.direct) + ' bytes' if self.direct else 'off'}")
+
+    def use_direct(self, size):
+        return self.direct is not None and size >= self.direct
+
+    def prepare(self, fd, offset, length, preallocate=True):
+        """Reserves [offset, offset + length) of fd and gives the kernel our advice. Returns whether it preallocated.
+
+        preallocate=False (a compressed, delta or otherwise unchecked size) only advises.
+        """
+        if length < PREALLOCATE_MIN_SIZE:
+            return False
+        preallocated = False
+        if preallocate and self.preallocate and _room_for(fd, length):
+            try:
+                os.posix_fallocate(fd, offset, length)
+                preallocated = True
+            except OSError as e:
+                if e.errno in _NO_ROOM:
+                    raise
+        if self.drop_behind is not None and length >= self.drop_behind:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        return preallocated
+
+    def drop_behind_for(self, fd, start, length):
+        """A DropBehind for a write of length bytes from start, or None if it's too small to bother."""
+        if self.drop_behind is None or length < self.drop_behind:
+            return None
+        return DropBehind(fd, start)
+
+def _room_for(fd, length):
+    """Whether length bytes fit on fd's filesystem and leave its reserve free; raises ENOSPC if they can't fit at all."""
+    st = os.fstatvfs(fd)
+    free = st.f_bavail * st.f_frsize
+    if length > free:
+        raise OSError(errno.ENOSPC, f"no room for {length} bytes ({free} free)")
+    return length <= free - st.f_blocks * st.f_frsize * PREALLOCATE_RESERVE
+
+def set_direct(fd, on=True):
+    """Turns O_DIRECT on (or off) for an open file. Returns False where the filesystem won't have it."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT if on else flags & ~os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return False
+    return True
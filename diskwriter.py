@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+
+"""
+Write-behind: received payloads go to disk from a pool of writer threads.
+
+Without it the thread (or event loop) reading a client's socket also writes
+every chunk to disk, so a slow disk stops the socket reads, the receive
+window fills and the client's transfer stalls with it.  With --writeBehind
+the reader copies each chunk into a queue and goes straight back to the
+socket; writer threads empty the queues, so receiving and writing overlap.
+
+There is a queue per device (st_dev of the file being written), each
+served by its own threads and bounded in bytes: a slow volume fills only
+its own queue and holds up only the clients writing to it.  When a queue
+is full, whoever adds to it waits for room, which slows that client's
+reads and lets TCP push back on the sender (backpressure).  The async
+engine's event loop mustn't wait: its chunk goes in over the limit, and
+that one client's socket isn't read again until the queue is down to half.
+
+All writes to one file go to one writer thread, in order.  A file's
+close() waits for its writes to land and raises the first error one of
+them hit, on the connection's own thread, so a full disk still fails the
+upload as it did before.  The event loop can't wait for that either: it
+has the writer thread close the file after its last write (close_behind)
+and hears back when it's done.  Payloads are copied through the queue rather
+than spliced, since splice() would write on the connection's thread.
+"""
+
+import os
+import time
+import threading
+import collections
+
+clock = time.perf_counter
+
+DEFAULT_THREADS_PER_DEVICE = 1
+
+class DeviceQueue:
+    """The queue of one device and the threads that write it out."""
+
+    def __init__(self, device, threads, limit):
+        self.device = device
+        self.limit = limit                  # bytes queued before producers wait
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)    # a job finished: there may be room now
+        self.drained = threading.Condition(self.lock) # a job finished: a file may have none left
+        self.lanes = []                     # one deque of jobs and its Condition per thread
+        self.waiting = []                   # (callback, since) of non-blocking producers waiting for room
+        self.queued = 0                     # bytes in the queue now
+        self.next_lane = 0
+        # Counted for the metrics endpoint
+        self.stalls = 0                     # times a producer waited for room
+        self.stall_seconds = 0.0
+        self.written = 0                    # bytes written out
+        for i in range(threads):
+            lane = (collections.deque(), threading.Condition(self.lock))
+            self.lanes.append(lane)
+            threading.Thread(target=self._run, args=lane, name=f"disk-writer {device:x}/{i}", daemon=True).start()
+
+    def lane(self):
+        """A lane (writer thread) for a new file, round-robin."""
+        with self.lock:
+            lane = self.lanes[self.next_lane]
+            self.next_lane = (self.next_lane + 1) % len(self.lanes)
+        return lane
+
+    def put(self, lane, output, work, args, size, block=True, always=False):
+        """Queues work(*args) for output's lane. Returns False if that filled the queue.
+
+        A blocking put waits while the queue is full.  A non-blocking one
+        queues the work regardless, and its caller should add nothing more
+        until when_room() calls back.  Work that is 'always' done runs even
+        after an earlier job of the output failed.
+        """
+        jobs, ready = lane
+        with self.lock:
+            if block and self.queued and self.queued + size > self.limit:
+                started = clock()
+                while self.queued and self.queued + size > self.limit:
+                    self.room.wait()
+                self.stalls += 1
+                self.stall_seconds += clock() - started
+            jobs.append((output, work, args, size, always))
+            self.queued += size
+            output.pending += 1
+            ready.notify()
+            return self.queued < self.limit
+
+    def when_room(self, callback):
+        """Calls callback() once the queue is down to half its limit: now, or later on a writer thread."""
+        with self.lock:
+            if self.queued > self.limit // 2:
+                self.waiting.append((callback, clock()))
+                self.stalls += 1
+                return
+        callback()
+
+    def _run(self, jobs, ready):
+        while True:
+            waiting = ()
+            with self.lock:
+                while not jobs:
+                    ready.wait()
+                output, work, args, size, always = jobs.popleft()
+            if output.error is None or always: # after an error the rest of that file is dropped
+                try:
+                    work(*args)
+                except Exception as e:
+                    output.error = e
+            with self.lock:
+                self.queued -= size
+                self.written += size
+                output.pending -= 1
+                self.room.notify_all()
+                self.drained.notify_all()
+                # Half empty, not just below the limit, or we'd stop and start for every chunk.
+                if self.waiting and self.queued <= self.limit // 2:
+                    waiting, self.waiting = self.waiting, []
+                    now = clock()
+                    self.stall_seconds += sum(now - since for _, since in waiting)
+            for callback, _ in waiting:
+                callback()
+
+    def wait_drained(self, output):
+        with self.lock:
+            while output.pending:
+                self.drained.wait()
+
+class WriteBehindOutput:
+    """An output for FramedReader/FrameParser whose writes happen on a writer thread."""
+    # Bytes have to pass through the queue, so no splice() into the file
+    zero_copy_ok = False
+
+    def __init__(self, output, queue, backpressure=None):
+        self.output = output
+        self.queue = queue
+        self.backpressure = backpressure # None: wait for room; else called with the queue when we filled it
+        self.lane = queue.lane()
+        self.pending = 0   # jobs queued and not yet done (changed under the queue's lock)
+        self.error = None  # the first exception a job raised
+        self.written = 0   # bytes handed over so far
+
+    @property
+    def fd(self):
+        return self.output.fd
+
+    def _submit(self, work, args, size):
+        if self.error is not None:
+            raise self.error
+        if self.backpressure is None:
+            self.queue.put(self.lane, self, work, args, size)
+        elif not self.queue.put(self.lane, self, work, args, size, block=False):
+            self.backpressure(self.queue)
+
+    def write(self, data):
+        # The caller reuses its buffer: keep a copy of our own until it's written.
+        data = data if isinstance(data, bytes) else bytes(data)
+        self._submit(self.output.write, (data,), len(data))
+        self.written += len(data)
+
+    def copy_blocks(self, first, count):
+        """A delta's copy of old blocks, done in order with the writes around it."""
+        self._submit(self.output.copy_blocks, (first, count), 0)
+        self.written += count * self.output.block_size
+
+    def flush(self):
+        """Waits until every queued write is done; raises the first one's error."""
+        self.queue.wait_drained(self)
+        if self.error is not None:
+            raise self.error
+
+    def forget_from(self, offset):
+        self._submit(self.output.forget_from, (offset,), 0)
+
+    def close(self, complete):
+        try:
+            self.flush()
+        except Exception:
+            self.output.close(False)
+            if complete: # otherwise the upload is being dropped anyway
+                raise
+            return
+        self.output.close(complete)
+
+    def close_behind(self, complete, done):
+        """close(), but on the writer thread after our last write; done(error or None) is called there."""
+        self.queue.put(self.lane, self, self._close_job, (complete, done), 0, block=False, always=True)
+
+    def _close_job(self, complete, done):
+        error = None
+        try:
+            if self.error is not None:
+                self.output.close(False)
+                if complete: # otherwise the upload is being dropped anyway
+                    error = self.error
+            else:
+                self.output.close(complete)
+        except Exception as e:
+            error = e
+        done(error)
+
+class DiskWriters:
+    """The writer threads and queues of one server process, a set per device."""
+
+    def __init__(self, queue_bytes, threads_per_device=DEFAULT_THREADS_PER_DEVICE):
+        self.queue_bytes = queue_bytes
+        self.threads_per_device = threads_per_device
+        self.lock = threading.Lock()
+        self.devices = {} # st_dev -> DeviceQueue, made when a device is first written to
+
+    def queue_for(self, fd):
+        device = os.fstat(fd).st_dev
+        with self.lock:
+            queue = self.devices.get(device)
+            if queue is None:
+                queue = self.devices[device] = DeviceQueue(device, self.threads_per_device, self.queue_bytes)
+        return queue
+
+    def output(self, output, backpressure=None):
+        """Wraps an open output (OutputFile, PartialFile or DeltaFile) so its writes go behind.
+
+        Without backpressure a write waits while the queue is full; with it,
+        the write is queued anyway and backpressure(queue) is called.
+        """
+        return WriteBehindOutput(output, self.queue_for(output.fd), backpressure)
+
+    def stats(self):
+        """(device, bytes queued, bytes written, stalls, seconds stalled) of every device so far."""
+        with self.lock:
+            queues = list(self.devices.values())
+        result = []
+        for queue in queues:
+            with queue.lock:
+                result.append((queue.device, queue.queued, queue.written, queue.stalls, queue.stall_seconds))
+        return result
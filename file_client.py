@@ -9,11 +9,263 @@ using a custom framing protocol.
 import socket  
 import sys     
 import os    
-from framing import FramedWriter   
-from buffers import BufferedWriter 
+import threading
+import time
+import random
+import select
+from framing import FramedWriter, ServerBusy, read_status
+from compression import CODEC_NONE, CODEC_NAMES
+from checksum import CHECKSUM_NAMES
+from batch import BATCH_FILE_MAX, is_relative_path
+from tuning import BufferTuning, parse_size
+from profiling import Profiler
+from buffers import BufferedWriter, BufferedReader
 sys.path.append("lib")  
 import params       
 
+# Seconds we wait for the status line.  A server from before admission
+# control never sends one: it just reads our headers.
+STATUS_TIMEOUT = 10
+
+class ConnectFailed(Exception):
+    """We couldn't connect, or the server wouldn't take us."""
+
+def connect(serverHost, serverPort, tuning):
+    """Opens one TCP connection to the server; raises ConnectFailed if it can't."""
+    # This 'try' block catches network errors (e.g., "Connection refused")
+    s = None
+    try:
+        # 1. Ask the OS for a new, empty socket "plug"
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A fixed --sockBuf has to be in place before the handshake.
+        tuning.prepare_socket(s.fileno())
+        
+        # 2. Tell the socket to connect to the server's address.
+        # This is a "blocking call" - the program pauses here until
+        # the connection is made or it fails.
+        s.connect((serverHost, serverPort))
+    except Exception as e:
+        # 'e' holds the error message (e.g., "Connection refused")
+        if s is not None:
+            s.close()
+        raise ConnectFailed(f"Error connecting to server: {e}")
+    return s
+
+def connect_admitted(serverHost, serverPort, retries, tuning):
+    """Connects and waits for the server's "OK".
+
+    Returns the socket's fd, a reader for replies and the newest header
+    version the server said it reads.
+
+    A busy server answers "BUSY <seconds>" and hangs up; we back off
+    (doubling the wait, with some jitter) and try again up to 'retries' times.
+    A server that says nothing for STATUS_TIMEOUT seconds is taken for a
+    legacy one and gets legacy headers.  Raises ConnectFailed when we can't get in.
+    """
+    for attempt in range(retries + 1):
+        s = connect(serverHost, serverPort, tuning)
+        # From here on we work with the raw file descriptor.
+        socket_fd = s.detach()
+        replies = BufferedReader(socket_fd, 256)
+        readable, _, _ = select.select([socket_fd], [], [], STATUS_TIMEOUT)
+        if not readable:
+            os.write(2, f"No status from the server after {STATUS_TIMEOUT}s, assuming an old server\n".encode())
+            return socket_fd, replies, 1
+        status, value = read_status(replies)
+        if status == "OK":
+            return socket_fd, replies, value
+        os.close(socket_fd)
+        if status != "BUSY":
+            raise ConnectFailed("Error: server closed the connection before accepting it")
+        delay = value * (2 ** attempt) * random.uniform(0.8, 1.2)
+        os.write(2, f"Server busy, retrying in {delay:.1f}s\n".encode())
+        time.sleep(delay)
+    raise ConnectFailed(f"Error: server still busy after {retries} retries")
+
+def walk_files(paths):
+    """Expands directories into every regular file below them (for --recursive).
+
+    os.scandir() hands us each entry's type and inode without a stat() per
+    file.  Sorting by inode puts the files roughly in the order their
+    metadata sits on disk, so reading them seeks far less than going
+    directory by directory would.
+    """
+    found = [] # (inode, path)
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append((0, path)) # named on the command line: sent first, as given
+            continue
+        directories = [path]
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except OSError as e:
+                os.write(2, f"Error: can't read directory: {e}\n".encode())
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        found.append((entry.inode(), entry.path))
+    found.sort(key=lambda item: item[0])
+    return [path for _, path in found]
+
+def batch_small_files(plan):
+    """Turns each run of whole-file tasks in a plan into one batch task: a (list of filenames,).
+
+    The writer reads those files ahead on its thread pool and packs the
+    small ones into batch frames.
+    """
+    batched = []
+    for task in plan:
+        if len(task) == 1:
+            if batched and isinstance(batched[-1][0], list):
+                batched[-1][0].append(task[0])
+            else:
+                batched.append(([task[0]],))
+        else:
+            batched.append(task)
+    return batched
+
+def plan_streams(files_to_add, streams, stripe_threshold):
+    """Splits the files into one to-do list per connection.
+
+    A file bigger than stripe_threshold is cut into one byte range per
+    connection; smaller files go whole to the connection with the least
+    data queued so far. With one stream the list is just the files in order.
+    """
+    plans = [[] for _ in range(streams)]
+    queued_bytes = [0] * streams
+    for filename in files_to_add:
+        if streams == 1:
+            plans[0].append((filename,))
+            continue
+        try:
+            size = os.stat(filename).st_size
+        except FileNotFoundError:
+            os.write(2, f"Error: Input file '{filename}' not found.\n".encode())
+            continue
+        if size > stripe_threshold:
+            # Stripes of one file share a random transfer id so the server
+            # knows which pieces belong together.
+            transfer_id = int.from_bytes(os.urandom(8), 'big')
+            stripe_size = -(-size // streams) # round up
+            for i in range(streams):
+                offset = i * stripe_size
+                length = min(stripe_size, size - offset)
+                plans[i].append((filename, offset, length, size, transfer_id))
+                queued_bytes[i] += length
+        else:
+            i = queued_bytes.index(min(queued_bytes))
+            plans[i].append((filename,))
+            queued_bytes[i] += size
+    return plans
+
+def send_plan(serverHost, serverPort, plan, options):
+    """Sends one to-do list of files (or file ranges) over its own connection.
+
+    With --resume (options["client_id"] set) a dropped connection isn't the
+    end: we reconnect and the server tells us how much of the interrupted
+    file it already has.
+    """
+    retries = options["retries"]
+    client_id = options["client_id"]
+    done = 0     # tasks finished so far (survives reconnects)
+    attempt = 0
+    while True:
+        # 1. Get the raw OS file descriptor (a number) for a connection the server
+        # has admitted.  This is the "pipe" that our BufferedWriter will write to.
+        tuning = options["tuning"]
+        socket_fd, replies, header_version = connect_admitted(serverHost, serverPort, retries, tuning)
+        print(f"Connected to server at {serverHost}:{serverPort}.")
+        tuned = not tuning.adaptive
+
+        # 2. Build our abstraction layers, from the bottom up:
+        #    - BufferedWriter(socket_fd): Creates a writer that reliably writes
+        #      bytes to the network socket.
+        #    - FramedWriter(...): Creates our file-packaging tool and tells it
+        #      to use the BufferedWriter as its destination.
+        writer = FramedWriter(BufferedWriter(socket_fd, tuning.initial_buffer_size()), options["codec"], options["compress_threads"],
+                              options["checksum"], options["checksum_blocks"], options["prefetch_threads"],
+                              header_version)
+        profile = options["profiler"].connection(f"{serverHost}:{serverPort}") if options["profiler"] else None
+        if profile is not None:
+            profile.instrument_writer(writer)
+            profile.start()
+
+        try:
+            # 3. Loop through the "to-do list" (shopping list) of filenames
+            while done < len(plan):
+                task = plan[done]
+                try:
+                    # 4. Tell the FramedWriter to do its job on this one file.
+                    # This is where the magic happens:
+                    # - FramedWriter opens the file, gets its size, and creates the 108-byte header.
+                    # - FramedWriter writes the header to the BufferedWriter.
+                    # - FramedWriter reads the file's data and writes it to the BufferedWriter.
+                    # - The BufferedWriter sends all those bytes over the network.
+                    if client_id is not None:
+                        writer.write_file_resumable(task[0], client_id, replies)
+                    elif options["delta"]:
+                        writer.write_file_delta(task[0], replies)
+                    elif options["dedup"]:
+                        writer.write_file_dedup(task[0], replies)
+                    elif isinstance(task[0], list):
+                        # Many files, small ones packed into batches (--recursive)
+                        writer.write_files_batched(task[0])
+                    elif len(task) == 1:
+                        writer.write_file(task[0])
+                    else:
+                        # One stripe of a big file: (filename, offset, length, total size, transfer id)
+                        writer.write_file_range(*task)
+                except FileNotFoundError:
+                    # Catch error if the user typed a bad filename
+                    os.write(2, f"Error: Input file '{task[0]}' not found.\n".encode())
+                except ValueError as e:
+                    # A file the header can't describe (an older server's 100-byte name limit)
+                    os.write(2, f"Error: can't send '{task[0]}': {e}\n".encode())
+                done += 1
+                # After the first file on a connection we know what the link is like.
+                if not tuned:
+                    size = tuning.tune(socket_fd, f"{serverHost}:{serverPort}")
+                    if size:
+                        writer.set_buffer_size(size)
+                    tuned = True
+
+            # 5. We are done sending this list.
+            # This calls writer.close() -> BufferedWriter.close() -> os.close(socket_fd).
+            # This flushes any remaining data in the buffer and closes the
+            # socket, which is the "hang up" signal that tells the server we're done.
+            # With checksums we first wait for the server's verdict on the last files.
+            if options["checksum"]:
+                options["rejected"].extend(writer.finish(replies))
+            else:
+                writer.close()
+            return
+        except (OSError, ServerBusy) as e:
+            writer.abort()
+            if client_id is None or attempt >= retries:
+                raise
+            delay = getattr(e, "retry_after", 1.0) * (2 ** attempt) * random.uniform(0.8, 1.2)
+            os.write(2, f"Connection lost ({e}), resuming in {delay:.1f}s\n".encode())
+            attempt += 1
+            time.sleep(delay)
+        finally:
+            if profile is not None:
+                profile.dump() # one breakdown per connection, reconnects included
+
+def run_plan(serverHost, serverPort, plan, options):
+    """send_plan(), noting a failure in options["failed"] (a stream's thread can't exit the program)."""
+    try:
+        send_plan(serverHost, serverPort, plan, options)
+    except ConnectFailed as e:
+        os.write(2, f"{e}\n".encode())
+        options["failed"].append(plan)
+    except Exception as e:
+        os.write(2, f"Error: transfer failed: {e}\n".encode())
+        options["failed"].append(plan)
+
 def main():
     # --- Block 2: Command-Line Argument Parsing ---
     
@@ -21,6 +273,22 @@ def main():
     switchesVarDefaults = (
         # (flags, variable_name, default_value)
         (('-s', '--server'), 'server', "127.0.0.1:50001"), # -s flag, stores in 'server'
+        (('-n', '--streams'), 'streams', 1),                 # parallel connections to use
+        (('-t', '--stripeThreshold'), 'stripeThreshold', 8 * 1024 * 1024), # files bigger than this are split across streams
+        (('-r', '--retries'), 'retries', 5),                 # attempts when the server says BUSY
+        (('-z', '--compress'), 'compress', "none"),          # none, zlib or lzma (skipped for files that don't shrink)
+        (('-j', '--compressThreads'), 'compressThreads', 1), # >1: compress blocks in parallel on this many threads
+        (('--resume',), 'resume', False),                    # resumable uploads: reconnect and skip what the server has
+        (('--clientId',), 'clientId', socket.gethostname()), # who we are, for the server's .part files
+        (('--delta',), 'delta', False),                      # only send what changed since the server's copy
+        (('--dedup',), 'dedup', False),                      # only send chunks the server's store doesn't have
+        (('-k', '--checksum'), 'checksum', "none"),         # none, crc32 or blake2b trailer on every file
+        (('--checksumBlocks',), 'checksumBlocks', False),    # also a digest per MiB (says where damage starts)
+        (('-B', '--bufferSize'), 'bufferSize', "auto"),      # our buffers, in bytes (k/m suffix), or sized from the link
+        (('--sockBuf',), 'sockBuf', "auto"),                 # SO_SNDBUF in bytes, or left to the kernel unless the link needs more
+        (('-R', '--recursive'), 'recursive', False),         # send whole directory trees, small files in batches
+        (('--prefetchThreads',), 'prefetchThreads', 8),      # threads reading small files ahead (--recursive)
+        (('--profile',), 'profile', os.environ.get("FT_PROFILE") or "none"), # stages,cprofile,tracemalloc or all
         (('-?', '--usage'), "usage", False),          # -? (help) flag, stores in 'usage'
     )
     
@@ -38,7 +306,7 @@ def main():
     # 2. Did the user forget to provide any filenames?
     if paramMap["usage"] or not files_to_add:
         # If either is true, print the correct usage and exit.
-        print("Usage: %s -s <server>:<port> <file1> [file2...]" % sys.argv[0])
+        print("Usage: %s -s <server>:<port> [--streams N] [--stripeThreshold bytes] [--retries N] [--compress none|zlib|lzma] [--compressThreads N] [--checksum none|crc32|blake2b [--checksumBlocks]] [--resume [--clientId id] | --delta | --dedup] [--recursive [--prefetchThreads N]] [--bufferSize N|auto] [--sockBuf N|auto] [--profile stages,cprofile,tracemalloc|all] <file or dir> [...]" % sys.argv[0])
         sys.exit(1) # Exit with an error code
     
     # Try to split the server address (e.g., "127.0.0.1:50000") into host and port
@@ -50,59 +318,88 @@ def main():
         os.write(2, f"Error: Can't parse server:port from '{server_address}'\n".encode())
         sys.exit(1)
 
-    # --- Block 3: Connect to the Server ---
-    
-    # This 'try' block catches network errors (e.g., "Connection refused")
     try:
-        # 1. Ask the OS for a new, empty socket "plug"
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        # 2. Tell the socket to connect to the server's address.
-        # This is a "blocking call" - the program pauses here until
-        # the connection is made or it fails.
-        s.connect((serverHost, serverPort))
-    except Exception as e:
-        # 'e' holds the error message (e.g., "Connection refused")
-        os.write(2, f"Error connecting to server: {e}\n".encode())
+        streams = int(paramMap["streams"])
+        stripe_threshold = int(paramMap["stripeThreshold"])
+        options = {
+            "retries": int(paramMap["retries"]),
+            "codec": CODEC_NAMES[paramMap["compress"]],
+            "compress_threads": int(paramMap["compressThreads"]),
+            "client_id": paramMap["clientId"] if paramMap["resume"] else None,
+            "delta": bool(paramMap["delta"]),
+            "dedup": bool(paramMap["dedup"]),
+            "checksum": CHECKSUM_NAMES[paramMap["checksum"]],
+            "checksum_blocks": bool(paramMap["checksumBlocks"]),
+            "prefetch_threads": int(paramMap["prefetchThreads"]),
+            "tuning": BufferTuning(parse_size(paramMap["bufferSize"]), parse_size(paramMap["sockBuf"]), sending=True),
+            "profiler": Profiler.from_spec(paramMap["profile"]),
+            "rejected": [], # (filename, offset) of files the server found damaged
+            "failed": [],   # plans whose connection failed
+        }
+        if streams < 1:
+            raise ValueError("need at least one stream")
+        if options["prefetch_threads"] < 1:
+            raise ValueError("need at least one prefetch thread")
+        if options["delta"] + options["dedup"] + (options["client_id"] is not None) > 1:
+            raise ValueError("pick one of --resume, --delta and --dedup")
+        # Delta and dedup frames carry no trailer, so refuse rather than drop it quietly.
+        if options["checksum"] and (options["delta"] or options["dedup"]):
+            raise ValueError("--checksum doesn't apply to --delta or --dedup uploads")
+    except (ValueError, KeyError) as e:
+        os.write(2, f"Error: bad --streams/--stripeThreshold/--retries/--compress/--compressThreads/--checksum/--prefetchThreads/--bufferSize/--sockBuf/--profile value, or conflicting modes ({e})\n".encode())
         sys.exit(1)
 
-    print(f"Connected to server at {server_address}.")
+    if paramMap["recursive"]:
+        # The server recreates the tree under its own directory, so it has to be named relatively.
+        for path in files_to_add:
+            if os.path.isdir(path) and not is_relative_path(path):
+                os.write(2, f"Error: give directories as relative paths (without '..'): {path}\n".encode())
+                sys.exit(1)
+        files_to_add = walk_files(files_to_add)
+
+    # --- Block 3: Plan the Connections ---
+    # With --streams N the files are spread over N parallel connections so a
+    # single TCP window doesn't limit us on high-latency links.
+    # (Resumable, delta and deduplicated uploads work on whole files, so they are never striped.)
+    if options["client_id"] is not None or options["delta"] or options["dedup"]:
+        stripe_threshold = float("inf")
+    plans = plan_streams(files_to_add, streams, stripe_threshold)
+    # Batches are plain frames: no resume, delta, dedup or checksum trailer,
+    # and small files aren't worth compressing.
+    if paramMap["recursive"] and not (options["client_id"] is not None or options["delta"]
+                                      or options["dedup"] or options["checksum"]):
+        plans = [batch_small_files(plan) for plan in plans]
+        if options["codec"] != CODEC_NONE:
+            os.write(2, f"Warning: --compress only applies to files over {BATCH_FILE_MAX} bytes with --recursive; "
+                        f"smaller ones go in uncompressed batches\n".encode())
+
+    if paramMap["recursive"]:
+        print(f"Sending {len(files_to_add)} files")
+    else:
+        print(f"Sending files: {', '.join(files_to_add)}")
+
+    os.write(2, f"{options['tuning'].describe()}\n".encode())
 
     # --- Block 4: Send the Files ---
-    
-    # 1. Get the raw OS file descriptor (a number) for our new socket 's'.
-    # This is the "pipe" that our BufferedWriter will write to.
-    socket_fd = s.fileno()
-    
-    # 2. Build our abstraction layers, from the bottom up:
-    #    - BufferedWriter(socket_fd): Creates a writer that reliably writes
-    #      bytes to the network socket.
-    #    - FramedWriter(...): Creates our file-packaging tool and tells it
-    #      to use the BufferedWriter as its destination.
-    writer = FramedWriter(BufferedWriter(socket_fd)) 
-
-    print(f"Sending files: {', '.join(files_to_add)}")
-    
-    # 3. Loop through the "to-do list" (shopping list) of filenames
-    for filename in files_to_add:
-        try:
-            # 4. Tell the FramedWriter to do its job on this one file.
-            # This is where the magic happens:
-            # - FramedWriter opens the file, gets its size, and creates the 108-byte header.
-            # - FramedWriter writes the header to the BufferedWriter.
-            # - FramedWriter reads the file's data and writes it to the BufferedWriter.
-            # - The BufferedWriter sends all those bytes over the network.
-            writer.write_file(filename)
-        except FileNotFoundError:
-            # Catch error if the user typed a bad filename
-            os.write(2, f"Error: Input file '{filename}' not found.\n".encode())
-    
-    # 5. We are done sending all files.
-    # This calls writer.close() -> BufferedWriter.close() -> os.close(socket_fd).
-    # This flushes any remaining data in the buffer and closes the
-    # socket, which is the "hang up" signal that tells the server we're done.
-    writer.close()
-    
+    if streams == 1:
+        run_plan(serverHost, serverPort, plans[0], options)
+    else:
+        # One thread per connection; each runs its own FramedWriter.
+        threads = [threading.Thread(target=run_plan, args=(serverHost, serverPort, plan, options))
+                   for plan in plans if plan]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    if options["failed"]:
+        os.write(2, f"Error: {len(options['failed'])} of {len([plan for plan in plans if plan])} "
+                    f"connection(s) failed; the transfer is incomplete\n".encode())
+        sys.exit(1)
+    if options["rejected"]:
+        os.write(2, f"Error: {len(options['rejected'])} file(s) failed verification: "
+                    f"{', '.join(name for name, _ in options['rejected'])}\n".encode())
+        sys.exit(1)
     print("File transfer complete.")
 
 # --- Block 5: Main Execution Guard ---
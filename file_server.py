@@ -5,8 +5,8 @@
 File transfer server. Listens for a connection and receives one or more files
 using a custom framing protocol.
 
-This is the THREADED version. It uses standard Python threading to handle 
-multiple clients concurrently.
+This is the THREADED version. It uses a fixed pool of Python threads to handle 
+multiple clients concurrently (or, with --engine async, a single event loop).
 """
 
 # --- Block 1: Imports and Setup ---
@@ -14,19 +14,34 @@ import socket  # Provides networking tools (socket(), bind(), listen(), accept()
 import sys     # Used for sys.exit() and sys.path
 import os      # Provides OS-level functions like fileno()
 import threading # <--- NEW: The library for creating and managing threads
-from framing import FramedReader   # Your custom tool to unpack 108-byte headers
+import selectors # Event loop for the async engine (epoll/kqueue when available)
+import resource  # To raise the open-file limit for many concurrent clients
+import queue     # Hands accepted connections to the worker pool
+import signal    # SIGUSR1 prints the pool counters
+import time
+import collections # Work writer threads hand back to the event loop
+from framing import FramedReader, FrameParser, STATUS_OK, busy_status # Your custom tool to unpack 108-byte headers
 from buffers import BufferedReader # Your custom tool for reliable os.read() calls
+from chunkstore import ChunkStore # Server-side chunk store for deduplicated uploads
+from tuning import BufferTuning, parse_size # Buffer sizes, fixed or from the link
+from metrics import Metrics, serve_metrics # Counters for the optional Prometheus endpoint
+from profiling import Profiler # Opt-in per-connection profiling (--profile / FT_PROFILE)
+from diskwriter import DiskWriters # Optional write-behind pool for received payloads
+from diskio import DiskPolicy # Preallocation, page cache advice and O_DIRECT for received files
 sys.path.append("lib")       # Adds 'lib' folder to Python's search path
 import params                # Your teacher's helper script for parsing command-line args
 
 # --- NEW: Thread Handler Function ---
 # This function is the "worker" for each thread. It runs concurrently
 # with the main server loop and other client threads.
-def handle_client(conn, addr):
+def handle_client(conn, addr, store=None, tuning=None, metrics=None, profiler=None, disk_writers=None, disk_policy=None):
     # 'conn' is the connection socket object specific to this client.
     # 'addr' is the client's (IP, port) information.
     # threading.get_ident() gives us the unique ID of the current thread for logging.
     print(f"Thread (ID: {threading.get_ident()}): Handling connection from {addr}")
+    reader = None
+    counted = metrics.connection(addr) if metrics is not None else None
+    profile = profiler.connection(f"client {addr}") if profiler is not None else None
     try:
         # 1. Get the raw file descriptor
         # We need the raw integer 'pipe' number for our low-level buffers.
@@ -35,13 +50,24 @@ def handle_client(conn, addr):
         # 2. Build the abstraction layers
         # Create a BufferedReader to read reliably from the socket pipe.
         # Pass that to a FramedReader that understands our file format.
-        reader = FramedReader(BufferedReader(conn_fd))
+        tuning = tuning or BufferTuning(sending=False)
+        reader = FramedReader(BufferedReader(conn_fd, tuning.initial_buffer_size()), reply=conn.sendall, store=store,
+                              metrics=counted, disk_writers=disk_writers, disk_policy=disk_policy)
+        if profile is not None:
+            profile.instrument_reader(reader)
+            profile.start()
 
         # 3. Use the abstraction to receive files
         # The loop continues as long as the client is sending files.
         # It returns False when the client disconnects (sends 0 bytes).
+        tuned = not tuning.adaptive
         while reader.read_next_file():
-            pass # The read_next_file() method does all the actual work.
+            # The read_next_file() method does all the actual work.
+            if not tuned: # after the first file we know what the link is like
+                size = tuning.tune(conn_fd, f"client {addr}")
+                if size:
+                    reader.set_buffer_size(size)
+                tuned = True
         
         # We reach here only when the client has successfully disconnected.
         print(f"Thread (ID: {threading.get_ident()}): Finished with client {addr}")
@@ -53,80 +79,646 @@ def handle_client(conn, addr):
         os.write(2, f"Thread Error: {e}\n".encode())
     finally:
         # 4. Clean up THIS client's connection.
-        # This is critical. It closes the socket for this specific client.
+        # This is critical. It closes the socket for this specific client
+        # (and the splice pipe the reader may have opened for it).
+        if reader is not None:
+            reader.release()
+        if counted is not None:
+            metrics.close(counted)
+        if profile is not None:
+            profile.dump()
         conn.close() 
         # Unlike the fork version, we DO NOT call sys.exit(0) here.
         # When this function returns, the thread automatically disappears.
 
+# --- Graceful Shutdown ---
+# SIGTERM (sent by the pre-fork parent, or by an admin) stops a server from
+# accepting while it lets the clients it already has finish their uploads.
+class ServerShutdown(Exception):
+    pass
+
+def raise_shutdown(signum, frame):
+    raise ServerShutdown()
+
+# --- Admission Control ---
+# Counters shared by the accept loop and the pool workers.  They are only
+# touched once or twice per connection, so a plain lock is cheap enough.
+# Reentrant, because the SIGUSR1 report may run on the accept loop's thread
+# while it holds the lock.
+class ServerStats:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.accepted = 0       # connections admitted (queued for a worker)
+        self.rejected = 0       # connections turned away with BUSY
+        self.completed = 0      # connections a worker finished with
+        self.queued = 0         # admitted, waiting for a worker
+        self.in_flight = 0      # being received by a worker right now
+        self.queue_wait_total = 0.0 # seconds spent queued, summed over all connections
+        self.queue_wait_max = 0.0
+
+    def admitted(self):
+        with self.lock:
+            self.accepted += 1
+            self.queued += 1
+
+    def refused(self):
+        with self.lock:
+            self.rejected += 1
+
+    def started(self, waited):
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+
+    def finished(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def report(self):
+        with self.lock:
+            started = self.completed + self.in_flight
+            average_wait = self.queue_wait_total / started if started else 0.0
+            return (f"in_flight={self.in_flight} queued={self.queued} accepted={self.accepted} "
+                    f"rejected={self.rejected} completed={self.completed} "
+                    f"queue_wait_avg={average_wait:.3f}s queue_wait_max={self.queue_wait_max:.3f}s")
+
+def reject_client(conn, retry_after):
+    """Tells an over-limit client to come back later, without waiting on it."""
+    try:
+        conn.setblocking(False)
+        conn.send(busy_status(retry_after))
+    except OSError:
+        pass # the client is gone or its buffer is full; the close says enough
+    conn.close()
+
+# --- Worker Pool ---
+# A fixed number of threads take accepted connections from a bounded queue.
+# When both the workers and the queue are full (or max_uploads clients are
+# already admitted) new clients get "BUSY" right away instead of stalling.
+def run_worker_pool(s, pool_size, queue_depth, max_uploads, retry_after, stats, grace, store=None, tuning=None,
+                    metrics=None, profiler=None, disk_writers=None, disk_policy=None):
+    work = queue.Queue(maxsize=queue_depth)
+
+    def worker():
+        while True:
+            conn, addr, queued_at = work.get()
+            waited = time.monotonic() - queued_at
+            stats.started(waited)
+            if metrics is not None:
+                metrics.waited(waited)
+            try:
+                # Tell the client we are ready for its files.
+                conn.sendall(STATUS_OK)
+            except OSError as e:
+                os.write(2, f"Thread Error: {e}\n".encode())
+                conn.close()
+            else:
+                handle_client(conn, addr, store, tuning, metrics, profiler, disk_writers, disk_policy) # closes conn when done
+            finally:
+                stats.finished()
+
+    def refuse(conn):
+        stats.refused()
+        if metrics is not None:
+            metrics.rejected += 1
+        reject_client(conn, retry_after)
+
+    for _ in range(pool_size):
+        # Daemon threads: if you kill the main server (Ctrl+C), these threads
+        # will automatically die too, instead of keeping your terminal stuck.
+        threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        try:
+            # 1. Wait for a new client.
+            conn, addr = s.accept()
+            print(f"Main: Accepted connection from {addr}")
+            if metrics is not None:
+                metrics.accepted += 1 # only this thread counts these
+
+            # 2. Over the limit?  Say so now rather than letting it hang.
+            if stats.queued + stats.in_flight >= max_uploads:
+                refuse(conn)
+                continue
+            try:
+                work.put_nowait((conn, addr, time.monotonic()))
+            except queue.Full:
+                refuse(conn)
+                continue
+            stats.admitted()
+
+        except (KeyboardInterrupt, ServerShutdown):
+            # This handles Ctrl+C (or SIGTERM) gracefully: no new clients, but
+            # the ones already admitted get up to 'grace' seconds to finish.
+            print("\nServer stopping...")
+            s.close()
+            deadline = time.monotonic() + grace
+            while stats.queued + stats.in_flight and time.monotonic() < deadline:
+                time.sleep(0.1)
+            print(f"Main: {stats.report()}")
+            break
+        except Exception as e:
+            # Catch any other unexpected errors so the server doesn't crash.
+            print(f"Main: Error accepting connection: {e}")
+
+def start_stats_reporter(stats, interval):
+    """Prints the counters every 'interval' seconds (when they changed) and on SIGUSR1."""
+    signal.signal(signal.SIGUSR1, lambda signum, frame: os.write(2, f"Stats (pid {os.getpid()}): {stats.report()}\n".encode()))
+    if interval <= 0:
+        return
+    def reporter():
+        last = None
+        while True:
+            time.sleep(interval)
+            line = stats.report()
+            if line != last:
+                os.write(2, f"Stats (pid {os.getpid()}): {line}\n".encode())
+                last = line
+    threading.Thread(target=reporter, daemon=True).start()
+
+# --- Async Engine ---
+# One thread, one event loop: every client socket is non-blocking and
+# registered with a selector.  Whatever bytes arrive are pushed into that
+# client's FrameParser, which keeps track of where in the stream it is.
+# No thread stacks, so thousands of slow clients cost very little.
+class AsyncClient:
+    """One client of the async engine: its socket, its FrameParser and the replies it hasn't taken yet."""
+
+    def __init__(self, sel, conn, addr):
+        self.sel = sel
+        self.conn = conn
+        self.addr = addr
+        self.parser = None
+        self.outbox = bytearray() # replies the socket had no room for
+        self.paused = False       # not read while its write-behind queue is full
+        self.closed = False       # socket closed; kept only until its files are closed too
+        self.hung_up = False      # ...because it said goodbye, not because it failed
+        self.mask = selectors.EVENT_READ # 0: not registered at all
+        sel.register(conn, self.mask, self)
+
+    def update(self):
+        """Tells the selector what we wait for: data unless paused, and room to send while replies are queued."""
+        mask = (0 if self.paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if self.outbox else 0)
+        if mask == self.mask:
+            return
+        if not mask:
+            self.sel.unregister(self.conn)
+        elif not self.mask:
+            self.sel.register(self.conn, mask, self)
+        else:
+            self.sel.modify(self.conn, mask, self)
+        self.mask = mask
+
+    def close(self):
+        if self.mask:
+            self.sel.unregister(self.conn)
+        self.mask = 0
+        self.closed = True
+        self.conn.close()
+
+    def resume(self):
+        if self.paused and not self.closed:
+            self.paused = False
+            self.update()
+
+    def reply(self, data):
+        """Sends data to the client; what the socket can't take now goes out on EVENT_WRITE."""
+        # A reply goes to a client that is waiting for it, so a line fits at
+        # once; a list of delta signatures may not.  Nobody waits on either.
+        if self.closed:
+            return
+        if not self.outbox:
+            try:
+                data = memoryview(data)[self.conn.send(data):]
+            except BlockingIOError:
+                pass
+        if data:
+            self.outbox += data
+            self.update()
+
+    def flush(self):
+        """Sends as much of the queued replies as the socket takes now."""
+        try:
+            n = self.conn.send(self.outbox)
+        except BlockingIOError:
+            return
+        del self.outbox[:n]
+        self.update()
+
+# There is no queue here: an admitted client is served at once, so only
+# max_uploads applies and everyone past it gets "BUSY" like in the pool.
+def run_async_engine(s, max_uploads, retry_after, stats, grace, store=None, tuning=None, metrics=None, profiler=None,
+                     disk_writers=None, disk_policy=None):
+    # Each client needs a file descriptor; allow as many as the hard limit does.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+    sel = selectors.DefaultSelector()
+    s.setblocking(False)
+    sel.register(s, selectors.EVENT_READ, None) # data=None marks the listening socket
+
+    # Signals must not interrupt a client half way through feed(), so the
+    # handlers only take note and the wakeup socket makes select() return.
+    stop_requests = []
+    wakeup_r, wakeup_w = socket.socketpair()
+    wakeup_r.setblocking(False)
+    wakeup_w.setblocking(False)
+    signal.set_wakeup_fd(wakeup_w.fileno())
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop_requests.append(signum))
+    sel.register(wakeup_r, selectors.EVENT_READ, "wakeup")
+    deadline = None # set once we stop accepting
+    tuning = tuning or BufferTuning(sending=False)
+    recv_buffer = bytearray(tuning.initial_buffer_size()) # shared by all clients: we handle one at a time
+    recv_view = memoryview(recv_buffer)
+    untuned = set() # connections whose first file hasn't arrived yet
+    profiles = {}   # conn -> ConnectionProfile, when profiling
+    later = collections.deque() # (client, work) that writer threads hand back to the loop
+    print(f"Async engine: using {type(sel).__name__}")
+
+    def drop(client, hung_up=False):
+        client.hung_up = hung_up
+        client.parser.close()
+        client.close()
+        if not client.parser.closing:
+            retire(client)
+
+    def retire(client):
+        # Dropped, and every file it sent is closed: it no longer counts.
+        conn, parser = client.conn, client.parser
+        if client.hung_up:
+            print(f"Async: Finished with client {client.addr} ({parser.files} files)")
+        untuned.discard(conn)
+        profile = profiles.pop(conn, None)
+        if profile is not None:
+            profile.dump()
+        if parser.metrics is not None:
+            metrics.close(parser.metrics)
+        stats.finished()
+
+    def call_soon(client, work):
+        # On a writer thread: the loop does the work when it wakes.
+        later.append((client, work))
+        try:
+            wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass # the loop has a wakeup pending anyway
+
+    def run_later():
+        while later:
+            client, work = later.popleft()
+            try:
+                work()
+            except Exception as e:
+                if not client.closed: # a dropped client's file failing doesn't matter any more
+                    os.write(2, f"Async: dropping client {client.addr}: {e}\n".encode())
+                    drop(client)
+                    continue
+            if client.closed and not client.parser.closing:
+                retire(client)
+
+    def backpressure_for(client):
+        # A full disk queue: stop reading this client (TCP holds the sender
+        # back) while everybody else carries on.
+        def backpressure(queue):
+            if not client.paused:
+                client.paused = True
+                client.update()
+                queue.when_room(lambda: call_soon(client, client.resume))
+        return backpressure
+
+    while True:
+        if deadline is not None:
+            # Shutting down: done once every admitted client is (paused ones aren't in the selector).
+            if not stats.in_flight or time.monotonic() > deadline:
+                print(f"Async: stopped ({stats.in_flight} clients cut off)")
+                print(f"Main: {stats.report()}")
+                return
+        for key, events in sel.select(timeout=None if deadline is None else 0.5):
+            if key.data == "wakeup":
+                try:
+                    while wakeup_r.recv(512):
+                        pass
+                except BlockingIOError:
+                    pass
+                run_later()
+                if stop_requests and deadline is None:
+                    print("\nServer stopping...")
+                    sel.unregister(s)
+                    s.close()
+                    deadline = time.monotonic() + grace
+                continue
+            if key.data is None:
+                # Accept everybody who is waiting, not just one per wakeup.
+                while True:
+                    try:
+                        conn, addr = s.accept()
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError as e: # e.g. out of file descriptors
+                        print(f"Main: Error accepting connection: {e}")
+                        break
+                    conn.setblocking(False)
+                    if metrics is not None:
+                        metrics.accepted += 1
+                    if stats.in_flight >= max_uploads:
+                        stats.refused()
+                        if metrics is not None:
+                            metrics.rejected += 1
+                        reject_client(conn, retry_after)
+                        continue
+                    try:
+                        conn.send(STATUS_OK) # fits in any fresh socket's send buffer
+                    except OSError:
+                        conn.close()
+                        continue
+                    stats.admitted()
+                    stats.started(0.0) # no queue to wait in
+                    counted = metrics.connection(addr) if metrics is not None else None
+                    client = AsyncClient(sel, conn, addr)
+                    client.parser = parser = FrameParser(reply=client.reply, store=store, metrics=counted,
+                                                         disk_writers=disk_writers, disk_policy=disk_policy,
+                                                         backpressure=backpressure_for(client),
+                                                         defer=lambda work, client=client: call_soon(client, work))
+                    if profiler is not None:
+                        profiles[conn] = profile = profiler.connection(f"client {addr}")
+                        profile.instrument_parser(parser)
+                    if tuning.adaptive:
+                        untuned.add(conn)
+                continue
+
+            client = key.data
+            conn, addr, parser = client.conn, client.addr, client.parser
+            if events & selectors.EVENT_WRITE:
+                try:
+                    client.flush()
+                except OSError as e:
+                    os.write(2, f"Async: client {addr} failed: {e}\n".encode())
+                    drop(client)
+                    continue
+            if not events & selectors.EVENT_READ:
+                continue
+            try:
+                if parser.metrics is None:
+                    n = conn.recv_into(recv_buffer)
+                else:
+                    n = parser.metrics.network(conn.recv_into, recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError as e:
+                os.write(2, f"Async: client {addr} failed: {e}\n".encode())
+                drop(client)
+                continue
+            if n == 0: # client hung up: all of its files have been sent
+                drop(client, hung_up=True)
+                continue
+            profile = profiles.get(conn)
+            if profile is not None: # profiled only while it is this client's turn
+                profile.start()
+            try:
+                parser.feed(recv_view[:n])
+            except Exception as e:
+                # A bad header (or a disk error) only costs this one client.
+                os.write(2, f"Async: dropping client {addr}: {e}\n".encode())
+                drop(client)
+                continue
+            finally:
+                if profile is not None:
+                    profile.stop()
+            if conn in untuned and parser.files:
+                # The one receive buffer grows to suit the fastest link seen.
+                untuned.discard(conn)
+                size = tuning.tune(conn.fileno(), f"client {addr}")
+                if size and size > len(recv_buffer):
+                    recv_buffer = bytearray(size)
+                    recv_view = memoryview(recv_buffer)
+
+# --- Pre-fork Mode ---
+# Like fork-demo/helloServer.py, but the children are long-lived: N worker
+# processes each run a full server engine on the same listening socket (or,
+# with SO_REUSEPORT, on sockets of their own that the kernel balances
+# between).  Separate processes don't share one GIL, so CPU work in one
+# worker doesn't slow the others.  The parent only supervises.
+def run_prefork(workers, listener, make_listener, serve):
+    children = {}   # pid -> (slot, start time)
+    stopping = False
+
+    def spawn(slot):
+        sys.stdout.flush() # don't let the child inherit (and repeat) buffered output
+        pid = os.fork()
+        if pid == 0:
+            # child: Ctrl+C reaches the whole process group, but the parent
+            # decides when we stop and tells us with SIGTERM.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # forward() is the parent's; our engine reports for itself once
+            # it's up, and until then a SIGUSR1 mustn't kill us.
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            status = 0
+            try:
+                serve(listener if listener is not None else make_listener(), slot)
+            except Exception as e:
+                os.write(2, f"Worker {os.getpid()}: {e}\n".encode())
+                status = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(status)
+        children[pid] = (slot, time.monotonic())
+        print(f"Parent: started worker {slot} with pid = {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def forward(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, forward) # per-worker stats
+
+    for slot in range(workers):
+        spawn(slot)
+    # The parent just reaps (no WNOHANG needed: reaping is all it does).
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot, started = children.pop(pid)
+        if stopping:
+            print(f"Parent: worker {slot} (pid {pid}) exited")
+            continue
+        print(f"Parent: worker {slot} (pid {pid}) died with status {status}, restarting")
+        if time.monotonic() - started < 1:
+            time.sleep(1) # don't spin on a worker that dies right at startup
+        spawn(slot)
+    print("Parent: all workers stopped")
+
+def make_listener(listenAddr, listenPort, backlog, reuse_port, tuning=None):
+    """Creates, binds and starts the listening socket."""
+    # 1. Create the main "welcome desk" socket (IPv4, TCP)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if tuning is not None:
+        # A fixed --sockBuf: accepted sockets inherit it, window scale included.
+        tuning.prepare_socket(s.fileno())
+    # 2. Allow immediate reuse of the port if the server crashes and restarts.
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Several sockets (one per worker) may bind the same port.
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # 3. Bind our "welcome desk" to the specific port (e.g., 50001).
+    s.bind((listenAddr, listenPort))
+    # 4. Start listening. Allow up to 'backlog' clients to wait in line if we're busy.
+    s.listen(backlog)
+    return s
+
 # The main function is run by the primary (parent) thread.
 def main():
     # --- Block 2: Command-Line Argument Parsing ---
     # Define valid flags: -l for port (default 50001), -? for help.
     switchesVarDefaults = (
         (('-l', '--listenPort') ,'listenPort', 50001),
+        (('-e', '--engine'), 'engine', "threads"),   # "threads" or "async"
+        (('-b', '--backlog'), 'backlog', 128),       # pending connections the kernel may queue
+        (('-p', '--poolSize'), 'poolSize', 16),      # worker threads (threads engine)
+        (('-q', '--queueDepth'), 'queueDepth', 64),  # accepted clients that may wait for a worker (threads engine)
+        (('-m', '--maxUploads'), 'maxUploads', 80),  # clients admitted at once (working + waiting)
+        (('-r', '--retryAfter'), 'retryAfter', 2),   # seconds a rejected client is told to wait
+        (('--statsInterval',), 'statsInterval', 60), # seconds between counter reports
+        (('-w', '--workers'), 'workers', 1),         # worker processes (pre-fork mode when > 1)
+        (('--reusePort',), 'reusePort', False),      # one SO_REUSEPORT socket per worker
+        (('-g', '--grace'), 'grace', 30),            # seconds clients get to finish at shutdown
+        (('--dedupStore',), 'dedupStore', "none"),   # directory for deduplicated chunks ("none": no store)
+        (('--dedupMaxBytes',), 'dedupMaxBytes', 10 * 1024**3), # store size before old chunks are evicted
+        (('-B', '--bufferSize'), 'bufferSize', "auto"), # our receive buffers, in bytes (k/m suffix), or sized from the link
+        (('--sockBuf',), 'sockBuf', "auto"),         # SO_RCVBUF in bytes, or left to the kernel unless the link needs more
+        (('--metricsPort',), 'metricsPort', "none"), # HTTP port for Prometheus metrics (worker N: port + N)
+        (('--metricsAddr',), 'metricsAddr', "127.0.0.1"), # where the metrics port listens
+        (('--profile',), 'profile', os.environ.get("FT_PROFILE") or "none"), # stages,cprofile,tracemalloc or all
+        (('--writeBehind',), 'writeBehind', "none"), # bytes queued per device for the disk writers ("none": write inline)
+        (('--diskThreads',), 'diskThreads', 1),      # disk writer threads per device, with --writeBehind
+        (('--preallocate',), 'preallocate', "on"),   # reserve each file's full size before writing it ("off": grow as written)
+        (('--dropBehind',), 'dropBehind', "64m"),    # files this big are kept out of the page cache ("none": never)
+        (('--directIO',), 'directIO', "none"),       # files this big are written with O_DIRECT ("none": never)
         (('-?', '--usage'), "usage", False),
     )
     # Parse the arguments using the helper library.
     paramMap = params.parseParams(switchesVarDefaults)
     listenPort = int(paramMap["listenPort"])
+    engine = paramMap["engine"]
+    backlog = int(paramMap["backlog"])
+    pool_size = int(paramMap["poolSize"])
+    queue_depth = int(paramMap["queueDepth"])
+    max_uploads = int(paramMap["maxUploads"])
+    retry_after = int(paramMap["retryAfter"])
+    workers = int(paramMap["workers"])
+    reuse_port = paramMap["reusePort"]
+    grace = float(paramMap["grace"])
+    dedup_store = paramMap["dedupStore"]
+    dedup_max_bytes = int(paramMap["dedupMaxBytes"])
+    try:
+        tuning = BufferTuning(parse_size(paramMap["bufferSize"]), parse_size(paramMap["sockBuf"]), sending=False)
+    except ValueError as e:
+        print(f"Error: bad --bufferSize/--sockBuf ({e})")
+        sys.exit(1)
+    try:
+        profiler = Profiler.from_spec(paramMap["profile"])
+    except ValueError as e:
+        print(f"Error: bad --profile ({e})")
+        sys.exit(1)
+    try:
+        write_behind = None if paramMap["writeBehind"] == "none" else parse_size(paramMap["writeBehind"])
+        disk_threads = int(paramMap["diskThreads"])
+        if write_behind is None and paramMap["writeBehind"] != "none" or disk_threads < 1:
+            raise ValueError("give a size and at least one thread")
+    except ValueError as e:
+        print(f"Error: bad --writeBehind/--diskThreads ({e})")
+        sys.exit(1)
+    try:
+        if paramMap["preallocate"] not in ("on", "off"):
+            raise ValueError(f"--preallocate is on or off, not {paramMap['preallocate']}")
+        disk_policy = DiskPolicy(paramMap["preallocate"] == "on",
+                                 None if paramMap["dropBehind"] == "none" else parse_size(paramMap["dropBehind"]),
+                                 None if paramMap["directIO"] == "none" else parse_size(paramMap["directIO"]))
+    except ValueError as e:
+        print(f"Error: bad --preallocate/--dropBehind/--directIO ({e})")
+        sys.exit(1)
+    metrics_port = None if paramMap["metricsPort"] == "none" else int(paramMap["metricsPort"])
     listenAddr = '' # Listen on all available network interfaces (Wi-Fi, Ethernet, etc.)
 
     # If the user asked for help (-?), print usage and quit.
-    if paramMap["usage"]:
-        print("Usage: %s -l <listen_port>" % sys.argv[0])
+    if paramMap["usage"] or engine not in ("threads", "async"):
+        print("Usage: %s -l <listen_port> [--engine threads|async] [--backlog N]"
+              " [--poolSize N] [--queueDepth N] [--maxUploads N] [--retryAfter s] [--statsInterval s]"
+              " [--workers N] [--reusePort] [--grace s] [--dedupStore dir [--dedupMaxBytes N]]"
+              " [--bufferSize N|auto] [--sockBuf N|auto] [--metricsPort N [--metricsAddr addr]]"
+              " [--profile stages,cprofile,tracemalloc|all] [--writeBehind N [--diskThreads N]]"
+              " [--preallocate on|off] [--dropBehind N|none] [--directIO N|none]" % sys.argv[0])
         sys.exit(1)
 
     # --- Block 3: Server Setup (Listening Socket) ---
-    try:
-        # 1. Create the main "welcome desk" socket (IPv4, TCP)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # 2. Allow immediate reuse of the port if the server crashes and restarts.
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # 3. Bind our "welcome desk" to the specific port (e.g., 50001).
-        s.bind((listenAddr, listenPort))
-        # 4. Start listening. Allow up to 5 clients to wait in line if we're busy.
-        s.listen(5)
-        print(f"Threaded Server listening on port {listenPort}...")
-    except Exception as e:
-        print(f"Error setting up server socket: {e}")
-        sys.exit(1)
+    # With --reusePort each worker opens its own socket, so there is nothing
+    # to set up here; otherwise all workers share the one made now.
+    s = None
+    if workers == 1 or not reuse_port:
+        try:
+            s = make_listener(listenAddr, listenPort, backlog, reuse_port, tuning)
+        except Exception as e:
+            print(f"Error setting up server socket: {e}")
+            sys.exit(1)
+    print(f"{'Threaded' if engine == 'threads' else 'Async'} Server listening on port {listenPort}...")
+    print(tuning.describe())
+    print(disk_policy.describe())
+    if write_behind is not None:
+        print(f"Write-behind: {disk_threads} writer thread(s) per device, up to {write_behind} bytes queued per device")
 
     # --- Block 4: Main Server Loop ---
-    # Notice how much simpler this is than the forking version!
-    # No zombie reaping is needed because threads clean up after themselves.
-    while True:
-        try:
-            # 1. Wait for a new client.
-            # This is a BLOCKING call. The main thread sleeps here until a client connects.
-            # We don't need a timeout because we don't need to wake up to reap zombies.
-            conn, addr = s.accept()
-            print(f"Main: Accepted connection from {addr}")
+    def serve(s, slot=0):
+        # Each process reads the store's index for itself (after the fork).
+        store = ChunkStore(dedup_store, dedup_max_bytes) if dedup_store != "none" else None
+        # ...and counts for itself, on a metrics port of its own.
+        # Writer threads don't survive a fork, so each process starts its own.
+        disk_writers = DiskWriters(write_behind, disk_threads) if write_behind is not None else None
+        metrics = None
+        if metrics_port is not None:
+            metrics = Metrics(disk_writers)
+            serve_metrics(metrics, metrics_port + slot, paramMap["metricsAddr"])
+            print(f"Metrics (pid {os.getpid()}): http://{paramMap['metricsAddr']}:{metrics_port + slot}/metrics")
+        stats = ServerStats()
+        start_stats_reporter(stats, float(paramMap["statsInterval"]))
+        if engine == "async":
+            print(f"Main: at most {max_uploads} clients admitted (no queue: --queueDepth doesn't apply)")
+            run_async_engine(s, max_uploads, retry_after, stats, grace, store, tuning, metrics, profiler,
+                             disk_writers, disk_policy)
+            return
+        # The main thread only accepts; a fixed pool of worker threads does the
+        # receiving, so a burst of clients can't spawn unbounded threads.
+        signal.signal(signal.SIGTERM, raise_shutdown)
+        print(f"Main: {pool_size} workers, queue depth {queue_depth}, at most {max_uploads} clients admitted")
+        run_worker_pool(s, pool_size, queue_depth, max_uploads, retry_after, stats, grace, store, tuning, metrics,
+                        profiler, disk_writers, disk_policy)
 
-            # 2. Create a new Thread to handle this client.
-            # target=handle_client: Tells the thread what function to run.
-            # args=(conn, addr): Passes the connection socket and address to that function.
-            t = threading.Thread(target=handle_client, args=(conn, addr))
-            
-            # 3. Set the thread as a "daemon".
-            # This means if you kill the main server (Ctrl+C), these threads 
-            # will automatically die too, instead of keeping your terminal stuck.
-            t.daemon = True 
-            
-            # 4. Start the thread!
-            # The new thread immediately jumps to the 'handle_client' function,
-            # while this main thread immediately continues to the next line.
-            t.start()
-            
-            # The loop finishes and instantly goes back to the top to 's.accept()' 
-            # waiting for the next client, while the thread is busy working.
-
-        except KeyboardInterrupt:
-            # This handles Ctrl+C gracefully.
-            print("\nServer stopping...")
-            break
-        except Exception as e:
-            # Catch any other unexpected errors so the server doesn't crash.
-            print(f"Main: Error accepting connection: {e}")
+    if workers > 1:
+        run_prefork(workers, s, lambda: make_listener(listenAddr, listenPort, backlog, True, tuning), serve)
+    else:
+        serve(s)
 
 # --- Block 5: Main Execution Guard ---
 if __name__ == "__main__":
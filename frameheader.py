@@ -0,0 +1,465 @@
+#! /usr/bin/env python3
+
+"""
+Frame headers: the legacy, extended, batch and compact layouts a client
+puts in front of every payload, and the status and reply lines the server
+sends back.
+"""
+
+from compression import CODEC_NONE, codec_name, make_decompressor
+from checksum import CHECKSUM_NONE, CHECKSUM_PER_BLOCK, digest_size
+from chunkstore import MAX_RECIPE_CHUNKS
+from batch import MAX_BATCH_PAYLOAD
+
+# --- Extended headers ---
+# A legacy header is a 100-byte null padded filename followed by an 8-byte
+# length.  A filename can never start with 0xFE (it is not valid UTF-8), so
+# that byte marks an extended header of the same 108 bytes:
+#   1 byte   0xFE marker
+#   1 byte   version
+#   1 byte   flags
+#   97 bytes filename, null padded
+#   8 bytes  payload length
+# followed by the extra fields of every flag that is set, in flag order:
+#   FLAG_RANGE: 8-byte offset, 8-byte total file size, 8-byte transfer id
+#               (the payload is the bytes [offset, offset+length) of the file)
+#   FLAG_COMPRESSED: 1-byte codec (see compression.py); the payload is sent
+#               as length-prefixed compressed blocks, and the header's length
+#               is the uncompressed size
+#   FLAG_BLOCKS: no extra fields; with FLAG_COMPRESSED, every block was
+#               compressed on its own (decompress each one from scratch)
+#   FLAG_RESUME: no extra fields; with FLAG_RANGE, a resumable upload whose
+#               transfer id is the client's resume key (see resume.py).  Once
+#               the file is in place the server says "DONE <size>"; if it
+#               isn't, "OFFSET <n>" says how much of it the server has
+#   FLAG_QUERY: no extra fields and no payload; asks the server how much of
+#               a resumable upload it already has ("OFFSET <n>" comes back),
+#               or with FLAG_DELTA, for the signatures of its copy of the file
+#   FLAG_DELTA: 4-byte block size; the payload is a delta against the
+#               server's copy of the file (see delta.py), and the header's
+#               length is the size of the rebuilt file
+#   FLAG_DEDUP: 4-byte chunk count; the payload is the file's recipe, then
+#               (after the server's "NEED" reply) the chunks it asked for
+#               (see chunkstore.py); the header's length is the file size
+#   FLAG_CHECKSUM: 1-byte algorithm (see checksum.py, with CHECKSUM_PER_BLOCK
+#               set if there are block digests); the payload is followed by
+#               a trailer of digests, and a file that doesn't match them is
+#               reported back as "BAD <offset> <filename>"
+# 0xFD is not valid UTF-8 either; it marks a batch of small files (see batch.py):
+#   1 byte   0xFD marker
+#   4 bytes  number of files in the batch
+#   95 bytes zero
+#   8 bytes  payload length (all of the batch's entries)
+#
+# --- Compact headers (version 2) ---
+# A server that understands them says so in its status line ("OK v2"), and
+# the client then starts every frame with 0xFF (not valid UTF-8 either):
+#   1 byte   0xFF marker
+#   1 byte   version (2)
+#   varint   flags: the FLAG_* bits above, and FLAG_BATCH
+#   varint   filename length, then the filename (at most MAX_COMPACT_NAME bytes)
+#   varint   payload length
+#   varint   length of the fields that follow, then the fields (at most
+#            MAX_COMPACT_FIELDS bytes)
+# Varints are unsigned LEB128: 7 bits a byte, low bits first, high bit set
+# on every byte but the last.  Each field is a varint tag, a varint length
+# and that many bytes, here always one varint value.  A receiver skips tags
+# it doesn't know, so new optional fields (like mode and mtime) need no
+# flag day; a flag it doesn't know changes what the payload means, so that
+# frame is refused.  A 20-byte name with mode and mtime takes 43 bytes, not 108.
+EXTENDED_MARKER = 0xFE
+BATCH_MARKER = 0xFD
+COMPACT_MARKER = 0xFF
+COMPACT_VERSION = 2
+MAX_COMPACT_NAME = 4096     # PATH_MAX: a longer name couldn't be created anyway
+MAX_COMPACT_FIELDS = 4096   # far more than every known field takes
+EXTENDED_VERSION = 1
+FLAG_RANGE = 0x01
+FLAG_COMPRESSED = 0x02
+FLAG_BLOCKS = 0x04
+FLAG_RESUME = 0x08
+FLAG_QUERY = 0x10
+FLAG_DELTA = 0x20
+FLAG_DEDUP = 0x40
+FLAG_CHECKSUM = 0x80
+FLAG_BATCH = 0x100      # compact headers only: a batch of small files (see batch.py)
+KNOWN_FLAGS = 0x1FF
+# Compact header field tags
+TAG_OFFSET = 1
+TAG_TOTAL_SIZE = 2
+TAG_TRANSFER_ID = 3
+TAG_CODEC = 4
+TAG_BLOCK_SIZE = 5
+TAG_CHUNK_COUNT = 6
+TAG_CHECKSUM = 7
+TAG_BATCH_COUNT = 8
+TAG_MODE = 9            # permission bits for the new file
+TAG_MTIME = 10          # modification time for the new file, in nanoseconds
+COMPACT_PEEK = 512      # bytes looked at ahead to find a compact header's length in one go
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def decode_varint(data, i):
+    """Reads the varint at data[i]. Returns (value, index after it), or (None, i) if it doesn't all fit."""
+    if i < len(data) and data[i] < 0x80:
+        return data[i], i + 1 # most are a single byte
+    value = shift = 0
+    for j in range(i, min(len(data), i + 10)):
+        value |= (data[j] & 0x7F) << shift
+        if not data[j] & 0x80:
+            return value, j + 1
+        shift += 7
+    if len(data) >= i + 10:
+        raise ValueError("varint too long")
+    return None, i
+
+def compact_header_size(data):
+    """How long the compact header starting data is, once enough of it is there to tell.
+
+    While it isn't, returns more than len(data): read up to that and ask again.
+    Raises ValueError for a name or fields longer than we accept, before
+    anybody allocates room for them.
+    """
+    if len(data) < 2:
+        return 2
+    i = 2
+    for limit in (None, MAX_COMPACT_NAME, None, MAX_COMPACT_FIELDS): # flags, name, payload length, fields
+        value, i = decode_varint(data, i)
+        if value is None:
+            return len(data) + 1
+        if limit is not None:
+            if value > limit:
+                raise ValueError(f"compact header field of {value} bytes (at most {limit})")
+            i += value
+            if i > len(data):
+                return i
+    return i
+
+class FrameHeader:
+    """Everything a frame header says about the payload that follows it."""
+    def __init__(self, filename, data_length, offset=0, total_size=None, transfer_id=0):
+        self.filename = filename
+        self.data_length = data_length
+        # Only set for a range (stripe) of a larger file
+        self.offset = offset
+        self.total_size = total_size
+        self.transfer_id = transfer_id
+        # How the payload is compressed (CODEC_NONE: raw bytes), and whether
+        # its blocks were compressed independently
+        self.codec = CODEC_NONE
+        self.independent_blocks = False
+        # Resumable upload (a range into the client's .part file), or just a
+        # question about one
+        self.resumable = False
+        self.query = False
+        # A delta against the server's copy, in blocks of this size
+        self.delta = False
+        self.block_size = 0
+        # Deduplicated upload: a recipe of this many chunks comes first
+        self.dedup = False
+        self.chunk_count = 0
+        # Digests of the payload follow it in a trailer
+        self.checksum = CHECKSUM_NONE
+        self.checksum_blocks = False
+        # A batch frame: this many small files, each with its own name, in the payload
+        self.batch_count = 0
+        # Permission bits and mtime (ns) for the new file (None: the server's defaults)
+        self.mode = None
+        self.mtime_ns = None
+        # Flags as read off the wire (set by decode())
+        self.wire_flags = 0
+
+    def flags(self):
+        flags = 0
+        if self.total_size is not None:
+            flags |= FLAG_RANGE
+        if self.codec != CODEC_NONE:
+            flags |= FLAG_COMPRESSED
+            if self.independent_blocks:
+                flags |= FLAG_BLOCKS
+        if self.resumable:
+            flags |= FLAG_RESUME
+        if self.query:
+            flags |= FLAG_QUERY
+        if self.delta:
+            flags |= FLAG_DELTA
+        if self.dedup:
+            flags |= FLAG_DEDUP
+        if self.checksum != CHECKSUM_NONE:
+            flags |= FLAG_CHECKSUM
+        if self.batch_count:
+            flags |= FLAG_BATCH
+        return flags
+
+    def encode(self, version=1):
+        """Builds the header bytes: compact ones for version 2, otherwise the legacy
+        layout whenever it is enough."""
+        if version >= COMPACT_VERSION:
+            return self.encode_compact()
+        # 1. Convert filename string to bytes.
+        filename_bytes = self.filename.encode()
+        # 2. Convert the integer data length into an 8-byte sequence using big-endian byte order.
+        length_bytes = self.data_length.to_bytes(8, 'big')
+        if self.batch_count:
+            return (bytes([BATCH_MARKER]) + self.batch_count.to_bytes(4, 'big')).ljust(100, b'\0') + length_bytes
+        flags = self.flags()
+        if not flags:
+            if len(filename_bytes) > 100:
+                raise ValueError(f"filename too long for a legacy header: {self.filename}")
+            # 3. Pad the filename with null bytes until it is exactly 100 bytes
+            #    long and combine them to create the 108-byte header.
+            return filename_bytes.ljust(100, b'\0') + length_bytes
+        if len(filename_bytes) > 97:
+            raise ValueError(f"filename too long for an extended header: {self.filename}")
+        header = bytes([EXTENDED_MARKER, EXTENDED_VERSION, flags]) + filename_bytes.ljust(97, b'\0') + length_bytes
+        if flags & FLAG_RANGE:
+            header += self.offset.to_bytes(8, 'big') + self.total_size.to_bytes(8, 'big') + self.transfer_id.to_bytes(8, 'big')
+        if flags & FLAG_COMPRESSED:
+            header += bytes([self.codec])
+        if flags & FLAG_DELTA:
+            header += self.block_size.to_bytes(4, 'big')
+        if flags & FLAG_DEDUP:
+            header += self.chunk_count.to_bytes(4, 'big')
+        if flags & FLAG_CHECKSUM:
+            header += bytes([self.checksum | (CHECKSUM_PER_BLOCK if self.checksum_blocks else 0)])
+        return header
+
+    def encode_compact(self):
+        """Builds a compact (version 2) header."""
+        flags = self.flags()
+        fields = []
+        if flags & FLAG_RANGE:
+            fields += [(TAG_OFFSET, self.offset), (TAG_TOTAL_SIZE, self.total_size), (TAG_TRANSFER_ID, self.transfer_id)]
+        if flags & FLAG_COMPRESSED:
+            fields.append((TAG_CODEC, self.codec))
+        if flags & FLAG_DELTA:
+            fields.append((TAG_BLOCK_SIZE, self.block_size))
+        if flags & FLAG_DEDUP:
+            fields.append((TAG_CHUNK_COUNT, self.chunk_count))
+        if flags & FLAG_CHECKSUM:
+            fields.append((TAG_CHECKSUM, self.checksum | (CHECKSUM_PER_BLOCK if self.checksum_blocks else 0)))
+        if flags & FLAG_BATCH:
+            fields.append((TAG_BATCH_COUNT, self.batch_count))
+        if self.mode is not None:
+            fields.append((TAG_MODE, self.mode))
+        if self.mtime_ns is not None:
+            fields.append((TAG_MTIME, self.mtime_ns))
+        field_bytes = bytearray()
+        for tag, value in fields:
+            value_bytes = encode_varint(value)
+            field_bytes += encode_varint(tag) + encode_varint(len(value_bytes)) + value_bytes
+        filename_bytes = self.filename.encode()
+        return b"".join((bytes([COMPACT_MARKER, COMPACT_VERSION]), encode_varint(flags),
+                         encode_varint(len(filename_bytes)), filename_bytes, encode_varint(self.data_length),
+                         encode_varint(len(field_bytes)), field_bytes))
+
+    @staticmethod
+    def decode_compact(header):
+        """Unpacks a whole compact header (compact_header_size() says how long it is)."""
+        if header[1] != COMPACT_VERSION:
+            raise ValueError(f"unsupported compact header version {header[1]}")
+        flags, i = decode_varint(header, 2)
+        if flags & ~KNOWN_FLAGS:
+            raise ValueError(f"unknown header flags {flags & ~KNOWN_FLAGS:#x}")
+        name_length, i = decode_varint(header, i)
+        filename = bytes(header[i:i + name_length]).decode()
+        data_length, i = decode_varint(header, i + name_length)
+        fields_length, i = decode_varint(header, i)
+        frame = FrameHeader(filename, data_length)
+        frame.wire_flags = flags
+        end = i + fields_length
+        while i < end:
+            tag, i = decode_varint(header, i)
+            length, i = decode_varint(header, i)
+            if tag is None or length is None or i + length > end:
+                raise ValueError("header fields run past their end")
+            value_bytes = header[i:i + length]
+            i += length
+            if not TAG_OFFSET <= tag <= TAG_MTIME:
+                continue # an optional field from a newer client
+            value = decode_varint(value_bytes, 0)[0]
+            if value is None:
+                raise ValueError(f"bad value for header field {tag}")
+            if tag == TAG_OFFSET:
+                frame.offset = value
+            elif tag == TAG_TOTAL_SIZE:
+                frame.total_size = value
+            elif tag == TAG_TRANSFER_ID:
+                frame.transfer_id = value
+            elif tag == TAG_CODEC:
+                frame.codec = value
+            elif tag == TAG_BLOCK_SIZE:
+                frame.block_size = value
+            elif tag == TAG_CHUNK_COUNT:
+                frame.chunk_count = value
+            elif tag == TAG_CHECKSUM:
+                frame.checksum = value & ~CHECKSUM_PER_BLOCK
+                frame.checksum_blocks = bool(value & CHECKSUM_PER_BLOCK)
+            elif tag == TAG_BATCH_COUNT:
+                frame.batch_count = value
+            elif tag == TAG_MODE:
+                frame.mode = value & 0o777 # no setuid, setgid or sticky files from a client
+            else: # TAG_MTIME
+                frame.mtime_ns = value
+        if flags & FLAG_RANGE and frame.total_size is None:
+            raise ValueError("range frame without a total size")
+        if not flags & FLAG_RANGE:
+            frame.offset, frame.total_size, frame.transfer_id = 0, None, 0
+        if not flags & FLAG_COMPRESSED:
+            frame.codec = CODEC_NONE
+        if not flags & FLAG_CHECKSUM:
+            frame.checksum = CHECKSUM_NONE
+        frame._check_flags()
+        return frame
+
+    @staticmethod
+    def decode(header):
+        """Unpacks the fixed 108 bytes. Returns (frame, extra): extra is how many
+        bytes of extension fields follow, to be given to decode_extra()."""
+        # --- Unpack the Header ---
+        # 1. The last 8 bytes are the data length.
+        data_length = int.from_bytes(header[100:108], 'big')
+        if header[0] == BATCH_MARKER:
+            frame = FrameHeader("", data_length)
+            frame.batch_count = int.from_bytes(header[1:5], 'big')
+            if not frame.batch_count or not 0 < data_length <= MAX_BATCH_PAYLOAD:
+                raise ValueError(f"bad batch of {frame.batch_count} files in {data_length} bytes")
+            return frame, 0
+        if header[0] != EXTENDED_MARKER:
+            # 2. The first 100 bytes are the padded filename.
+            # Remove the null-byte padding and decode to get the original filename string.
+            return FrameHeader(bytes(header[:100]).strip(b'\0').decode(), data_length), 0
+
+        # An extended header: version and flags, then a shorter filename field.
+        version, flags = header[1], header[2]
+        if version != EXTENDED_VERSION:
+            raise ValueError(f"unsupported extended header version {version}")
+        frame = FrameHeader(bytes(header[3:100]).strip(b'\0').decode(), data_length)
+        frame.wire_flags = flags
+        extra = 0
+        if flags & FLAG_RANGE:
+            extra += 24
+        if flags & FLAG_COMPRESSED:
+            extra += 1
+        if flags & FLAG_DELTA:
+            extra += 4
+        if flags & FLAG_DEDUP:
+            extra += 4
+        if flags & FLAG_CHECKSUM:
+            extra += 1
+        return frame, extra
+
+    def decode_extra(self, extra):
+        """Fills in the extension fields that followed the fixed header."""
+        flags = self.wire_flags
+        i = 0
+        if flags & FLAG_RANGE:
+            self.offset = int.from_bytes(extra[i:i+8], 'big')
+            self.total_size = int.from_bytes(extra[i+8:i+16], 'big')
+            self.transfer_id = int.from_bytes(extra[i+16:i+24], 'big')
+            i += 24
+        if flags & FLAG_COMPRESSED:
+            self.codec = extra[i]
+            i += 1
+        if flags & FLAG_DELTA:
+            self.block_size = int.from_bytes(extra[i:i+4], 'big')
+            i += 4
+        if flags & FLAG_DEDUP:
+            self.chunk_count = int.from_bytes(extra[i:i+4], 'big')
+            i += 4
+        if flags & FLAG_CHECKSUM:
+            self.checksum = extra[i] & ~CHECKSUM_PER_BLOCK
+            self.checksum_blocks = bool(extra[i] & CHECKSUM_PER_BLOCK)
+            i += 1
+        self._check_flags()
+
+    def _check_flags(self):
+        """Checks that the flags off the wire make sense together, and sets the ones that are plain booleans."""
+        flags = self.wire_flags
+        if flags & FLAG_COMPRESSED:
+            make_decompressor(self.codec) # rejects codecs we don't know
+            self.independent_blocks = bool(flags & FLAG_BLOCKS)
+        if flags & FLAG_DELTA:
+            if flags & (FLAG_RANGE | FLAG_COMPRESSED | FLAG_CHECKSUM):
+                raise ValueError("delta frames are sent whole, uncompressed and unchecksummed")
+        elif flags & (FLAG_RESUME | FLAG_QUERY) and not flags & FLAG_RANGE:
+            raise ValueError("resumable frames need a range")
+        if flags & FLAG_DEDUP:
+            if flags != FLAG_DEDUP:
+                raise ValueError("deduplicated frames take no other flags")
+            if self.chunk_count > MAX_RECIPE_CHUNKS:
+                raise ValueError(f"recipe of {self.chunk_count} chunks is too long")
+        if flags & FLAG_CHECKSUM:
+            digest_size(self.checksum) # rejects algorithms we don't know
+        if flags & FLAG_BATCH:
+            if flags != FLAG_BATCH:
+                raise ValueError("batch frames take no other flags")
+            if not self.batch_count or not 0 < self.data_length <= MAX_BATCH_PAYLOAD:
+                raise ValueError(f"bad batch of {self.batch_count} files in {self.data_length} bytes")
+        else:
+            self.batch_count = 0
+        self.resumable = bool(flags & FLAG_RESUME)
+        self.query = bool(flags & FLAG_QUERY)
+        self.delta = bool(flags & FLAG_DELTA)
+        self.dedup = bool(flags & FLAG_DEDUP)
+
+    def describe(self):
+        if self.batch_count:
+            return f"batch of {self.batch_count} files ({self.data_length} bytes)"
+        if self.dedup:
+            return f"{self.filename} ({self.data_length} bytes, {self.chunk_count} chunks)"
+        if self.delta:
+            return f"{self.filename} ({self.data_length} bytes, delta)"
+        if self.resumable and self.total_size is not None:
+            return f"{self.filename} (resumable, bytes {self.offset}-{self.offset + self.data_length} of {self.total_size})"
+        compressed = f", {codec_name(self.codec)}" if self.codec != CODEC_NONE else ""
+        if self.total_size is None:
+            return f"{self.filename} ({self.data_length} bytes{compressed})"
+        return f"{self.filename} (bytes {self.offset}-{self.offset + self.data_length} of {self.total_size}{compressed})"
+
+# --- Connection status line ---
+# Once a server is ready to take a client's files it sends one line back:
+# "OK\n", followed by the header versions it reads beyond the legacy and
+# extended ones ("OK v2\n").  A server that is over its admission limits sends
+# "BUSY <seconds>\n" instead and hangs up; the client should retry later.
+STATUS_OK = b"OK v2\n"     # "v2": we read compact headers
+
+def busy_status(retry_after):
+    return f"BUSY {retry_after}\n".encode()
+
+class ServerBusy(Exception):
+    """The server asked us to come back in 'retry_after' seconds."""
+    def __init__(self, retry_after):
+        super().__init__(f"server busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+def read_reply(reader):
+    """Reads one line the server sent us, split into words ([] on EOF)."""
+    line = bytearray()
+    while not line.endswith(b"\n") and len(line) < 256:
+        byte = reader.read(1)
+        if not byte:
+            return []
+        line += byte
+    return line.decode(errors="replace").split()
+
+def read_status(reader):
+    """Reads the server's status line.
+
+    Returns ("OK", header version), ("BUSY", seconds) or (None, None) on EOF.
+    The header version is the newest the server reads: 2 if it said "OK v2",
+    1 (legacy and extended headers only) for a plain "OK".
+    """
+    words = read_reply(reader)
+    if words and words[0] == "BUSY":
+        return "BUSY", float(words[1]) if len(words) > 1 else 1.0
+    if words and words[0] == "OK":
+        versions = [int(word[1:]) for word in words[1:] if word[:1] == "v" and word[1:].isdigit()]
+        return "OK", max(versions, default=1)
+    return (words[0] if words else None), None
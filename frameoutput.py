@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+
+"""
+Where received payloads go on the server: the output files (whole, striped,
+O_DIRECT), finishing stripes, and the answers to queries about what we
+already have (resume offsets and delta signatures).
+"""
+
+import os
+import fcntl
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+from compression import CODEC_NONE
+from resume import PartialFile, UploadInProgress
+from checksum import CHECKSUM_NONE
+from delta import DeltaFile, signature_reply
+from diskio import DIRECT_BUFFER_SIZE, set_direct
+from batch import is_relative_path, make_parent_dirs
+from frameheader import busy_status
+
+def write_all(fd, data, position=None):
+    """Writes all of data to fd (at position, if given), looping over short writes."""
+    view = memoryview(data)
+    while view:
+        if position is None:
+            bytes_written = os.write(fd, view)
+        else:
+            bytes_written = os.pwrite(fd, view, position)
+            position += bytes_written
+        view = view[bytes_written:]
+
+SIGNATURE_THREADS = 4   # signature queries answered at once off an event loop
+_signature_pool = None  # made on first use
+
+def answer_query(header, reply, defer=None):
+    """Tells a client how much of its resumable upload we already have, or sends block signatures.
+
+    Signatures mean reading the whole file.  Given defer (an event loop's,
+    see FrameParser) that happens on a pool thread and defer() sends them.
+    """
+    global _signature_pool
+    if header.delta and defer is None:
+        reply(_signatures(header))
+        return
+    if header.delta:
+        if _signature_pool is None:
+            _signature_pool = ThreadPoolExecutor(max_workers=SIGNATURE_THREADS, thread_name_prefix="signatures")
+        def work():
+            signatures = _signatures(header)
+            defer(lambda: reply(signatures))
+        _signature_pool.submit(work)
+        return
+    try:
+        offset = PartialFile(header.filename, header.transfer_id, header.total_size).resume_offset()
+    except UploadInProgress:
+        # An older connection for this upload hasn't noticed it's dead yet.
+        reply(busy_status(1))
+        return
+    os.write(2, f"Resume query: {header.filename} has {offset} of {header.total_size} bytes\n".encode())
+    reply(f"OFFSET {offset}\n".encode())
+
+def _signatures(header):
+    """The reply to a signature query: only files below our directory, where uploads go, are described."""
+    if not is_relative_path(header.filename):
+        return b"SIGS 0 0\n"
+    try:
+        return signature_reply(header.filename)
+    except OSError: # gone or unreadable half way: as if we had no copy
+        return b"SIGS 0 0\n"
+
+def confirm_resumable(header, complete, reply):
+    """Tells a client whether its resumable upload is in place ("DONE") or how much of it we have."""
+    if reply is None:
+        return
+    if complete:
+        reply(f"DONE {header.total_size}\n".encode())
+        return
+    try:
+        offset = PartialFile(header.filename, header.transfer_id, header.total_size).resume_offset()
+    except UploadInProgress:
+        offset = 0
+    reply(f"OFFSET {offset}\n".encode())
+
+def stripe_path(header):
+    """The temporary file the stripes of a range transfer are assembled in."""
+    return f"{header.filename}.stripes-{header.transfer_id:016x}"
+
+class OutputFile:
+    """Where a payload goes: an open file, and the offset to write at (None: just append).
+
+    With a temp_path the file is written there and only renamed to its real
+    name once it is complete.
+    """
+    # Whether splice() may move bytes straight into fd behind our back
+    zero_copy_ok = True
+
+    def __init__(self, header, fd, position=None, temp_path=None):
+        self.header = header
+        self.fd = fd
+        self.position = position
+        self.temp_path = temp_path
+        self.written = 0
+        self.preallocated = False # the whole file was reserved up front (see diskio.py)
+        self.cache = None         # DropBehind, for a file too big to keep in the page cache
+
+    def write(self, data):
+        write_all(self.fd, data, self.position)
+        self.advance(len(data))
+
+    def advance(self, n):
+        """Accounts for n bytes that reached the file some other way (splice)."""
+        if self.position is not None:
+            self.position += n
+        self.written += n
+        if self.cache is not None:
+            self.cache.wrote(self.written if self.position is None else self.position)
+
+    def close(self, complete):
+        if self.cache is not None:
+            self.cache.done(self.written if self.position is None else self.position)
+        if self.preallocated and not complete:
+            os.ftruncate(self.fd, self.written) # not the full size we reserved: only what arrived
+        if complete and self.header.total_size is None:
+            # The sender's permissions and mtime, if its header had them.
+            if self.header.mode is not None:
+                os.fchmod(self.fd, self.header.mode)
+            if self.header.mtime_ns is not None:
+                os.utime(self.fd, ns=(self.header.mtime_ns, self.header.mtime_ns))
+        # Close the new file that we just created.
+        os.close(self.fd)
+        if self.temp_path is not None:
+            if complete:
+                os.rename(self.temp_path, self.header.filename)
+            else:
+                os.unlink(self.temp_path)
+        elif complete and self.header.total_size is not None:
+            finish_range(self.header)
+
+class DirectOutputFile(OutputFile):
+    """A whole file written with O_DIRECT, through a page-aligned buffer (see diskio.py)."""
+    # O_DIRECT wants aligned buffers; splice() would hand it pipe pages
+    zero_copy_ok = False
+
+    def __init__(self, header, fd, temp_path=None):
+        super().__init__(header, fd, temp_path=temp_path)
+        self.buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE) # anonymous mappings start on a page
+        self.view = memoryview(self.buffer)
+        self.filled = 0   # bytes waiting in the buffer
+        self.flushed = 0  # bytes already in the file
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            n = min(len(view), DIRECT_BUFFER_SIZE - self.filled)
+            self.view[self.filled:self.filled + n] = view[:n]
+            self.filled += n
+            view = view[n:]
+            if self.filled == DIRECT_BUFFER_SIZE:
+                self._write_buffer()
+        self.advance(len(data))
+
+    def _write_buffer(self):
+        write_all(self.fd, self.view[:self.filled], self.flushed)
+        self.flushed += self.filled
+        self.filled = 0
+
+    def close(self, complete):
+        if self.filled:
+            # The tail needn't be a whole number of blocks: it goes through the page cache.
+            set_direct(self.fd, False)
+            self._write_buffer()
+        self.view.release()
+        self.buffer.close()
+        super().close(complete)
+
+def _prepare(output, policy, offset, length, header):
+    """Has the DiskPolicy reserve and advise [offset, offset + length) of output's file; closes it if that fails.
+
+    Only a plain payload is reserved: a compressed or delta one's size isn't
+    backed by as many bytes on the wire.
+    """
+    if policy is None:
+        return False
+    plain = header.codec == CODEC_NONE and not header.delta
+    try:
+        return policy.prepare(output.fd, offset, length, preallocate=plain)
+    except BaseException:
+        output.close(False)
+        raise
+
+def _whole_file(header, fd, policy, temp_path=None):
+    """The OutputFile (or DirectOutputFile) for a whole file, newly opened as fd."""
+    if policy is not None and policy.use_direct(header.data_length) and set_direct(fd):
+        output = DirectOutputFile(header, fd, temp_path)
+    else:
+        output = OutputFile(header, fd, temp_path=temp_path)
+        if policy is not None:
+            output.cache = policy.drop_behind_for(fd, 0, header.data_length)
+    output.preallocated = _prepare(output, policy, 0, header.data_length, header)
+    return output
+
+def open_output(header, made_dirs=None, policy=None):
+    """Opens the file a payload goes to, returning an OutputFile (or PartialFile, or DeltaFile).
+
+    Recursive uploads name files by their path under the directory sent, so
+    the directories in a relative filename are created first (once each,
+    given the connection's made_dirs).  A DiskPolicy (diskio.py) decides on
+    preallocation, page cache advice and O_DIRECT.
+    """
+    if is_relative_path(header.filename):
+        make_parent_dirs(header.filename, set() if made_dirs is None else made_dirs)
+    if header.delta:
+        if not is_relative_path(header.filename):
+            raise ValueError(f"delta against {header.filename}: only files below our directory have a basis")
+        output = DeltaFile(header.filename, header.block_size, header.data_length)
+        _prepare(output, policy, 0, header.data_length, header)
+        return output
+    if header.resumable:
+        output = PartialFile(header.filename, header.transfer_id, header.total_size)
+        output.open(header.offset)
+        output.preallocated = _prepare(output, policy, header.offset, header.total_size - header.offset, header)
+        return output
+    if header.total_size is None and header.checksum != CHECKSUM_NONE:
+        # Kept out of the way until its checksum says it arrived intact.
+        temp_path = f"{header.filename}.incoming-{os.urandom(8).hex()}"
+        return _whole_file(header, os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), policy, temp_path)
+    if header.total_size is None:
+        return _whole_file(header, os.open(header.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC), policy)
+    # Every stripe of a transfer writes into one shared temporary file at
+    # its own offset; no O_TRUNC, since other stripes may already be in it.
+    output_fd = os.open(stripe_path(header), os.O_WRONLY | os.O_CREAT, 0o644)
+    if os.fstat(output_fd).st_size < header.total_size:
+        os.ftruncate(output_fd, header.total_size)
+    output = OutputFile(header, output_fd, header.offset)
+    # The file already has its full size; this lays out the blocks of our stripe.
+    _prepare(output, policy, header.offset, header.data_length, header)
+    if policy is not None:
+        output.cache = policy.drop_behind_for(output_fd, header.offset, header.data_length)
+    return output
+
+def reject_payload(header, output, bad_offset, reply):
+    """Reports a payload that doesn't match its checksums; a resumable upload forgets the bad part."""
+    offset = header.offset + bad_offset
+    os.write(2, f"Checksum mismatch: {header.filename} from byte {offset}\n".encode())
+    if header.resumable:
+        output.forget_from(offset)
+    if reply is not None:
+        reply(f"BAD {offset} {header.filename}\n".encode())
+
+def finish_range(header):
+    """Records a completed stripe; the one that completes the file renames it into place."""
+    temp_path = stripe_path(header)
+    # The ledger lists (offset, length) of each stripe that arrived.  Stripes
+    # of one transfer may land on different connections (or processes), so
+    # it is updated under an exclusive lock.
+    ledger_fd = os.open(temp_path + ".ledger", os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        fcntl.flock(ledger_fd, fcntl.LOCK_EX)
+        write_all(ledger_fd, header.offset.to_bytes(8, 'big') + header.data_length.to_bytes(8, 'big'))
+        records = os.pread(ledger_fd, os.fstat(ledger_fd).st_size, 0)
+        stripes = {}
+        for i in range(0, len(records) - 15, 16):
+            stripes[int.from_bytes(records[i:i+8], 'big')] = int.from_bytes(records[i+8:i+16], 'big')
+        if sum(stripes.values()) >= header.total_size and os.path.exists(temp_path):
+            # All stripes are in: publish the file in one atomic rename.
+            os.rename(temp_path, header.filename)
+            os.unlink(temp_path + ".ledger")
+            os.write(2, f"Assembled: {header.filename} ({header.total_size} bytes, {len(stripes)} stripes)\n".encode())
+    finally:
+        os.close(ledger_fd) # also drops the lock
@@ -0,0 +1,253 @@
+#! /usr/bin/env python3
+
+"""
+The async engine's receiver: FramedReader's work, driven by whatever bytes
+the event loop hands it.
+"""
+
+import os
+from compression import CODEC_NONE, make_decompressor, parse_block_prefix, inflate
+from checksum import CHECKSUM_NONE, StreamChecksum, ChecksummedOutput, trailer_size
+from chunkstore import RECIPE_ENTRY_SIZE, DedupFile
+from delta import DELTA_COPY, DELTA_END, OP_SIZE, parse_op
+from batch import is_relative_path, make_parent_dirs, write_batch
+from frameheader import COMPACT_MARKER, COMPACT_PEEK, FrameHeader, compact_header_size
+from frameoutput import answer_query, confirm_resumable, open_output, reject_payload
+
+class FrameParser:
+    """A non-blocking FramedReader for event loops.
+
+    Instead of pulling bytes from a reader it is pushed whatever arrived with
+    feed(), and it never waits for more: a header split across two recv()s is
+    kept until the rest shows up, and payload bytes go to disk as they come.
+    """
+    # What the bytes we are waiting for are
+    HEADER, EXTRA, PAYLOAD, BLOCK_PREFIX, BLOCK, DELTA_OP, LITERAL, RECIPE, CHUNK, TRAILER, BATCH, COMPACT = range(12)
+
+    def __init__(self, reply=None, store=None, metrics=None, disk_writers=None, disk_policy=None, backpressure=None,
+                 defer=None):
+        self.reply = reply         # sends a line back to the client (for queries and recipes)
+        self.store = store         # where deduplicated uploads keep their chunks
+        self.metrics = metrics     # this connection's ConnectionMetrics (None: not counting)
+        self.disk_writers = disk_writers # write-behind pool (None: payloads are written here)
+        self.disk_policy = disk_policy   # preallocation, page cache advice and O_DIRECT (None: none of it)
+        self.backpressure = backpressure # told when a write-behind queue is full (None: wait for room)
+        self.defer = defer         # runs a function on our thread later, given from a writer thread (None: files
+                                   # written behind are closed here, waiting for their writes)
+        self.closing = 0           # files a writer thread is closing for us
+        self.state = self.HEADER
+        self.pending = bytearray() # header (or compressed block) bytes collected so far
+        self.need = 1              # bytes wanted before the current piece is complete (1: which kind of header)
+        self.frame = None          # header of the file being received
+        self.output = None         # OutputFile receiving the current payload
+        self.bytes_remaining = 0   # raw payload (or delta literal) bytes still to come
+        self.decompressor = None
+        self.received = 0          # uncompressed bytes written for a compressed payload
+        self.sums = None           # checksums of the payload, if it has a trailer
+        self.files = 0             # files completed on this connection
+        self.made_dirs = set()     # directories already created for them
+
+    def feed(self, data):
+        """Consumes every byte of data (a bytes-like object)."""
+        data = memoryview(data)
+        while data:
+            if self.state == self.PAYLOAD or self.state == self.LITERAL:
+                # --- Raw payload: straight from the receive buffer to the file ---
+                n = min(len(data), self.bytes_remaining)
+                self._write(data[:n])
+                self.bytes_remaining -= n
+                data = data[n:]
+                if self.bytes_remaining:
+                    continue
+                if self.state == self.LITERAL:
+                    self.state, self.need = self.DELTA_OP, OP_SIZE
+                else:
+                    self._payload_done()
+                continue
+
+            # --- Everything else: collect until we have all of it ---
+            n = min(len(data), self.need - len(self.pending))
+            self.pending += data[:n]
+            data = data[n:]
+            if len(self.pending) < self.need:
+                break
+            piece = bytes(self.pending)
+            self.pending.clear()
+            if self.state == self.HEADER and len(piece) == 1 and piece[0] == COMPACT_MARKER:
+                # Look into what else arrived for the header's length.
+                self.state = self.COMPACT
+                self.pending += piece
+                self.need = compact_header_size(piece + bytes(data[:COMPACT_PEEK]))
+            elif self.state == self.HEADER and len(piece) == 1:
+                self.pending += piece # the rest of a fixed-size header
+                self.need = 108
+            elif self.state == self.COMPACT:
+                size = compact_header_size(piece)
+                if size > len(piece): # not all of it yet; now we know more of its length
+                    self.pending += piece
+                    self.need = compact_header_size(piece + bytes(data[:COMPACT_PEEK]))
+                    continue
+                self.frame = FrameHeader.decode_compact(piece)
+                self._start_file()
+            elif self.state == self.HEADER:
+                self.frame, extra = FrameHeader.decode(piece)
+                if extra:
+                    self.state, self.need = self.EXTRA, extra # extension fields come next
+                    continue
+                self._start_file()
+            elif self.state == self.EXTRA:
+                self.frame.decode_extra(piece)
+                self._start_file()
+            elif self.state == self.TRAILER:
+                bad_offset = self.sums.verify(piece)
+                if bad_offset is not None:
+                    reject_payload(self.frame, self.output.output, bad_offset, self.reply)
+                    self.state = None # the file doesn't count
+                self._finish_file()
+            elif self.state == self.BATCH:
+                sizes = self._disk(write_batch, piece, self.frame.batch_count, self.made_dirs)
+                if self.metrics is not None:
+                    for size in sizes:
+                        self.metrics.file_done(size)
+                self.files += self.frame.batch_count
+                self.frame = None
+                self.state, self.need = self.HEADER, 1
+            elif self.state == self.RECIPE:
+                self._start_dedup(piece)
+            elif self.state == self.CHUNK:
+                self._disk(self.output.add_chunk, piece)
+                self._next_chunk()
+            elif self.state == self.DELTA_OP:
+                op, first, second = parse_op(piece)
+                if op == DELTA_END:
+                    self._finish_file()
+                elif op == DELTA_COPY:
+                    self.output.copy_blocks(first, second)
+                elif first:
+                    self.state, self.bytes_remaining = self.LITERAL, first
+            elif self.state == self.BLOCK_PREFIX:
+                block_length = parse_block_prefix(piece)
+                if block_length == 0:
+                    self._payload_done()
+                else:
+                    self.state, self.need = self.BLOCK, block_length
+            else: # BLOCK
+                if self.frame.independent_blocks:
+                    self.decompressor = make_decompressor(self.frame.codec)
+                for out in inflate(self.decompressor, piece, self.frame.data_length - self.received):
+                    self._write(out)
+                    self.received += len(out)
+                self.state, self.need = self.BLOCK_PREFIX, 4
+
+    def _write(self, data):
+        if self.metrics is None:
+            self.output.write(data)
+        else:
+            self.metrics.disk(self.output.write, data)
+
+    def _disk(self, work, *args):
+        """work(*args), counted as time on disk when metrics are on."""
+        if self.metrics is None:
+            return work(*args)
+        return self.metrics.disk(work, *args)
+
+    def _start_file(self):
+        frame = self.frame
+        if frame.query:
+            answer_query(frame, self.reply, self.defer)
+            self.frame = None
+            self.state, self.need = self.HEADER, 1
+            return
+        os.write(2, f"Extracting: {frame.describe()}\n".encode())
+        if frame.batch_count: # collected whole, then written out together
+            self.state, self.need = self.BATCH, frame.data_length
+            return
+        if frame.dedup:
+            self.state, self.need = self.RECIPE, frame.chunk_count * RECIPE_ENTRY_SIZE
+            if not self.need:
+                self._start_dedup(b"")
+            return
+        self.output = self._disk(open_output, frame, self.made_dirs, self.disk_policy)
+        if self.disk_writers is not None:
+            self.output = self.disk_writers.output(self.output, self.backpressure)
+        if frame.checksum != CHECKSUM_NONE:
+            self.sums = StreamChecksum(frame.checksum, frame.checksum_blocks)
+            self.output = ChecksummedOutput(self.output, self.sums)
+        if frame.delta:
+            self.state, self.need = self.DELTA_OP, OP_SIZE
+            return
+        if frame.codec != CODEC_NONE:
+            self.decompressor = make_decompressor(frame.codec)
+            self.received = 0
+            self.state, self.need = self.BLOCK_PREFIX, 4
+            return
+        self.bytes_remaining = frame.data_length
+        self.state = self.PAYLOAD
+        if not self.bytes_remaining:
+            self._payload_done()
+
+    def _start_dedup(self, recipe):
+        if is_relative_path(self.frame.filename):
+            make_parent_dirs(self.frame.filename, self.made_dirs)
+        self.output = DedupFile(self.store, self.frame.filename, self.frame.data_length, recipe)
+        self.reply(self.output.need_reply())
+        self._next_chunk()
+
+    def _next_chunk(self):
+        length = self.output.next_chunk_length()
+        if length is None:
+            self._finish_file()
+        else:
+            self.state, self.need = self.CHUNK, length
+
+    def _payload_done(self):
+        """The payload is all in; a checksummed one still has its trailer to come."""
+        if self.sums is None:
+            self._finish_file()
+        else:
+            frame = self.frame
+            self.state, self.need = self.TRAILER, trailer_size(frame.checksum, frame.checksum_blocks, frame.data_length)
+
+    def _finish_file(self, dropped=False):
+        frame = self.frame
+        if self.state is None: # dropped mid-file, or rejected
+            complete = False
+        elif frame.dedup:
+            complete = self.output.next_chunk_length() is None
+        elif frame.delta:
+            complete = self.output.written == frame.data_length
+        elif frame.codec != CODEC_NONE:
+            complete = self.state in (self.BLOCK_PREFIX, self.TRAILER) and self.received == frame.data_length
+        else:
+            complete = not self.bytes_remaining
+        output = self.output
+        self.output = self.frame = self.decompressor = self.sums = None
+        self.state, self.need = self.HEADER, 1
+        if self.defer is None or self.disk_writers is None or frame.dedup:
+            self._disk(output.close, complete)
+            self._closed(frame, complete, dropped)
+            return
+        # Its writes are still queued: the writer thread closes it after the
+        # last one, and the file only counts (or gets its "DONE") after that.
+        def closed(error):
+            self.closing -= 1
+            if error is not None:
+                raise error
+            self._closed(frame, complete, dropped)
+        self.closing += 1
+        output.close_behind(complete, lambda error: self.defer(lambda: closed(error)))
+
+    def _closed(self, frame, complete, dropped):
+        """A file is closed for good: count it and tell the client."""
+        if complete:
+            self.files += 1
+            if self.metrics is not None:
+                self.metrics.file_done(frame.data_length)
+        if frame.resumable and not dropped:
+            confirm_resumable(frame, complete, self.reply)
+
+    def close(self):
+        """Called at end of stream; closes a file left half-written by a dropped client."""
+        if self.output is not None:
+            self.state = None # whatever we were waiting for, it isn't coming
+            self._finish_file(dropped=True)
@@ -1,13 +1,70 @@
 #! /usr/bin/env python3
 
+"""
+The framing protocol: FramedWriter sends files as frames, FramedReader
+receives them on a blocking connection.  Headers live in frameheader.py,
+the server's output files in frameoutput.py and the event-loop receiver in
+frameparser.py; everything is importable from here as well.
+"""
 
 import os
-from buffers import BufferedWriter, BufferedReader
+import errno
+import socket
+import fcntl
+import stat
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from compression import (CODEC_NONE, SAMPLE_SIZE, BLOCK_SIZE, MIN_COMPRESS_SIZE, make_compressor,
+                         compress_block, make_decompressor, worth_compressing, block_prefix,
+                         parse_block_prefix, inflate)
+from resume import resume_key
+from checksum import CHECKSUM_NONE, StreamChecksum, ChecksummedOutput, trailer_size
+from chunkstore import DEDUP_MIN_SIZE, MAX_RECIPE_CHUNKS, RECIPE_ENTRY_SIZE, DedupFile, file_recipe, encode_recipe
+from delta import (DELTA_MIN_SIZE, DELTA_COPY, DELTA_END, OP_SIZE, SIGNATURE_SIZE, parse_signatures,
+                   compute_delta, encode_op, parse_op)
+from batch import (BATCH_MAX_BYTES, BATCH_MAX_FILES, read_small_file, encode_entry, is_relative_path,
+                   make_parent_dirs, write_batch)
+# (Some of these are only here for the client, server and bench, which import them from framing.)
+from frameheader import (COMPACT_MARKER, COMPACT_PEEK, COMPACT_VERSION, STATUS_OK, FrameHeader, ServerBusy,
+                         busy_status, compact_header_size, read_reply, read_status)
+from frameoutput import answer_query, confirm_resumable, open_output, reject_payload, write_all
+from frameparser import FrameParser
 
 class FramedWriter:
-    def __init__(self, buffered_writer_object):
+    def __init__(self, buffered_writer_object, codec=CODEC_NONE, compress_threads=1,
+                 checksum=CHECKSUM_NONE, checksum_blocks=False, prefetch_threads=8, header_version=1):
         # Now it uses the object you pass in
         self.writer = buffered_writer_object
+        # Compression to try on each file (CODEC_NONE: always send raw bytes)
+        self.codec = codec
+        # With more than one thread, files are cut into blocks that are
+        # compressed in parallel while earlier blocks go out on the network.
+        self.compress_threads = compress_threads
+        self.pool = None # created on first use
+        # Checksum trailer to send after each payload (and whether per block)
+        self.checksum = checksum
+        self.checksum_blocks = checksum_blocks
+        # (filename, offset) of every file the server said arrived damaged
+        self.rejected = []
+        # Header layout the server reads (COMPACT_VERSION: compact headers)
+        self.header_version = header_version
+        # Small files are read ahead on this many threads and sent in batches
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_pool = None # created on first use
+        self.batch = []           # (entry header, data) of the batch being filled
+        self.batch_bytes = 0
+        # Whether the kernel sendfile() path can be used (decided on first file)
+        self.sendfile_ok = None
+        # How much of a file we read at a time when it goes through Python
+        self.chunk_size = buffered_writer_object.buffer_size
+        # The calls that read files and send them (profiling swaps in timed ones)
+        self.pread = os.pread
+        self.sendfile = getattr(os, "sendfile", None)
+
+    def set_buffer_size(self, size):
+        """Changes the write buffer and read chunk size (for buffers tuned after the first file)."""
+        self.writer.buffer_size = size
+        self.chunk_size = size
 
     #Finds a file's size, creates a header, and writes the header and data
     def write_file(self, filename_to_add):
@@ -15,84 +72,675 @@ class FramedWriter:
         os.write(2, f"Archiving: {filename_to_add}\n".encode())
 
         fd = os.open(filename_to_add, os.O_RDONLY)# Open the input file for reading
+        try:
+            file_size = os.lseek(fd, 0, os.SEEK_END)# this sets the file offset to the end of the file and returns the file size
+            # --- ----the Header ----------
+            # The filename (null padded to 100 bytes) followed by the size as
+            # 8 big-endian bytes: the 108-byte header.
+            header = FrameHeader(filename_to_add, file_size)
+            if self.header_version >= COMPACT_VERSION:
+                # Compact headers have room for the file's permissions and mtime.
+                st = os.fstat(fd)
+                header.mode, header.mtime_ns = stat.S_IMODE(st.st_mode), st.st_mtime_ns
+            self._write_frame(header, fd, 0, file_size)
+        finally:
+            # Close the input file we were reading from.
+            os.close(fd)
 
-        file_size = os.lseek(fd, 0, os.SEEK_END)# this sets the file offset to the end of the file and returns the file size
-        os.lseek(fd, 0, os.SEEK_SET)# this returns the file offset to the beginning of the file
-        # --- ----the Header ----------
-        # 1. Convert filename string to bytes.
-        filename_bytes = filename_to_add.encode()
-        # 2. Pad the filename with null bytes until it is exactly 100 bytes long.
-        padded_filename = filename_bytes.ljust(100, b'\0')#adds null bytes to the right until it is 100 bytes long
-        # 3. Convert the integer file_size into an 8-byte sequence.
-        length_bytes = file_size.to_bytes(8, 'big')#convert the integer file_size into an 8-byte sequence using big-endian byte order
-        # 4. Combine them to create the 108-byte header.
-        header = padded_filename + length_bytes
-        
-        # --- ---- Write the header and file data to the buffered writer -----
-        self.writer.write(header)
+    def write_file_range(self, filename_to_add, offset, length, total_size, transfer_id):
+        """Sends bytes [offset, offset+length) of a file as one stripe of transfer_id."""
+        os.write(2, f"Archiving: {filename_to_add} [{offset}-{offset + length} of {total_size}]\n".encode())
+        fd = os.open(filename_to_add, os.O_RDONLY)
+        try:
+            header = FrameHeader(filename_to_add, length, offset, total_size, transfer_id)
+            self._write_frame(header, fd, offset, length)
+        finally:
+            os.close(fd)
+
+    def write_file_resumable(self, filename_to_add, client_id, replies):
+        """Sends a file the server can keep if we get cut off, skipping what it already has.
+
+        'replies' is a BufferedReader on the same connection, for the server's answer.
+        """
+        fd = os.open(filename_to_add, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            key = resume_key(client_id, filename_to_add, st.st_size, st.st_mtime_ns)
+            # 1. Ask how much of this exact file the server already has.
+            query = FrameHeader(filename_to_add, 0, 0, st.st_size, key)
+            query.resumable = query.query = True
+            self.writer.write(query.encode(self.header_version))
+            self.writer.flush()
+            words = self._read_answer(replies)
+            if words[:1] == ["BUSY"]:
+                raise ServerBusy(float(words[1]) if len(words) > 1 else 1.0)
+            if len(words) < 2 or words[0] != "OFFSET":
+                raise ConnectionError(f"no answer to resume query for {filename_to_add}")
+            offset = int(words[1])
+
+            # 2. Send only the rest.
+            if offset:
+                os.write(2, f"Archiving: {filename_to_add} (resuming at byte {offset} of {st.st_size})\n".encode())
+            else:
+                os.write(2, f"Archiving: {filename_to_add}\n".encode())
+            header = FrameHeader(filename_to_add, st.st_size - offset, offset, st.st_size, key)
+            header.resumable = True
+            self._write_frame(header, fd, offset, st.st_size - offset)
+            self.writer.flush()
+
+            # 3. Bytes in our send buffer aren't bytes on the server's disk:
+            # the file is only done once the server says it's in place.
+            words = self._read_answer(replies)
+            if words[:1] != ["DONE"]:
+                raise ConnectionError(f"server didn't confirm {filename_to_add} "
+                                      f"({' '.join(words) if words else 'connection closed'})")
+        finally:
+            os.close(fd)
+
+    def write_file_delta(self, filename_to_add, replies):
+        """Sends a file as a delta against the server's copy of it, if the server has one.
+
+        'replies' is a BufferedReader on the same connection, for the server's signatures.
+        """
+        fd = os.open(filename_to_add, os.O_RDONLY)
+        try:
+            file_size = os.fstat(fd).st_size
+            block_size = count = 0
+            if file_size >= DELTA_MIN_SIZE:
+                # 1. Ask for the signatures of the server's blocks.
+                query = FrameHeader(filename_to_add, 0)
+                query.delta = query.query = True
+                self.writer.write(query.encode(self.header_version))
+                self.writer.flush()
+                words = self._read_answer(replies)
+                if len(words) < 3 or words[0] != "SIGS":
+                    raise ConnectionError(f"no answer to signature query for {filename_to_add}")
+                block_size, count = int(words[1]), int(words[2])
+            if not count:
+                # Nothing to build on: send the whole file.
+                os.write(2, f"Archiving: {filename_to_add}\n".encode())
+                self._write_frame(FrameHeader(filename_to_add, file_size), fd, 0, file_size)
+                return
+            signatures = replies.read(count * SIGNATURE_SIZE)
+            if len(signatures) < count * SIGNATURE_SIZE:
+                raise ConnectionError(f"connection closed inside the signatures of {filename_to_add}")
+
+            # 2. Send our file as references to those blocks plus literal bytes.
+            header = FrameHeader(filename_to_add, file_size)
+            header.delta = True
+            header.block_size = block_size
+            self.writer.write(header.encode(self.header_version))
+            matched = 0
+            for op, first, second in compute_delta(fd, file_size, block_size, parse_signatures(signatures)):
+                if op == DELTA_COPY:
+                    self.writer.write(encode_op(op, first, second))
+                    matched += second * block_size
+                    continue
+                self.writer.write(encode_op(op, second))
+                if second < 65536 or not self._send_payload_sendfile(fd, first, second):
+                    end = first + second
+                    while first < end:
+                        chunk = self.pread(fd, min(self.chunk_size, end - first), first)
+                        self.writer.write(chunk)
+                        first += len(chunk)
+            self.writer.write(encode_op(DELTA_END))
+            os.write(2, f"Archiving: {filename_to_add} (delta: {file_size - matched} of {file_size} bytes sent)\n".encode())
+        finally:
+            os.close(fd)
+
+    def write_file_dedup(self, filename_to_add, replies):
+        """Sends a file as a recipe of chunk hashes, then only the chunks the server is missing.
+
+        'replies' is a BufferedReader on the same connection, for the server's answer.
+        """
+        fd = os.open(filename_to_add, os.O_RDONLY)
+        try:
+            file_size = os.fstat(fd).st_size
+            recipe = file_recipe(fd, file_size) if file_size >= DEDUP_MIN_SIZE else []
+            if not recipe or len(recipe) > MAX_RECIPE_CHUNKS:
+                os.write(2, f"Archiving: {filename_to_add}\n".encode())
+                self._write_frame(FrameHeader(filename_to_add, file_size), fd, 0, file_size)
+                return
+
+            # 1. The recipe: which chunks (by SHA-256) make up the file.
+            header = FrameHeader(filename_to_add, file_size)
+            header.dedup = True
+            header.chunk_count = len(recipe)
+            self.writer.write(header.encode(self.header_version))
+            self.writer.write(encode_recipe(recipe))
+            self.writer.flush()
+            words = self._read_answer(replies)
+            if len(words) < 2 or words[0] != "NEED":
+                raise ConnectionError(f"no answer to the recipe of {filename_to_add}")
+            count = int(words[1])
+            needed = replies.read(4 * count)
+            if len(needed) < 4 * count:
+                raise ConnectionError(f"connection closed inside the reply for {filename_to_add}")
+
+            # 2. The chunks the server doesn't have, in the order it asked.
+            sent = 0
+            for i in range(0, 4 * count, 4):
+                _, offset, length = recipe[int.from_bytes(needed[i:i+4], 'big')]
+                self.writer.write(self.pread(fd, length, offset))
+                sent += length
+            os.write(2, f"Archiving: {filename_to_add} (dedup: {count} of {len(recipe)} chunks, "
+                        f"{sent} of {file_size} bytes sent)\n".encode())
+        finally:
+            os.close(fd)
+
+    def write_files_batched(self, filenames):
+        """Sends many files, packing the small ones into batch frames.
+
+        Opening and reading the files happens on a thread pool a few files
+        ahead of us, so the disk is kept busy while batches go out.  A file
+        too big for a batch gets an ordinary frame of its own.
+        """
+        if self.prefetch_pool is None:
+            self.prefetch_pool = ThreadPoolExecutor(max_workers=self.prefetch_threads)
+        in_flight = collections.deque()
+        max_in_flight = 4 * self.prefetch_threads
+        for filename in filenames:
+            in_flight.append((filename, self.prefetch_pool.submit(read_small_file, filename)))
+            if len(in_flight) >= max_in_flight:
+                self._add_to_batch(*in_flight.popleft())
+        while in_flight:
+            self._add_to_batch(*in_flight.popleft())
+        self._write_batch()
+
+    def _add_to_batch(self, filename, prefetched):
+        try:
+            data = prefetched.result()
+        except FileNotFoundError:
+            os.write(2, f"Error: Input file '{filename}' not found.\n".encode())
+            return
+        if data is None:
+            # Too big for a batch; keep the order by sending what we have first.
+            self._write_batch()
+            self.write_file(filename)
+            return
+        entry = encode_entry(filename, data)
+        if self.batch and (self.batch_bytes + len(entry) + len(data) > BATCH_MAX_BYTES
+                           or len(self.batch) >= BATCH_MAX_FILES):
+            self._write_batch()
+        self.batch.append((entry, data))
+        self.batch_bytes += len(entry) + len(data)
 
-        # Read the input file's data in chunks and write each chunk to the buffer.
+    def _write_batch(self):
+        """Sends the files collected so far as one batch frame."""
+        if not self.batch:
+            return
+        os.write(2, f"Archiving: batch of {len(self.batch)} files ({self.batch_bytes} bytes)\n".encode())
+        header = FrameHeader("", self.batch_bytes)
+        header.batch_count = len(self.batch)
+        self.writer.write(header.encode(self.header_version))
+        # Small pieces are queued, not copied: the buffered writer hands
+        # runs of them to the kernel in a single writev().
+        for entry, data in self.batch:
+            self.writer.write(entry)
+            self.writer.write(data)
+        self.batch = []
+        self.batch_bytes = 0
+
+    def _read_answer(self, replies):
+        """Reads the server's answer to a query, noting any "BAD" reports that came first."""
         while True:
-            chunk = os.read(fd, 4096)#os.read reads up to 4096 bytes from the file descriptor fd
-            if not chunk:
+            words = read_reply(replies)
+            if words[:1] != ["BAD"] or len(words) < 3:
+                return words
+            filename, offset = " ".join(words[2:]), int(words[1])
+            os.write(2, f"Error: server rejected {filename} (checksum mismatch from byte {offset})\n".encode())
+            self.rejected.append((filename, offset))
+
+    def finish(self, replies):
+        """Ends our side of the stream, then waits for the server's last reports and closes.
+
+        Returns the (filename, offset) of every file the server rejected.
+        """
+        self.writer.flush()
+        # Half-close: the server sees the end of our files but can still answer.
+        with socket.socket(fileno=os.dup(self.writer.fd)) as s:
+            s.shutdown(socket.SHUT_WR)
+        while self._read_answer(replies):
+            pass
+        self.close()
+        return self.rejected
+
+    def _write_frame(self, header, fd, offset, length):
+        """Writes header, then length bytes of fd starting at offset (then the checksum trailer)."""
+        # Adaptive compression: compress a sample first and only use the codec
+        # if it actually shrinks (already-compressed data usually won't).
+        sample = None
+        if self.codec != CODEC_NONE and length >= MIN_COMPRESS_SIZE:
+            sample = self.pread(fd, min(SAMPLE_SIZE, length), offset)
+            if worth_compressing(sample):
+                header.codec = self.codec
+                header.independent_blocks = self.compress_threads > 1
+
+        # The checksums are worked out as the payload goes by.
+        sums = None
+        if self.checksum != CHECKSUM_NONE:
+            header.checksum = self.checksum
+            header.checksum_blocks = self.checksum_blocks
+            sums = StreamChecksum(self.checksum, self.checksum_blocks)
+
+        # --- ---- Write the header and file data to the buffered writer -----
+        self.writer.write(header.encode(self.header_version))
+
+        if header.codec != CODEC_NONE and header.independent_blocks:
+            self._write_compressed_blocks(fd, offset, length, header.codec, sample, sums)
+        elif header.codec != CODEC_NONE:
+            self._write_compressed(fd, offset, length, header.codec, sample, sums)
+        # Fast path: a regular file going to a socket never has to pass through
+        # Python at all.  Flush the header, then let the kernel copy the payload.
+        # (Not with checksums: then every byte has to be seen on its way.)
+        elif sums is not None or not self._send_payload_sendfile(fd, offset, length):
+            # Read the input file's data in chunks and write each chunk to the buffer.
+            end = offset + length
+            while offset < end:
+                chunk = self.pread(fd, min(self.chunk_size, end - offset), offset)#reads a chunk at offset without moving the file position
+                if not chunk:
+                    break
+                if sums is not None:
+                    sums.update(chunk)
+                self.writer.write(chunk)
+                offset += len(chunk)
+
+        if sums is not None:
+            self.writer.write(sums.trailer())
+
+    def _write_compressed(self, fd, offset, length, codec, sample, sums=None):
+        """Streams length bytes of fd through the compressor as length-prefixed blocks."""
+        compressor = make_compressor(codec)
+        end = offset + length
+        chunk = sample # the sample is the first chunk; no need to read it twice
+        while offset < end:
+            if chunk is None:
+                chunk = self.pread(fd, min(SAMPLE_SIZE, end - offset), offset)
+                if not chunk:
+                    break
+            offset += len(chunk)
+            if sums is not None:
+                sums.update(chunk)
+            self._write_block(compressor.compress(chunk))
+            chunk = None
+        self._write_block(compressor.flush())
+        self.writer.write(block_prefix(0)) # end of payload
+
+    def _write_compressed_blocks(self, fd, offset, length, codec, sample, sums=None):
+        """Compresses BLOCK_SIZE pieces of fd on the thread pool, writing them out in order."""
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.compress_threads)
+        # A bounded window of blocks in flight: enough to keep every thread
+        # busy while we wait on the oldest, but memory stays bounded.
+        in_flight = collections.deque()
+        max_in_flight = 2 * self.compress_threads
+        end = offset + length
+        while offset < end:
+            if sample is not None and len(sample) == min(BLOCK_SIZE, end - offset):
+                chunk, sample = sample, None # the sample is exactly the first block
+            else:
+                chunk, sample = self.pread(fd, min(BLOCK_SIZE, end - offset), offset), None
+                if not chunk:
+                    break
+            offset += len(chunk)
+            if sums is not None:
+                sums.update(chunk)
+            in_flight.append(self.pool.submit(compress_block, codec, chunk))
+            if len(in_flight) >= max_in_flight:
+                self._write_block(in_flight.popleft().result())
+        while in_flight:
+            self._write_block(in_flight.popleft().result())
+        self.writer.write(block_prefix(0)) # end of payload
+
+    def _write_block(self, block):
+        if block: # compressors often hold output back; empty blocks would end the payload
+            self.writer.write(block_prefix(len(block)))
+            self.writer.write(block)
+
+    def _send_payload_sendfile(self, fd, offset, length):
+        """Sends length bytes of fd from offset with os.sendfile(). Returns False if the caller must fall back."""
+        if self.sendfile_ok is None:
+            # Only sockets qualify as a destination (pipes and stdout use the loop).
+            try:
+                out_fd = self.writer.fd
+                self.sendfile_ok = hasattr(os, "sendfile") and stat.S_ISSOCK(os.fstat(out_fd).st_mode)
+            except (AttributeError, OSError):
+                self.sendfile_ok = False
+        if not self.sendfile_ok or not stat.S_ISREG(os.fstat(fd).st_mode):
+            return False
+
+        self.writer.flush() # the header must hit the socket before the payload
+        start, end = offset, offset + length
+        while offset < end:
+            try:
+                sent = self.sendfile(self.writer.fd, fd, offset, end - offset)
+            except OSError as e:
+                if offset == start and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    self.sendfile_ok = False # not supported here; remember and fall back
+                    return False
+                raise
+            if sent == 0: # the file shrank underneath us
                 break
-            self.writer.write(chunk)
-            
-        # Close the input file we were reading from.
-        os.close(fd)
+            offset += sent
+        return True
 
     def close(self):
         """Closes the underlying buffered writer, flushing any remaining data."""
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.prefetch_pool is not None:
+            self.prefetch_pool.shutdown()
         self.writer.close()#close the underlying buffered writer, flushing any remaining data
 
+    def abort(self):
+        """Closes the connection after an error, dropping whatever wasn't sent."""
+        self.writer.discard()
+        self.close()
+
 class FramedReader:
-    def __init__(self, buffered_reader_object):
+    def __init__(self, buffered_reader_object, zero_copy=True, reply=None, store=None, metrics=None, disk_writers=None,
+                 disk_policy=None):
         # Now it uses the object you pass in
         self.reader = buffered_reader_object
+        # Write-behind pool (diskwriter.py) the payloads are written from (None: written here)
+        self.disk_writers = disk_writers
+        # Preallocation, page cache advice and O_DIRECT for the files we write (diskio.py; None: none of it)
+        self.disk_policy = disk_policy
+        # This connection's ConnectionMetrics (None: not counting)
+        self.metrics = metrics
+        if metrics is not None:
+            self.reader.readv = metrics.readv
+        # Sends a line back to the client (for queries and recipes)
+        self.reply = reply
+        # Where deduplicated uploads keep their chunks (None: no store)
+        self.store = store
+        # Directories already created for files on this connection
+        self.made_dirs = set()
+        # One chunk buffer reused for every payload read
+        self.chunk = bytearray(buffered_reader_object.buffer_size)
+        self.chunk_view = memoryview(self.chunk)
+        # Zero-copy receive: splice() the payload socket -> pipe -> file.
+        self.zero_copy = zero_copy
+        self.splice_ok = None # decided on first file
+        self.pipe = None      # (read_fd, write_fd), created on first use
+        self.pipe_size = 65536
 
-    def read_next_file(self):
-        """Reads the next header and data chunk from the archive, saving it to a file."""
-        
+    def _network(self, read, *args, **kwargs):
+        """read(*args), counted as bytes from the socket when metrics are on."""
+        if self.metrics is None:
+            return read(*args, **kwargs)
+        return self.metrics.network(read, *args, **kwargs)
+
+    def _disk(self, work, *args, **kwargs):
+        """work(*args), counted as time on disk when metrics are on."""
+        if self.metrics is None:
+            return work(*args, **kwargs)
+        return self.metrics.disk(work, *args, **kwargs)
+
+    def set_buffer_size(self, size):
+        """Grows the read buffer and chunk buffer (for buffers tuned after the first file)."""
+        if size > self.reader.buffer_size:
+            self.reader.resize(size)
+            self.chunk = bytearray(size)
+            self.chunk_view = memoryview(self.chunk)
+
+    def read_header(self):
+        """Reads and unpacks the next frame header. Returns None at the end of the archive."""
         # --- Read the Header ---
-        # Read the fixed-size 108-byte header from the archive.
-        header = self.reader.read(108)
-        
+        # The first byte says which kind of header this is.
+        ahead = self.reader.peek(COMPACT_PEEK)
+
         # If the header is empty, we've reached the end of the archive.
-        if not header:
+        if not ahead:
+            return None
+        if ahead[0] == COMPACT_MARKER:
+            # A compact header: usually all of it is already buffered.
+            size = compact_header_size(ahead)
+            if size <= len(ahead):
+                return FrameHeader.decode_compact(self.reader.read(size))
+            # Otherwise read as much as we know it has until it's all in.
+            header = bytearray(self.reader.read(len(ahead)))
+            size = compact_header_size(header)
+            while size > len(header):
+                more = self.reader.read(size - len(header))
+                if not more:
+                    os.write(2, f"Connection closed inside a header\n".encode())
+                    return None
+                header += more
+                size = compact_header_size(header)
+            return FrameHeader.decode_compact(header)
+
+        # Otherwise the fixed-size 108-byte header.
+        header = self.reader.read(108)
+        if len(header) < 108:
+            os.write(2, f"Connection closed inside a header ({len(header)} of 108 bytes)\n".encode())
+            return None
+
+        frame, extra = FrameHeader.decode(header)
+        if extra:
+            extra_bytes = self.reader.read(extra)
+            if len(extra_bytes) < extra:
+                os.write(2, f"Connection closed inside a header\n".encode())
+                return None
+            frame.decode_extra(extra_bytes)
+        return frame
+
+    def read_next_file(self):
+        """Reads the next header and data chunk from the archive, saving it to a file."""
+        header = self.read_header()
+        if header is None:
             return False # Signal that we are done.
+        if header.query:
+            answer_query(header, self.reply)
+            return True
 
-        # --- Unpack the Header ---
-        # 1. The first 100 bytes are the padded filename.
-        padded_filename = header[:100]
-        # 2. The last 8 bytes are the data length.
-        length_bytes = header[100:]
-        
-        # 3. Remove the null-byte padding and decode to get the original filename string.
-        filename = padded_filename.strip(b'\0').decode()
-        # 4. Convert the 8 bytes for the length back into an integer.
-        data_length = int.from_bytes(length_bytes, 'big')
-
-        os.write(2, f"Extracting: {filename} ({data_length} bytes)\n".encode())
+        os.write(2, f"Extracting: {header.describe()}\n".encode())
+        if header.batch_count:
+            self._receive_batch(header)
+            return True
+        if header.dedup:
+            self._receive_dedup(header)
+            return True
         # --- Read the Data and Write to New File ---
-        # Create and open the new file for writing.
-        output_fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
-        #writer = BufferedWriter(output_fd)
+        # Create and open the new file for writing (or the shared stripe file).
+        output = self._disk(open_output, header, self.made_dirs, self.disk_policy)
+        if self.disk_writers is not None:
+            output = self.disk_writers.output(output)
+        sums = None
+        if header.checksum != CHECKSUM_NONE:
+            sums = StreamChecksum(header.checksum, header.checksum_blocks)
+            output = ChecksummedOutput(output, sums)
+        complete = False
+        try:
+            if header.delta:
+                received = self._receive_delta(output)
+            elif header.codec != CODEC_NONE:
+                received = self._receive_compressed(output, header.codec, header.independent_blocks,
+                                                    header.data_length)
+            else:
+                received = self._receive_payload(output, header.data_length)
+            arrived = complete = received == header.data_length
+            if complete and sums is not None:
+                complete = self._check_trailer(header, sums, output.output)
+        finally:
+            self._disk(output.close, complete)
+        if header.resumable and arrived:
+            confirm_resumable(header, complete, self.reply)
+        if complete and self.metrics is not None:
+            self.metrics.file_done(header.data_length)
+        return True # Signal success.
+
+    def _check_trailer(self, header, sums, output):
+        """Reads the checksum trailer and compares it with what we received."""
+        trailer = self.reader.read(trailer_size(header.checksum, header.checksum_blocks, header.data_length))
+        bad_offset = sums.verify(trailer)
+        if bad_offset is None:
+            return True
+        reject_payload(header, output, bad_offset, self.reply)
+        return False
+
+    def _receive_payload(self, output, data_length):
+        """Moves data_length payload bytes into output. Returns how many actually arrived."""
+        bytes_remaining = data_length
+        # 1. Payload bytes that BufferedReader already pulled off the socket go first.
+        bytes_remaining -= self._copy_payload(output, min(bytes_remaining, self.reader.buffered()))
+        # 2. The rest can move socket -> pipe -> file without entering Python.
+        if self.zero_copy and output.zero_copy_ok:
+            bytes_remaining -= self._receive_payload_splice(output, bytes_remaining)
+        # 3. Anything left (no splice available) is copied through our chunk buffer.
+        bytes_remaining -= self._copy_payload(output, bytes_remaining)
+        return data_length - bytes_remaining
+
+    def _receive_compressed(self, output, codec, independent_blocks, data_length):
+        """Reads compressed blocks up to the zero-length one, decompressing them into output.
+
+        Raises ValueError (dropping the connection) if they inflate past data_length.
+        """
+        decompressor = make_decompressor(codec)
+        received = 0
+        while True:
+            prefix = self.reader.read(4)
+            if len(prefix) < 4:
+                break # connection closed mid-payload
+            block_length = parse_block_prefix(prefix)
+            if block_length == 0:
+                break # end of payload
+            block = self.reader.read(block_length)
+            if independent_blocks:
+                decompressor = make_decompressor(codec)
+            for data in inflate(decompressor, block, data_length - received):
+                self._disk(output.write, data)
+                received += len(data)
+            if len(block) < block_length:
+                break
+        return received
+
+    def _receive_batch(self, header):
+        """Reads a whole batch of small files in one go and writes them out."""
+        payload = self.reader.read(header.data_length)
+        if len(payload) < header.data_length:
+            os.write(2, f"Connection closed inside a {header.describe()}\n".encode())
+            return
+        sizes = self._disk(write_batch, payload, header.batch_count, self.made_dirs)
+        if self.metrics is not None:
+            for size in sizes:
+                self.metrics.file_done(size)
+
+    def _receive_dedup(self, header):
+        """Reads a recipe, tells the client which chunks we need, and builds the file from them."""
+        recipe = self.reader.read(header.chunk_count * RECIPE_ENTRY_SIZE)
+        if len(recipe) < header.chunk_count * RECIPE_ENTRY_SIZE:
+            os.write(2, f"Connection closed inside the recipe of {header.filename}\n".encode())
+            return
+        if is_relative_path(header.filename):
+            make_parent_dirs(header.filename, self.made_dirs)
+        output = DedupFile(self.store, header.filename, header.data_length, recipe)
+        try:
+            self.reply(output.need_reply())
+            length = output.next_chunk_length()
+            while length is not None:
+                chunk = self.reader.read(length)
+                if len(chunk) < length:
+                    break # connection closed mid-payload
+                self._disk(output.add_chunk, chunk)
+                length = output.next_chunk_length()
+        finally:
+            complete = output.next_chunk_length() is None
+            self._disk(output.close, complete)
+        if complete and self.metrics is not None:
+            self.metrics.file_done(header.data_length)
+
+    def _receive_delta(self, output):
+        """Rebuilds a file from delta ops up to DELTA_END. Returns the size of the rebuilt file."""
+        while True:
+            op_header = self.reader.read(OP_SIZE)
+            if len(op_header) < OP_SIZE:
+                break # connection closed mid-payload
+            op, first, second = parse_op(op_header)
+            if op == DELTA_END:
+                break
+            if op == DELTA_COPY:
+                output.copy_blocks(first, second)
+            elif self._receive_payload(output, first) < first:
+                break
+        return output.written
+
+    def _copy_payload(self, output, data_length):
+        """Copies up to data_length payload bytes from the reader to output. Returns bytes copied."""
         # Keep reading from the archive until we've read the full data_length.
+        # readinto() drops the bytes straight into our reusable chunk buffer,
+        # so no new bytes objects are created per chunk.
         bytes_remaining = data_length
         while bytes_remaining > 0:
             # Read a chunk from the archive.
-            chunk = self.reader.read(min(bytes_remaining, 4096))
-            if not chunk: # Should not happen if archive is not corrupt
+            n = self.reader.readinto(self.chunk_view[:min(bytes_remaining, len(self.chunk))])
+            if not n: # Should not happen if archive is not corrupt
                 break
             # Write the chunk to the new file.
-            os.write(output_fd, chunk)
-            #writer.write(chunk)
-            bytes_remaining -= len(chunk)
-            
-        # Close the new file that we just created.
-        os.close(output_fd)
-        return True # Signal success.
+            self._disk(output.write, self.chunk_view[:n])
+            bytes_remaining -= n
+        return data_length - bytes_remaining
+
+    def _receive_payload_splice(self, output, data_length):
+        """Moves up to data_length bytes from the socket into output's file with os.splice(). Returns bytes moved."""
+        output_fd = output.fd
+        if self.splice_ok is None:
+            # splice() needs a socket (or pipe) on the reading side.
+            try:
+                self.splice_ok = hasattr(os, "splice") and stat.S_ISSOCK(os.fstat(self.reader.fd).st_mode)
+            except (AttributeError, OSError):
+                self.splice_ok = False
+        if not self.splice_ok or data_length == 0 or not stat.S_ISREG(os.fstat(output_fd).st_mode):
+            return 0
+        if self.pipe is None:
+            self.pipe = os.pipe()
+            try: # a bigger pipe means fewer splice() round trips
+                self.pipe_size = fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, 1 << 20)
+            except (AttributeError, OSError):
+                pass
+        pipe_r, pipe_w = self.pipe
+
+        moved = 0
+        while moved < data_length:
+            try:
+                in_pipe = self._network(os.splice, self.reader.fd, pipe_w, min(data_length - moved, self.pipe_size),
+                                        flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if moved == 0 and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    self.splice_ok = False # not supported here; remember and fall back
+                    return 0
+                raise
+            if in_pipe == 0: # connection closed mid-payload
+                break
+            # Drain the pipe into the file before pulling more off the socket.
+            while in_pipe:
+                try:
+                    written = self._disk(os.splice, pipe_r, output_fd, in_pipe, offset_dst=output.position,
+                                         flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    # This filesystem can't take splice(); empty the pipe by hand.
+                    self.splice_ok = False
+                    while in_pipe:
+                        data = os.read(pipe_r, in_pipe)
+                        output.write(data)
+                        in_pipe -= len(data)
+                        moved += len(data)
+                    return moved
+                output.advance(written)
+                in_pipe -= written
+                moved += written
+        return moved
 
     def close(self):
         """Closes the underlying buffered reader."""
+        self.release()
         self.reader.close()
+
+    def release(self):
+        """Frees the splice pipe, leaving the connection itself open."""
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
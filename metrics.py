@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+
+"""
+Server metrics, served in Prometheus' text format on an optional local HTTP port.
+
+Counting must not slow a transfer down, so nothing on the hot path takes a
+lock.  Every connection gets a ConnectionMetrics that only the thread (or
+event loop) handling it writes to: plain attribute adds.  When the
+connection ends it is folded into the server-wide totals; a scrape adds up
+the totals and every connection still open.  Locks are taken once per
+connection and once per scrape.
+
+Rates (bytes/s, files/s) are left to Prometheus' rate() over the counters;
+each open connection also reports its own throughput so far.
+"""
+
+import os
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+clock = time.perf_counter
+
+# Histogram bucket upper bounds
+FILE_SIZE_BUCKETS = (1 << 10, 16 << 10, 64 << 10, 1 << 20, 16 << 20, 256 << 20, 1 << 30)     # bytes
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9)                                               # bytes per second
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)                                           # seconds
+
+class Histogram:
+    """Counts of observations at or below each bound, plus their sum."""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last one is above every bound (+Inf)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.merge(self)
+        return histogram
+
+class ConnectionMetrics:
+    """One connection's numbers.  Only whoever handles the connection writes them."""
+
+    def __init__(self, client):
+        self.client = client
+        self.started = time.monotonic()
+        self.bytes_received = 0
+        self.reads = 0                # read()/recv()/splice() calls on the socket
+        self.network_seconds = 0.0    # spent in those calls: waiting for the client
+        self.disk_seconds = 0.0       # spent creating, writing and closing files
+        self.files = 0
+        self.file_bytes = Histogram(FILE_SIZE_BUCKETS)
+
+    def network(self, read, *args, **kwargs):
+        """Calls read(*args), which returns a byte count, as time and bytes from the client."""
+        started = clock()
+        n = read(*args, **kwargs)
+        self.network_seconds += clock() - started
+        self.reads += 1
+        self.bytes_received += n
+        return n
+
+    def readv(self, fd, buffers):
+        """os.readv(), counted (BufferedReader uses this in place of os.readv)."""
+        return self.network(os.readv, fd, buffers)
+
+    def disk(self, work, *args, **kwargs):
+        """Calls work(*args) as time spent on disk."""
+        started = clock()
+        try:
+            return work(*args, **kwargs)
+        finally:
+            self.disk_seconds += clock() - started
+
+    def file_done(self, size):
+        self.files += 1
+        self.file_bytes.observe(size)
+
+    def throughput(self, now=None):
+        """Bytes per second since the connection was accepted."""
+        elapsed = (now or time.monotonic()) - self.started
+        return self.bytes_received / elapsed if elapsed > 0 else 0.0
+
+class Metrics:
+    """Server-wide metrics: totals of finished connections, plus the open ones."""
+
+    def __init__(self, disk_writers=None):
+        self.lock = threading.Lock()
+        self.disk_writers = disk_writers # DiskWriters whose queues we report (None: writes are inline)
+        self.live = {}                # id(ConnectionMetrics) -> ConnectionMetrics, still open
+        # Only the accept loop (one thread) changes these two
+        self.accepted = 0
+        self.rejected = 0
+        # Folded in from finished connections, under the lock
+        self.closed = 0
+        self.done = ConnectionMetrics(None)
+        self.throughput = Histogram(THROUGHPUT_BUCKETS)
+        self.queue_wait = Histogram(QUEUE_WAIT_BUCKETS)
+
+    def connection(self, addr):
+        """Starts counting for a new connection."""
+        connection = ConnectionMetrics(f"{addr[0]}:{addr[1]}" if isinstance(addr, tuple) else str(addr))
+        with self.lock:
+            self.live[id(connection)] = connection
+        return connection
+
+    def waited(self, seconds):
+        """Records how long an accepted connection waited for a worker."""
+        with self.lock:
+            self.queue_wait.observe(seconds)
+
+    def close(self, connection):
+        """Folds a finished connection into the totals."""
+        throughput = connection.throughput()
+        with self.lock:
+            if self.live.pop(id(connection), None) is None:
+                return
+            done = self.done
+            done.bytes_received += connection.bytes_received
+            done.reads += connection.reads
+            done.network_seconds += connection.network_seconds
+            done.disk_seconds += connection.disk_seconds
+            done.files += connection.files
+            done.file_bytes.merge(connection.file_bytes)
+            self.closed += 1
+            self.throughput.observe(throughput)
+
+    def render(self):
+        """The metrics in Prometheus' text exposition format."""
+        with self.lock:
+            live = list(self.live.values())
+            total = ConnectionMetrics(None)
+            for attr in ("bytes_received", "reads", "network_seconds", "disk_seconds", "files"):
+                setattr(total, attr, getattr(self.done, attr))
+            total.file_bytes = self.done.file_bytes.copy()
+            throughput = self.throughput.copy()
+            queue_wait = self.queue_wait.copy()
+            closed = self.closed
+        for connection in live:
+            total.bytes_received += connection.bytes_received
+            total.reads += connection.reads
+            total.network_seconds += connection.network_seconds
+            total.disk_seconds += connection.disk_seconds
+            total.files += connection.files
+            total.file_bytes.merge(connection.file_bytes)
+
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP filetransfer_{name} {help_text}")
+            lines.append(f"# TYPE filetransfer_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"filetransfer_{name}{labels} {value}")
+        def histogram(name, help_text, h):
+            samples, cumulative = [], 0
+            for bound, count in zip(h.bounds + (float("inf"),), h.counts):
+                cumulative += count
+                samples.append((f'_bucket{{le="{"+Inf" if bound == float("inf") else bound}"}}', cumulative))
+            samples += [("_sum", h.sum), ("_count", cumulative)]
+            metric(name, "histogram", help_text, samples)
+
+        metric("connections_accepted_total", "counter", "Connections accepted.", [("", self.accepted)])
+        metric("connections_rejected_total", "counter", "Connections turned away as busy.", [("", self.rejected)])
+        metric("connections_closed_total", "counter", "Connections finished (or dropped).", [("", closed)])
+        metric("connections_active", "gauge", "Connections being received right now.", [("", len(live))])
+        metric("bytes_received_total", "counter", "Bytes read from clients.", [("", total.bytes_received)])
+        metric("socket_reads_total", "counter", "Read calls on client sockets.", [("", total.reads)])
+        metric("files_received_total", "counter", "Files received complete.", [("", total.files)])
+        metric("network_seconds_total", "counter", "Time spent in socket reads (waiting on clients).",
+               [("", f"{total.network_seconds:.6f}")])
+        metric("disk_seconds_total", "counter", "Time spent creating, writing and closing files.",
+               [("", f"{total.disk_seconds:.6f}")])
+        histogram("file_size_bytes", "Sizes of the files received.", total.file_bytes)
+        histogram("connection_throughput_bytes_per_second", "Average throughput of finished connections.", throughput)
+        histogram("queue_wait_seconds", "Time accepted connections waited for a worker.", queue_wait)
+
+        now = time.monotonic()
+        per_client = [(f'{{client="{c.client}"}}', c) for c in live]
+        metric("client_bytes_received", "gauge", "Bytes read from each open connection.",
+               [(labels, c.bytes_received) for labels, c in per_client])
+        metric("client_throughput_bytes_per_second", "gauge", "Each open connection's throughput so far.",
+               [(labels, f"{c.throughput(now):.1f}") for labels, c in per_client])
+        metric("client_network_seconds", "gauge", "Each open connection's time in socket reads.",
+               [(labels, f"{c.network_seconds:.6f}") for labels, c in per_client])
+        metric("client_disk_seconds", "gauge", "Each open connection's time on disk.",
+               [(labels, f"{c.disk_seconds:.6f}") for labels, c in per_client])
+
+        if self.disk_writers is not None:
+            devices = [(f'{{device="{device:x}"}}', numbers) for device, *numbers in self.disk_writers.stats()]
+            metric("write_behind_queued_bytes", "gauge", "Bytes waiting for a disk writer, per device.",
+                   [(labels, queued) for labels, (queued, written, stalls, stalled) in devices])
+            metric("write_behind_written_bytes_total", "counter", "Bytes the disk writers wrote, per device.",
+                   [(labels, written) for labels, (queued, written, stalls, stalled) in devices])
+            metric("write_behind_stalls_total", "counter", "Times a connection waited for room in a device's queue.",
+                   [(labels, stalls) for labels, (queued, written, stalls, stalled) in devices])
+            metric("write_behind_stall_seconds_total", "counter", "Time connections waited for room, per device.",
+                   [(labels, f"{stalled:.6f}") for labels, (queued, written, stalls, stalled) in devices])
+        return "\n".join(lines) + "\n"
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serves GET /metrics on host:port from a daemon thread. Returns the HTTP server."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # a scrape every few seconds would drown out the transfer log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
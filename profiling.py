@@ -0,0 +1,268 @@
+#! /usr/bin/env python3
+
+"""
+Opt-in profiling of a connection: where its time goes, stage by stage.
+
+Turned on with --profile (or the FT_PROFILE environment variable), a comma
+separated list of:
+  stages       time every stage of FramedReader/FramedWriter and every
+               system call the buffers make, with calls and bytes per call
+  cprofile     run the connection under cProfile
+  tracemalloc  trace allocations made while the connection ran
+  all          all three
+Each connection prints its breakdown to stderr when it ends.
+
+Nothing here is wired in unless it is turned on: instrumenting a reader or
+writer replaces methods on that one instance with timed wrappers, so the
+classes themselves (and every connection when profiling is off) run exactly
+the code they always do.
+
+Stage times are kept both inclusive ("total") and exclusive ("own": minus
+the stages called inside), so the own times of a connection add up to the
+time spent in instrumented code and say where it went: readv, the copies in
+readinto, header parsing, or writes to disk.
+"""
+
+import os
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+clock = time.perf_counter
+
+MODES = ("stages", "cprofile", "tracemalloc")
+TOP = 15 # lines of cProfile and tracemalloc output per connection
+
+# Instance methods timed as stages: name -> label in the report
+READER_STAGES = {
+    "read_next_file": "file",
+    "read_header": "header",
+    "_receive_payload": "payload",
+    "_receive_compressed": "payload (compressed)",
+    "_receive_delta": "payload (delta)",
+    "_receive_batch": "batch",
+    "_receive_dedup": "dedup",
+    "_check_trailer": "trailer",
+}
+WRITER_STAGES = {
+    "write_file": "file",
+    "write_file_range": "file (stripe)",
+    "write_file_resumable": "file (resumable)",
+    "write_file_delta": "file (delta)",
+    "write_file_dedup": "file (dedup)",
+    "write_files_batched": "files (batched)",
+    "_write_batch": "batch",
+    "_write_frame": "frame",
+    "_write_compressed": "payload (compressed)",
+    "_write_compressed_blocks": "payload (compressed blocks)",
+    "_send_payload_sendfile": "payload (sendfile)",
+}
+BUFFERED_READER_STAGES = {"peek": "buffer peek", "readinto": "buffer copy", "read": "buffer copy"}
+BUFFERED_WRITER_STAGES = {"write": "buffer write", "flush": "buffer flush"}
+
+def parse_modes(spec):
+    """The set of modes in a --profile value ("none" or empty: no profiling)."""
+    modes = set()
+    for mode in str(spec or "none").lower().split(","):
+        mode = mode.strip()
+        if mode in ("", "none", "off"):
+            continue
+        if mode == "all":
+            modes.update(MODES)
+        elif mode in MODES:
+            modes.add(mode)
+        else:
+            raise ValueError(f"unknown profiling mode {mode!r} (pick from {', '.join(MODES)}, all)")
+    return modes
+
+class Stage:
+    __slots__ = ("calls", "total", "own", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.bytes = None # only for stages that move a known number of bytes
+
+class Profiler:
+    """The profiling settings; hands out a ConnectionProfile per connection."""
+
+    def __init__(self, modes):
+        self.modes = modes
+        self.count = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        """A Profiler for a --profile value, or None when it turns nothing on."""
+        modes = parse_modes(spec)
+        return cls(modes) if modes else None
+
+    def connection(self, name):
+        self.count += 1
+        return ConnectionProfile(f"{name} #{self.count}", self.modes)
+
+class ConnectionProfile:
+    """One connection's timings, cProfile and allocation trace."""
+
+    def __init__(self, name, modes):
+        self.name = name
+        self.stages = {}   # label -> Stage
+        self.stack = []    # time spent in nested stages, one entry per stage running
+        self.elapsed = 0.0 # time between start() and stop(), summed
+        self.started = None
+        self.cprofile = cProfile.Profile() if "cprofile" in modes else None
+        self.cprofile_error = None
+        self.trace = "tracemalloc" in modes
+        self.snapshot = None
+        self.timing = "stages" in modes
+
+    # --- Hooks ---
+
+    def timed(self, label, function, *args, **kwargs):
+        """Calls function(*args) as one call of stage label."""
+        stage = self.stages.get(label)
+        if stage is None:
+            stage = self.stages[label] = Stage()
+        stack = self.stack
+        stack.append(0.0)
+        started = clock()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            elapsed = clock() - started
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            stage.calls += 1
+            stage.total += elapsed
+            stage.own += elapsed - inner
+        return result
+
+    def _wrap(self, label, function):
+        return lambda *args, **kwargs: self.timed(label, function, *args, **kwargs)
+
+    def _moved(self, label, n):
+        stage = self.stages[label]
+        stage.bytes = (stage.bytes or 0) + n
+
+    def _wrap_syscall(self, label, function):
+        """A system call that returns a byte count (readv, writev, sendfile) or the bytes read (pread)."""
+        def call(*args, **kwargs):
+            result = self.timed(label, function, *args, **kwargs)
+            self._moved(label, result if isinstance(result, int) else len(result))
+            return result
+        return call
+
+    def _wrap_indirect(self, kind, hook):
+        """FramedReader._network/_disk (and FrameParser._disk): hook(work, *args), a stage per kind of work."""
+        def call(work, *args, **kwargs):
+            label = f"{kind} {work.__name__}"
+            result = self.timed(label, hook, work, *args, **kwargs)
+            if isinstance(result, int): # bytes spliced
+                self._moved(label, result)
+            elif work.__name__ == "write":
+                self._moved(label, len(args[0]))
+            return result
+        return call
+
+    def _wrap_write(self, write):
+        """FrameParser._write(data)."""
+        def call(data):
+            self.timed("disk write", write, data)
+            self._moved("disk write", len(data))
+        return call
+
+    def _instrument(self, obj, stages):
+        for name, label in stages.items():
+            setattr(obj, name, self._wrap(label, getattr(obj, name)))
+
+    def instrument_reader(self, framed_reader):
+        """Times a FramedReader's stages and its BufferedReader's reads."""
+        if not self.timing:
+            return
+        reader = framed_reader.reader
+        self._instrument(framed_reader, READER_STAGES)
+        self._instrument(reader, BUFFERED_READER_STAGES)
+        reader.readv = self._wrap_syscall("syscall readv", reader.readv)
+        framed_reader._network = self._wrap_indirect("syscall", framed_reader._network)
+        framed_reader._disk = self._wrap_indirect("disk", framed_reader._disk)
+
+    def instrument_parser(self, parser):
+        """Times a FrameParser's disk work (the event loop does its reads)."""
+        if self.timing:
+            parser._disk = self._wrap_indirect("disk", parser._disk)
+            parser._write = self._wrap_write(parser._write)
+
+    def instrument_writer(self, framed_writer):
+        """Times a FramedWriter's stages and its BufferedWriter's writes."""
+        if not self.timing:
+            return
+        writer = framed_writer.writer
+        self._instrument(framed_writer, WRITER_STAGES)
+        self._instrument(writer, BUFFERED_WRITER_STAGES)
+        writer.writev = self._wrap_syscall("syscall writev", writer.writev)
+        framed_writer.sendfile = self._wrap_syscall("syscall sendfile", framed_writer.sendfile)
+        framed_writer.pread = self._wrap_syscall("syscall pread", framed_writer.pread)
+
+    # --- Running ---
+
+    def start(self):
+        """Starts (or resumes) profiling in the calling thread."""
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self.snapshot is None:
+                self.snapshot = tracemalloc.take_snapshot()
+        if self.cprofile is not None and self.cprofile_error is None:
+            try:
+                self.cprofile.enable()
+            except ValueError as e: # another profiler is running (Python 3.12+ allows one)
+                self.cprofile_error = str(e)
+        self.started = clock()
+
+    def stop(self):
+        if self.started is None:
+            return
+        if self.cprofile is not None and self.cprofile_error is None:
+            self.cprofile.disable()
+        self.elapsed += clock() - self.started
+        self.started = None
+
+    def report(self):
+        """The breakdown, as text."""
+        out = io.StringIO()
+        out.write(f"Profile {self.name}: {self.elapsed * 1000:.1f} ms profiled\n")
+        if self.timing:
+            own_total = sum(stage.own for stage in self.stages.values()) or 1.0
+            out.write(f"  {'stage':28} {'calls':>8} {'total ms':>10} {'own ms':>10} {'own %':>6} {'bytes':>12} {'bytes/call':>10}\n")
+            for label, stage in sorted(self.stages.items(), key=lambda item: -item[1].own):
+                if stage.bytes is None:
+                    moved = per_call = ""
+                else:
+                    moved, per_call = stage.bytes, stage.bytes // stage.calls if stage.calls else 0
+                out.write(f"  {label:28} {stage.calls:>8} {stage.total * 1000:>10.2f} {stage.own * 1000:>10.2f} "
+                          f"{stage.own / own_total * 100:>6.1f} {moved:>12} {per_call:>10}\n")
+        if self.cprofile is not None:
+            if self.cprofile_error is not None:
+                out.write(f"  cProfile: not run ({self.cprofile_error})\n")
+            else:
+                stats = pstats.Stats(self.cprofile, stream=out)
+                stats.sort_stats("cumulative").print_stats(TOP)
+        if self.snapshot is not None:
+            # Other connections running at the same time show up here too.
+            out.write(f"  tracemalloc: top {TOP} allocation sites since the connection started\n")
+            # (Leaving out what the profilers themselves allocate.)
+            ignore = [tracemalloc.Filter(False, path) for path in (cProfile.__file__, pstats.__file__, tracemalloc.__file__, __file__)]
+            now = tracemalloc.take_snapshot().filter_traces(ignore)
+            for diff in now.compare_to(self.snapshot.filter_traces(ignore), "lineno")[:TOP]:
+                out.write(f"    {diff}\n")
+            current, peak = tracemalloc.get_traced_memory()
+            out.write(f"  tracemalloc: {current} bytes traced now, peak {peak}\n")
+        return out.getvalue()
+
+    def dump(self):
+        """Stops profiling and prints the breakdown to stderr."""
+        self.stop()
+        os.write(2, self.report().encode())
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+
+"""
+Server-side state for resumable uploads.
+
+A resumable upload is written to "<filename>.<key>.part" instead of the
+real filename.  Next to it, "<...>.part.idx" lists every complete 1 MiB
+block received so far as (8-byte end offset, 16-byte blake2b digest).  The
+key identifies one (client, filename, file version), so different clients
+never share a .part file.
+
+When the client reconnects it asks how far we got; we check the last
+indexed block against what is actually on disk (a crash may have recorded
+a block whose data never made it) and answer with the end of the last good
+block.  The client then sends only the rest, and the finished file is
+renamed into place.
+"""
+
+import os
+import fcntl
+import hashlib
+
+RESUME_BLOCK_SIZE = 1 << 20
+RECORD_SIZE = 24  # 8-byte end offset + 16-byte digest
+
+def resume_key(client_id, filename, size, mtime_ns):
+    """The 64-bit key a client uses for one version of one of its files."""
+    h = hashlib.blake2b(f"{client_id}\0{filename}\0{size}\0{mtime_ns}".encode(), digest_size=8)
+    return int.from_bytes(h.digest(), 'big')
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+class UploadInProgress(Exception):
+    """Another connection is still writing this .part file."""
+
+class PartialFile:
+    """The .part file and block index of one resumable upload (an output for FramedReader)."""
+    # Every byte is hashed on its way to disk, so splice() can't be used.
+    zero_copy_ok = False
+
+    def __init__(self, filename, key, total_size):
+        self.filename = filename
+        self.total_size = total_size
+        self.part_path = f"{filename}.{key:016x}.part"
+        self.index_path = self.part_path + ".idx"
+        self.fd = None
+        self.index_fd = None
+        self.position = 0
+        self.written = 0
+        self.preallocated = False # reserved up to total_size (see diskio.py)
+
+    def _lock_index(self):
+        """Opens and exclusively locks the index; raises UploadInProgress if someone holds it."""
+        index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(index_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(index_fd)
+            raise UploadInProgress(self.filename)
+        return index_fd
+
+    @staticmethod
+    def _read_records(index_fd):
+        data = os.pread(index_fd, os.fstat(index_fd).st_size, 0)
+        return [(int.from_bytes(data[i:i+8], 'big'), data[i+8:i+RECORD_SIZE])
+                for i in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE)]
+
+    def resume_offset(self):
+        """How many bytes of the file we have and trust. Drops index entries that don't check out."""
+        if not os.path.exists(self.index_path) or not os.path.exists(self.part_path):
+            return 0
+        index_fd = self._lock_index()
+        try:
+            records = self._read_records(index_fd)
+            part_fd = os.open(self.part_path, os.O_RDONLY)
+            try:
+                # Walk back from the newest block until one matches the disk;
+                # normally that's the very first one we look at.
+                good = len(records)
+                while good:
+                    end, digest = records[good - 1]
+                    start = records[good - 2][0] if good > 1 else 0
+                    if block_digest(os.pread(part_fd, end - start, start)) == digest:
+                        break
+                    good -= 1
+            finally:
+                os.close(part_fd)
+            os.ftruncate(index_fd, good * RECORD_SIZE)
+            return records[good - 1][0] if good else 0
+        finally:
+            os.close(index_fd) # also drops the lock
+
+    def open(self, offset):
+        """Prepares to receive the file from offset (which must be what resume_offset() said)."""
+        self.index_fd = self._lock_index()
+        records = self._read_records(self.index_fd)
+        kept = [record for record in records if record[0] <= offset]
+        if offset != (kept[-1][0] if kept else 0):
+            os.close(self.index_fd)
+            raise ValueError(f"can't resume {self.filename} at {offset}: not a verified block boundary")
+        os.ftruncate(self.index_fd, len(kept) * RECORD_SIZE)
+        self.fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        self.position = self.block_start = offset
+        self.block_hash = hashlib.blake2b(digest_size=16)
+        if offset:
+            os.write(2, f"Resuming: {self.filename} at byte {offset}\n".encode())
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            # Never let one write cross a block boundary, so each block's
+            # digest covers exactly its own bytes.
+            piece = view[:self.block_start + RESUME_BLOCK_SIZE - self.position]
+            while piece:
+                bytes_written = os.pwrite(self.fd, piece, self.position)
+                self.block_hash.update(piece[:bytes_written])
+                self.position += bytes_written
+                self.written += bytes_written
+                view = view[bytes_written:]
+                piece = piece[bytes_written:]
+            if self.position - self.block_start == RESUME_BLOCK_SIZE or self.position == self.total_size:
+                self._record_block()
+
+    def forget_from(self, offset):
+        """Drops the index entries of every block past offset (their data arrived damaged)."""
+        kept = [record for record in self._read_records(self.index_fd) if record[0] <= offset]
+        os.ftruncate(self.index_fd, len(kept) * RECORD_SIZE)
+
+    def _record_block(self):
+        os.write(self.index_fd, self.position.to_bytes(8, 'big') + self.block_hash.digest())
+        self.block_start = self.position
+        self.block_hash = hashlib.blake2b(digest_size=16)
+
+    def close(self, complete):
+        """Closes the .part file; a complete one is renamed into place and its index removed."""
+        done = complete and self.position == self.total_size
+        if self.preallocated and not done:
+            os.ftruncate(self.fd, self.position) # only what arrived, not all we reserved
+        os.close(self.fd)
+        try:
+            if done:
+                os.rename(self.part_path, self.filename)
+                os.unlink(self.index_path)
+        finally:
+            os.close(self.index_fd) # also drops the lock
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Network impairments for stammerProxy: what one direction of a connection goes through.
+
+An impairment is written as comma separated settings, e.g.
+"rate=20mbit,latency=15ms,jitter=3ms":
+  rate     bandwidth cap in bytes per second (k/m/g, or kbit/mbit/gbit)
+  burst    bytes the rate's token bucket holds (default: 10 ms worth, at least 16k)
+  latency  how long every byte is held before it is forwarded (us/ms/s; one way)
+  jitter   up to this much more latency, at random; bytes are never reordered
+  resetAt  reset the connection (RST both ways) once this many bytes went through
+  stammer  random partial sends, pausing pauseDelay between them (the classic mode)
+Sizes and rates use decimal suffixes (1k = 1000).
+
+Up is client -> server, down is server -> client; a profile gives each its own.
+"""
+
+# Named profiles: (up, down).  Latencies are one way, so RTT is their sum.
+PROFILES = {
+    "lan": ("latency=0.2ms", "latency=0.2ms"),
+    "wan": ("rate=100mbit,latency=20ms,jitter=2ms", "rate=100mbit,latency=20ms,jitter=2ms"),
+    "transatlantic": ("rate=100mbit,latency=40ms,jitter=5ms", "rate=100mbit,latency=40ms,jitter=5ms"),
+    "dsl": ("rate=1mbit,latency=15ms,jitter=3ms", "rate=20mbit,latency=15ms,jitter=3ms"),
+    "lte": ("rate=10mbit,latency=35ms,jitter=15ms", "rate=40mbit,latency=35ms,jitter=15ms"),
+    "satellite": ("rate=3mbit,latency=300ms,jitter=20ms", "rate=25mbit,latency=300ms,jitter=20ms"),
+}
+
+RATE_UNITS = (("gbit", 1e9 / 8), ("mbit", 1e6 / 8), ("kbit", 1e3 / 8), ("bit", 1 / 8),
+              ("g", 1e9), ("m", 1e6), ("k", 1e3), ("", 1))
+SIZE_UNITS = (("g", 1e9), ("m", 1e6), ("k", 1e3), ("", 1))
+TIME_UNITS = (("us", 1e-6), ("ms", 1e-3), ("s", 1), ("", 1))
+
+def parseNumber(value, units):
+    value = value.strip().lower()
+    for suffix, scale in units: # longest suffixes first
+        if value.endswith(suffix):
+            number = float(value[:len(value) - len(suffix)]) * scale
+            if number < 0:
+                raise ValueError("negative: %s" % value)
+            return number
+    raise ValueError("can't parse %s" % value)
+
+class Impairment:
+    def __init__(self):
+        self.rate = 0          # bytes per second (0: unlimited)
+        self.burst = 0         # bytes the token bucket holds (0: default)
+        self.latency = 0.0     # seconds every byte is held back
+        self.jitter = 0.0      # up to this many more, at random
+        self.resetAt = 0       # bytes after which the connection is reset (0: never)
+        self.stammer = False   # random partial sends with pauses
+
+    def copy(self):
+        other = Impairment()
+        other.__dict__.update(self.__dict__)
+        return other
+
+    def apply(self, spec):
+        """Applies the settings in spec on top of these; returns self."""
+        for setting in spec.split(","):
+            setting = setting.strip()
+            if not setting:
+                continue
+            key, _, value = setting.partition("=")
+            key = key.strip()
+            if key == "rate":
+                self.rate = parseNumber(value, RATE_UNITS)
+            elif key == "burst":
+                self.burst = int(parseNumber(value, SIZE_UNITS))
+            elif key == "latency":
+                self.latency = parseNumber(value, TIME_UNITS)
+            elif key == "jitter":
+                self.jitter = parseNumber(value, TIME_UNITS)
+            elif key in ("resetAt", "reset"):
+                self.resetAt = int(parseNumber(value, SIZE_UNITS))
+            elif key == "stammer":
+                self.stammer = value.strip().lower() not in ("0", "off", "no", "false")
+            else:
+                raise ValueError("unknown impairment setting '%s'" % key)
+        return self
+
+    def active(self):
+        return bool(self.rate or self.latency or self.jitter or self.resetAt or self.stammer)
+
+    def bucketSize(self):
+        return self.burst or max(16000, int(self.rate / 100))
+
+    def bufferSize(self):
+        """Bytes a forwarder should hold to keep this direction full: twice rate x delay."""
+        delay = self.latency + self.jitter
+        if not delay:
+            return 262144
+        if not self.rate:
+            return 4 << 20
+        return max(262144, int(2 * self.rate * delay))
+
+    def describe(self):
+        parts = []
+        if self.rate:
+            parts.append("rate %.3g Mbit/s (burst %d)" % (self.rate * 8 / 1e6, self.bucketSize()))
+        if self.latency or self.jitter:
+            parts.append("latency %.3g ms" % (self.latency * 1000) + (" + up to %.3g ms jitter" % (self.jitter * 1000) if self.jitter else ""))
+        if self.resetAt:
+            parts.append("reset at byte %d" % self.resetAt)
+        if self.stammer:
+            parts.append("stammering")
+        return ", ".join(parts) or "none"
+
+def makeImpairments(profile, both, up, down):
+    """(up, down) Impairments from a profile name ("none": no profile) and specs applied on top."""
+    if profile == "none":
+        upSpec = downSpec = ""
+    elif profile in PROFILES:
+        upSpec, downSpec = PROFILES[profile]
+    else:
+        raise ValueError("unknown profile '%s' (pick from %s)" % (profile, ", ".join(sorted(PROFILES))))
+    upImp = Impairment().apply(upSpec).apply(both).apply(up)
+    downImp = Impairment().apply(downSpec).apply(both).apply(down)
+    return upImp, downImp
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import sys
 import traceback
-from select import *
+import selectors
+from selectors import EVENT_READ, EVENT_WRITE
 from socket import *
+from heapq import heappush, heappop
+import itertools
+import resource
 import time
 import random
+import os
+import fcntl
+import struct
+from collections import deque
 
 import re
+from impairments import makeImpairments
 
 sys.path.append("lib")       # for params
 import params
@@ -16,7 +25,14 @@ switchesVarDefaults = (
     (('-s', '--server'), 'server', "127.0.0.1:50001"),
     (('-d', '--debug'), "debug", False), # boolean (set if present)
     (('-?', '--usage'), "usage", False), # boolean (set if present)
-    (('-p', '--pausedelay'), 'pauseDelay', 0.5)
+    (('-p', '--pausedelay'), 'pauseDelay', 0.5),
+    (('-f', '--fast'), 'fast', False),   # boolean: pass data straight through (no stammering)
+    (('-c', '--bufCap'), 'bufCap', "auto"), # bytes buffered per direction (auto: sized for the impairment)
+    (('--splice',), 'splice', False),    # boolean: move data socket -> pipe -> socket with splice() (Linux)
+    (('-P', '--profile'), 'profile', "none"), # named impairment profile: lan, wan, dsl, lte, satellite, ...
+    (('-i', '--impair'), 'impair', "none"),   # impairment for both directions, e.g. rate=20mbit,latency=15ms
+    (('--up',), 'up', "none"),           # impairment client -> server (on top of the above)
+    (('--down',), 'down', "none")        # impairment server -> client
     )
 
 
@@ -41,8 +57,38 @@ except:
     print("Can't parse listen port from %s" % listenPort)
     sys.exit(1)
 
-print ("%s: listening on %s, will forward to %s\n" % 
-       (progname, listenPort, server))
+fast, useSplice = paramMap["fast"], paramMap["splice"]
+try:
+    specs = [paramMap[name] if paramMap[name] != "none" else "" for name in ("impair", "up", "down")]
+    impairments = makeImpairments(paramMap["profile"], *specs)
+except ValueError as e:
+    print("Can't parse impairments: %s" % e)
+    sys.exit(1)
+if not fast and not any(imp.active() for imp in impairments):
+    for imp in impairments:
+        imp.stammer = True # nothing else asked for: stammer as always
+try:
+    bufCap = None if paramMap["bufCap"] == "auto" else int(paramMap["bufCap"])
+    if bufCap is not None and bufCap < 1:
+        raise ValueError()
+except ValueError:
+    print("Can't parse buffer capacity from %s" % paramMap["bufCap"])
+    sys.exit(1)
+if useSplice and not hasattr(os, "splice"):
+    print("splice() isn't available here")
+    sys.exit(1)
+
+def directionBufCap(imp):
+    if bufCap is not None:
+        return bufCap
+    if imp.stammer and not (imp.rate or imp.latency or imp.jitter):
+        return 1000 # the classic stammer: small buffers, so it stammers often
+    return imp.bufferSize()
+upCap, downCap = (directionBufCap(imp) for imp in impairments)
+
+print ("%s: listening on %s, will forward to %s%s\n  up: %s (%d-byte buffers)\n  down: %s (%d-byte buffers)\n" %
+       (progname, listenPort, server, " using splice" if useSplice else "",
+        impairments[0].describe(), upCap, impairments[1].describe(), downCap))
 
 
 sockNames = {}               # from socket to name
@@ -50,51 +96,225 @@ nextConnectionNumber = 0     # each connection is assigned a unique id
 
 now = time.time()
 
+# Every socket is registered with the selector (epoll where there is one)
+# only while some forwarder wants it, and its interest is changed only when
+# a forwarder's wants change: nothing is rebuilt per wakeup, so thousands of
+# connections cost no more per event than one.
+sel = selectors.DefaultSelector()
+watched = {}                 # socket -> [forwarder that wants it readable, forwarder that wants it writable]
+
+def watch(sock, event, fwd):
+    """Records that fwd (or with None, nobody) wants event on sock, telling the selector if that changes its mask."""
+    entry = watched.get(sock)
+    if entry is None:
+        if fwd is None:
+            return
+        entry = watched[sock] = [None, None]
+    which = 0 if event == EVENT_READ else 1
+    if entry[which] is fwd:
+        return
+    oldMask = (EVENT_READ if entry[0] else 0) | (EVENT_WRITE if entry[1] else 0)
+    entry[which] = fwd
+    newMask = (EVENT_READ if entry[0] else 0) | (EVENT_WRITE if entry[1] else 0)
+    if oldMask == newMask:
+        return
+    if not oldMask:
+        sel.register(sock, newMask, entry)
+    elif not newMask:
+        sel.unregister(sock)
+    else:
+        sel.modify(sock, newMask, entry)
+
+def unwatch(sock):
+    """Forgets a socket that is about to be closed."""
+    entry = watched.pop(sock, None)
+    if entry is not None:
+        if entry[0] or entry[1]:
+            sel.unregister(sock)
+        entry[0] = entry[1] = None # events already returned for it are ignored
+
+# Forwarders waiting out a pause, their latency or the token bucket, soonest first: (when, seq, fwd)
+timers = []
+timerSeq = itertools.count()
+
 class Fwd:
-    def __init__(self, conn, inSock, outSock, bufCap = 1000):
+    def __init__(self, conn, inSock, outSock, bufCap = 1000, imp = None, direction = ""):
         global now
         self.conn, self.inSock, self.outSock, self.bufCap = conn, inSock, outSock, bufCap
-        self.inClosed, self.buf = 0, bytes(0)
+        self.imp = imp if imp is not None and imp.active() else None # None: straight through
+        self.direction = direction
+        self.inClosed = 0
+        self.makeBuffer()
         self.delaySendUntil = 0 # no delay
+        self.wakeAt = None      # when a timer will look at us again
+        # Byte counts since the start; the latency queue holds (release time,
+        # bytes received by then), so bytes go out in order once released.
+        self.received = self.released = self.sent = 0
+        self.marks = deque()
+        self.lastRelease = 0
+        if self.imp is not None and self.imp.rate:
+            self.tokens, self.tokensAt = self.imp.bucketSize(), now
+        # For the stats printed at close
+        self.started, self.lastSend, self.maxQueued, self.waits = now, None, 0, 0
+        self.update()
+    def makeBuffer(self):
+        # Data waiting to go out is buf[start:end] of one buffer allocated up
+        # front: recv_into() adds at the end, send() takes from the start,
+        # and nothing is copied unless the free space at the end runs out.
+        self.buf = bytearray(self.bufCap)
+        self.view = memoryview(self.buf)
+        self.start = self.end = 0
+    def buffered(self):
+        return self.end - self.start
+    def recvSome(self):
+        """Reads what fits into the buffer; returns how much (0 at end of stream)."""
+        if self.end == self.bufCap: # the free space is all at the front: move the data down
+            self.view[:self.end - self.start] = self.view[self.start:self.end]
+            self.start, self.end = 0, self.end - self.start
+        n = self.inSock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+    def sendSome(self, toSend):
+        """Sends up to toSend buffered bytes; returns how many went."""
+        n = self.outSock.send(self.view[self.start:self.start + toSend])
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+        return n
+    def close(self):
+        pass
     def checkRead(self):
-        if len(self.buf) < self.bufCap and not self.inClosed:
+        if self.buffered() < self.bufCap and not self.inClosed:
             return self.inSock
         else:
             return None
+    def sendable(self):
+        """How many buffered bytes may go out now, and if none, when that changes (or None)."""
+        n = self.buffered()
+        if now < self.delaySendUntil:
+            return 0, self.delaySendUntil
+        imp = self.imp
+        if imp is None or not n:
+            return n, None
+        marks = self.marks
+        while marks and marks[0][0] <= now:
+            self.released = marks.popleft()[1]
+        n = min(n, self.released - self.sent)
+        if not n:
+            return 0, marks[0][0] # still in flight
+        if imp.resetAt:
+            n = min(n, imp.resetAt - self.sent)
+        if imp.rate:
+            self.tokens = min(imp.bucketSize(), self.tokens + (now - self.tokensAt) * imp.rate)
+            self.tokensAt = now
+            if self.tokens < min(n, 1024): # wait for a packet's worth, not a trickle
+                return 0, now + (min(n, 1024) - self.tokens) / imp.rate
+            n = min(n, int(self.tokens))
+        return n, None
     def checkWrite(self):
-        if len(self.buf) > 0 and now >= self.delaySendUntil:
+        n, wait = self.sendable()
+        if n:
             return self.outSock
-        else:
-            return None
+        if wait is not None and (self.wakeAt is None or wait < self.wakeAt):
+            self.wakeAt = wait # look again then
+            heappush(timers, (wait, next(timerSeq), self))
+        return None
+    def update(self):
+        """Brings the selector up to date with what this forwarder waits for now."""
+        watch(self.inSock, EVENT_READ, self if self.checkRead() else None)
+        watch(self.outSock, EVENT_WRITE, self if self.checkWrite() else None)
     def doRecv(self):
         try:
-            b = self.inSock.recv(self.bufCap - len(self.buf))
+            n = self.recvSome()
+        except (BlockingIOError, InterruptedError):
+            return
         except:
             self.conn.die()
             return
-        if len(b):
-            self.buf += b
-        else:
+        if not n:
             self.inClosed = 1
+        self.received += n
+        imp = self.imp
+        if imp is not None and (imp.latency or imp.jitter):
+            # Held back for latency plus some jitter, but never overtaking earlier bytes
+            release = max(now + imp.latency + random.uniform(0, imp.jitter), self.lastRelease)
+            self.lastRelease = release
+            self.marks.append((release, self.received))
+        else:
+            self.released = self.received
+        self.maxQueued = max(self.maxQueued, self.buffered())
+        self.update()
         self.checkDone()
     def doSend(self):
         global now
+        imp = self.imp
         try:
-            bufLen = len(self.buf)
-            toSend = random.randrange(1, bufLen+1)
-            if debug: print("attempting to send %d of %d" % (toSend, len(self.buf)))
-            n = self.outSock.send(self.buf[0:toSend])
-            self.buf = self.buf[n:]
-            if len(self.buf):
+            toSend, wait = self.sendable()
+            if not toSend: # a timer beat us to it, or the bucket emptied
+                self.update()
+                return
+            if imp is not None and imp.stammer:
+                toSend = random.randrange(1, toSend+1)
+            if debug: print("attempting to send %d of %d" % (toSend, self.buffered()))
+            n = self.sendSome(toSend)
+            self.sent += n
+            self.lastSend = now
+            if imp is not None and imp.rate:
+                self.tokens -= n
+                if self.tokens < 1024:
+                    self.waits += 1
+            if imp is not None and imp.resetAt and self.sent >= imp.resetAt:
+                self.conn.reset(self)
+                return
+            if self.buffered() and imp is not None and imp.stammer:
                 self.delaySendUntil = now + pauseDelay
+                self.waits += 1
+        except (BlockingIOError, InterruptedError):
+            return
         except Exception as e:
             print(e)
             self.conn.die()
+            return
+        self.update()
         self.checkDone()
     def checkDone(self):
-        if len(self.buf) == 0 and self.inClosed:
-            self.outSock.shutdown(SHUT_WR)
+        if self.buffered() == 0 and self.inClosed:
+            watch(self.inSock, EVENT_READ, None)
+            watch(self.outSock, EVENT_WRITE, None)
+            try:
+                self.outSock.shutdown(SHUT_WR)
+            except OSError:
+                pass # the other side is gone already
             self.conn.fwdDone(self)
+    def stats(self):
+        elapsed = (self.lastSend or now) - self.started
+        rate = self.sent / elapsed / 1e6 if elapsed > 0 else 0.0
+        return ("%s %d bytes in %.2fs (%.2f MB/s), at most %d queued, %d waits" %
+                (self.direction, self.sent, elapsed, rate, self.maxQueued, self.waits))
+
+class SpliceFwd(Fwd):
+    """A forwarder whose buffer is a pipe: splice() moves the data and it never enters Python."""
+    def makeBuffer(self):
+        self.pipeR, self.pipeW = os.pipe()
+        try:
+            self.bufCap = fcntl.fcntl(self.pipeW, fcntl.F_SETPIPE_SZ, self.bufCap) # rounded up to whole pages
+        except (AttributeError, OSError):
+            self.bufCap = 65536 # the usual default size
+        self.pending = 0
+    def buffered(self):
+        return self.pending
+    def recvSome(self):
+        n = os.splice(self.inSock.fileno(), self.pipeW, self.bufCap - self.pending,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.pending += n
+        return n
+    def sendSome(self, toSend):
+        n = os.splice(self.pipeR, self.outSock.fileno(), toSend, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.pending -= n
+        return n
+    def close(self):
+        os.close(self.pipeR)
+        os.close(self.pipeW)
             
     
 connections = set()
@@ -108,33 +328,51 @@ class Conn:
         nextConnectionNumber += 1
         self.ssock = ssock = socket(af, socktype)
         self.forwarders = forwarders = set()
+        self.dead = False
         print("New connection #%d from %s" % (connIndex, repr(caddr)))
         sockNames[csock] = "C%d:ToClient" % connIndex
         sockNames[ssock] = "C%d:ToServer" % connIndex
+        csock.setblocking(False)
         ssock.setblocking(False)
-        ssock.connect_ex(saddr)
-        forwarders.add(Fwd(self, csock, ssock))
-        forwarders.add(Fwd(self, ssock, csock))
+        ssock.connect_ex(saddr) # writable once connected
+        fwdClass = SpliceFwd if useSplice else Fwd
+        self.up = fwdClass(self, csock, ssock, upCap, impairments[0], "up")
+        self.down = fwdClass(self, ssock, csock, downCap, impairments[1], "down")
+        forwarders.add(self.up)
+        forwarders.add(self.down)
         connections.add(self)
     def fwdDone(self, forwarder):
         forwarders = self.forwarders
         forwarders.remove(forwarder)
+        forwarder.close()
         print("forwarder %s ==> %s from connection %d shutting down" % (sockNames[forwarder.inSock], sockNames[forwarder.outSock], self.connIndex))
         if len(forwarders) == 0:
             self.die()
     def die(self):
-        print("connection %d shutting down" % self.connIndex)
+        if self.dead:
+            return
+        self.dead = True
+        print("connection %d shutting down: %s; %s" % (self.connIndex, self.up.stats(), self.down.stats()))
+        for fwd in self.forwarders:
+            fwd.close()
         for s in self.ssock, self.csock:
+            unwatch(s)
             del sockNames[s]
             try:
                 s.close()
             except:
                 pass 
         connections.remove(self)
-    def doErr(self):
-        print("forwarder from client %s failing due to error" % repr(self.caddr))
-        die()
-                
+    def reset(self, forwarder):
+        """Breaks the connection off with a RST in both directions, as a failing network would."""
+        print("connection %d reset after %d bytes %s" % (self.connIndex, forwarder.sent, forwarder.direction))
+        for s in self.ssock, self.csock:
+            try:
+                s.setsockopt(SOL_SOCKET, SO_LINGER, struct.pack("ii", 1, 0)) # close() sends RST
+            except OSError:
+                pass
+        self.die()
+
 class Listener:
     def __init__(self, bindaddr, saddr, addrFamily=AF_INET, socktype=SOCK_STREAM): # saddr is address of server
         self.bindaddr, self.saddr = bindaddr, saddr
@@ -144,58 +382,59 @@ class Listener:
         lsock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         lsock.bind(bindaddr)
         lsock.setblocking(False)
-        lsock.listen(2)
+        lsock.listen(SOMAXCONN) # soak tests open connections by the thousand
+        sel.register(lsock, EVENT_READ, self)
     def doRecv(self):
-        try:
-            csock, caddr = self.lsock.accept() # socket connected to client
-            conn = Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
-        except:
-            print("weird.  listener readable but can't accept!")
-            traceback.print_exc(file=sys.stdout)
-    def doErr(self):
-        print("listener socket failed!!!!!")
-        sys.exit(2)
+        while 1: # everyone who is waiting, not one per wakeup
+            try:
+                csock, caddr = self.lsock.accept() # socket connected to client
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e: # e.g. out of file descriptors; try again next time
+                print("can't accept: %s" % e)
+                return
+            try:
+                conn = Conn(csock, caddr, self.addrFamily, self.socktype, self.saddr)
+            except:
+                print("weird.  can't set up connection from %s" % repr(caddr))
+                traceback.print_exc(file=sys.stdout)
+                csock.close()
 
-    def checkRead(self):
-        return self.lsock
-    def checkWrite(self):
-        return None
-    def checkErr(self):
-        return self.lsock
-        
+# Each connection takes two file descriptors; allow as many as the hard limit does.
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+if soft != hard:
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
 
 l = Listener(("0.0.0.0", listenPort), (serverHost, serverPort))
 
-def lookupSocknames(socks):
-    return [ sockName(s) for s in socks ]
-
 while 1:
-    rmap,wmap,xmap = {},{},{}   # socket:object mappings for select
-    xmap[l.checkErr()] = l
-    rmap[l.checkRead()] = l
     now = time.time()
-    nextDelayUntil = now + 10   # default 10s poll
-    for conn in connections:
-        for sock in conn.csock, conn.ssock:
-            xmap[sock] = conn
-            for fwd in conn.forwarders:
-                sock = fwd.checkRead()
-                if (sock): rmap[sock] = fwd
-                sock = fwd.checkWrite()
-                if (sock): wmap[sock] = fwd
-                delayUntil = fwd.delaySendUntil
-                if (delayUntil < nextDelayUntil and delayUntil > now): # minimum active delay
-                    nextDelayUntil = delayUntil
-    maxSleep = nextDelayUntil - now
+    # Pauses that are over: those forwarders may send again.  All of them
+    # are taken off first, so a timer one sets again for "now" (a wait too
+    # short for the clock to see) waits for the next round, not forever.
+    due = []
+    while timers and timers[0][0] <= now:
+        delayUntil, seq, fwd = heappop(timers)
+        if fwd.wakeAt == delayUntil:
+            fwd.wakeAt = None
+        due.append(fwd)
+    for fwd in due:
+        if not fwd.conn.dead and fwd in fwd.conn.forwarders:
+            fwd.update()
+    maxSleep = max(0, timers[0][0] - now) if timers else 10 # default 10s poll
     if debug: print("select max sleep=%fs" % maxSleep)
-    rset, wset, xset = select(list(rmap.keys()), list(wmap.keys()), list(xmap.keys()), maxSleep)
-    if debug: print([ repr([ sockNames[s] for s in sset]) for sset in [rset,wset,xset] ])
-    for sock in rset:
-        rmap[sock].doRecv()
-    for sock in wset:
-        wmap[sock].doSend()
-    for sock in xset:
-        xmap[sock].doErr()
-
-    
-
+    events = sel.select(maxSleep)
+    now = time.time()
+    if debug: print([ (sockNames.get(key.fileobj), mask) for key, mask in events ])
+    for key, mask in events:
+        if key.data is l:
+            l.doRecv()
+            continue
+        entry = key.data # [reader, writer]; emptied if its connection died meanwhile
+        if mask & EVENT_READ and entry[0]:
+            entry[0].doRecv()
+        if mask & EVENT_WRITE and entry[1]:
+            entry[1].doSend()
@@ -0,0 +1,88 @@
+"""
+Shared setup for the tests: the modules live at the top of the repository
+(and params.py in lib/), as they do when the client and server are run.
+Transfers go over a socketpair to a server side forked off for each
+connection, working in its own directory like a real server would.
+"""
+
+import os
+import socket
+import sys
+import traceback
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "lib")]
+
+from buffers import BufferedReader, BufferedWriter
+from chunkstore import ChunkStore
+from framing import FramedReader, FramedWriter
+from frameparser import FrameParser
+
+def serve(sock, engine, store_dir):
+    """Receives one connection's files into the current directory, as a server engine does."""
+    store = ChunkStore(store_dir, 1 << 30) if store_dir is not None else None
+    if engine == "threads":
+        reader = FramedReader(BufferedReader(sock.fileno(), 65536), reply=sock.sendall, store=store)
+        while reader.read_next_file():
+            pass
+        reader.release()
+    else:
+        parser = FrameParser(reply=sock.sendall, store=store)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            parser.feed(data)
+        parser.close()
+
+@pytest.fixture(params=["threads", "async"])
+def engine(request):
+    return request.param
+
+@pytest.fixture
+def dirs(tmp_path, monkeypatch):
+    """(src, dst): the client works in src, the server writes into dst."""
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    monkeypatch.chdir(src)
+    return src, dst
+
+@pytest.fixture
+def transfer(dirs, engine):
+    """Runs send(writer, replies) against a server in a child process, over a socketpair.
+
+    Returns whatever send returned, once the server has seen the end of the
+    stream and exited.  FramedWriter options are passed through.
+    """
+    def run(send, store_dir=None, header_version=2, **options):
+        client, server = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                client.close()
+                os.chdir(dirs[1])
+                serve(server, engine, store_dir)
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        server.close()
+        fd = client.detach()
+        writer = FramedWriter(BufferedWriter(fd, 65536), header_version=header_version, **options)
+        replies = BufferedReader(fd, 256)
+        try:
+            result = send(writer, replies)
+            writer.finish(replies)
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            _, status = os.waitpid(pid, 0)
+        assert status == 0, "the server side failed"
+        return result
+    return run
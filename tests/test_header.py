@@ -0,0 +1,143 @@
+"""
+Frame headers: every layout encodes and decodes back to the same header.
+"""
+
+import pytest
+
+from frameheader import (BATCH_MARKER, COMPACT_MARKER, EXTENDED_MARKER, FrameHeader, compact_header_size,
+                         decode_varint, encode_varint)
+from checksum import CHECKSUM_BLAKE2B, CHECKSUM_CRC32
+from compression import CODEC_ZLIB
+
+FIELDS = ("filename", "data_length", "offset", "total_size", "transfer_id", "codec", "independent_blocks",
+          "resumable", "query", "delta", "block_size", "dedup", "chunk_count", "checksum", "checksum_blocks",
+          "batch_count", "mode", "mtime_ns")
+
+def fields(header):
+    return {name: getattr(header, name) for name in FIELDS}
+
+def decode_fixed(data):
+    """Decodes a legacy, extended or batch header the way FramedReader does."""
+    frame, extra = FrameHeader.decode(data[:108])
+    assert len(data) == 108 + extra
+    if extra:
+        frame.decode_extra(data[108:])
+    return frame
+
+def plain():
+    return FrameHeader("notes.txt", 1234)
+
+def stripe():
+    header = FrameHeader("dir/big.bin", 1 << 20, 3 << 20, 10 << 20, 0x1122334455667788)
+    header.codec = CODEC_ZLIB
+    header.independent_blocks = True
+    header.checksum = CHECKSUM_BLAKE2B
+    header.checksum_blocks = True
+    return header
+
+def resumable_query():
+    header = FrameHeader("part.bin", 0, 0, 5000, 42)
+    header.resumable = header.query = True
+    return header
+
+def delta():
+    header = FrameHeader("old.bin", 70000)
+    header.delta = True
+    header.block_size = 2048
+    return header
+
+def dedup():
+    header = FrameHeader("chunks.bin", 300000)
+    header.dedup = True
+    header.chunk_count = 5
+    return header
+
+def checksummed():
+    header = FrameHeader("sum.bin", 99)
+    header.checksum = CHECKSUM_CRC32
+    return header
+
+def batch():
+    header = FrameHeader("", 4096)
+    header.batch_count = 3
+    return header
+
+EXTENDED = [stripe, resumable_query, delta, dedup, checksummed]
+
+@pytest.mark.parametrize("value", [0, 1, 0x7F, 0x80, 0x3FFF, 0x4000, 1 << 63, (1 << 64) - 1])
+def test_varint_round_trip(value):
+    data = encode_varint(value)
+    assert decode_varint(data + b"\x05", 0) == (value, len(data))
+    assert decode_varint(data[:-1], 0) == (None, 0)
+
+def test_legacy_round_trip():
+    data = plain().encode()
+    assert len(data) == 108 and data.startswith(b"notes.txt\0")
+    assert fields(decode_fixed(data)) == fields(plain())
+
+def test_legacy_name_too_long():
+    with pytest.raises(ValueError):
+        FrameHeader("x" * 101, 1).encode()
+
+@pytest.mark.parametrize("make", EXTENDED)
+def test_extended_round_trip(make):
+    data = make().encode()
+    assert data[0] == EXTENDED_MARKER
+    assert fields(decode_fixed(data)) == fields(make())
+
+def test_extended_name_too_long():
+    with pytest.raises(ValueError):
+        FrameHeader("x" * 98, 1, 0, 1, 1).encode()
+
+def test_batch_round_trip():
+    data = batch().encode()
+    assert len(data) == 108 and data[0] == BATCH_MARKER
+    assert fields(decode_fixed(data)) == fields(batch())
+
+@pytest.mark.parametrize("make", [plain, batch] + EXTENDED)
+def test_compact_round_trip(make):
+    header = make()
+    header.mode, header.mtime_ns = 0o640, 1_700_000_000_123_456_789
+    data = header.encode(2)
+    assert data[0] == COMPACT_MARKER
+    assert compact_header_size(data) == len(data)
+    assert fields(FrameHeader.decode_compact(data)) == fields(header)
+
+def test_compact_long_name():
+    header = FrameHeader("d/" * 300 + "f.txt", 5)
+    assert fields(FrameHeader.decode_compact(header.encode(2))) == fields(header)
+
+def test_compact_size_of_every_prefix():
+    data = stripe().encode(2)
+    for i in range(len(data)):
+        assert compact_header_size(data[:i]) > i
+
+def test_compact_skips_unknown_tags():
+    data = plain().encode(2)
+    # Append an unknown tag 99 holding one byte to the (empty) field list.
+    assert data[-1] == 0
+    data = data[:-1] + bytes([3, 99, 1, 7])
+    assert fields(FrameHeader.decode_compact(data)) == fields(plain())
+
+def test_compact_rejects_unknown_flags():
+    data = bytes([COMPACT_MARKER, 2]) + encode_varint(0x200) + bytes([1]) + b"a" + bytes([0, 0])
+    with pytest.raises(ValueError):
+        FrameHeader.decode_compact(data)
+
+def test_compact_rejects_huge_name():
+    data = bytes([COMPACT_MARKER, 2, 0]) + encode_varint(1 << 20)
+    with pytest.raises(ValueError):
+        compact_header_size(data)
+
+def test_compact_mode_drops_special_bits():
+    header = plain()
+    header.mode = 0o4755
+    assert FrameHeader.decode_compact(header.encode(2)).mode == 0o755
+
+@pytest.mark.parametrize("flags", [0x20 | 0x01, 0x40 | 0x80, 0x08])
+def test_bad_flag_combinations(flags):
+    # delta+range, dedup+checksum, resume without a range
+    data = bytes([EXTENDED_MARKER, 1, flags]) + b"f".ljust(97, b"\0") + (10).to_bytes(8, 'big')
+    frame, extra = FrameHeader.decode(data)
+    with pytest.raises(ValueError):
+        frame.decode_extra(bytes(extra))
@@ -0,0 +1,78 @@
+"""
+FrameParser (the async engine's receiver) must not care where recv() cuts
+the stream: every split point gives the same files.
+"""
+
+import os
+
+import pytest
+
+from buffers import BufferedWriter
+from checksum import CHECKSUM_CRC32
+from compression import CODEC_ZLIB
+from framing import FramedWriter
+from frameparser import FrameParser
+
+FILES = {
+    "text.txt": b"".join(b"line %d of some compressible text\n" % i for i in range(100)),
+    "small.bin": bytes(range(256)) * 2,
+    "empty": b"",
+    "summed.txt": b"checksummed and compressed " * 60,
+    "sub/one.txt": b"first batched file\n",
+    "sub/two.txt": b"second batched file\n",
+}
+
+def write_stream(path, header_version, **options):
+    """Returns a function that appends frames to path from a FramedWriter with these options."""
+    def write(send):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        writer = FramedWriter(BufferedWriter(fd, 4096), header_version=header_version, **options)
+        send(writer)
+        writer.close()
+    return write
+
+@pytest.fixture(params=[1, 2], ids=["v1", "v2"])
+def stream(request, tmp_path, monkeypatch):
+    """The bytes of a client stream with plain, compressed, checksummed and batch frames."""
+    src = tmp_path / "src"
+    for name, data in FILES.items():
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_bytes(data)
+    monkeypatch.chdir(src)
+    path = tmp_path / "stream"
+    version = request.param
+    write_stream(path, version, codec=CODEC_ZLIB)(
+        lambda writer: [writer.write_file(name) for name in ("text.txt", "small.bin", "empty")])
+    write_stream(path, version, codec=CODEC_ZLIB, checksum=CHECKSUM_CRC32, checksum_blocks=True)(
+        lambda writer: writer.write_file("summed.txt"))
+    write_stream(path, version)(lambda writer: writer.write_files_batched(["sub/one.txt", "sub/two.txt"]))
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    monkeypatch.chdir(dst)
+    return path.read_bytes()
+
+def parse(pieces):
+    parser = FrameParser()
+    for piece in pieces:
+        parser.feed(piece)
+    parser.close()
+    return parser.files
+
+def check_and_clear():
+    for name, data in FILES.items():
+        with open(name, "rb") as f:
+            assert f.read() == data, name
+        os.remove(name)
+
+def test_every_split_point(stream):
+    for i in range(len(stream) + 1):
+        assert parse([stream[:i], stream[i:]]) == len(FILES), i
+        check_and_clear()
+
+def test_one_byte_at_a_time(stream):
+    assert parse([stream[i:i + 1] for i in range(len(stream))]) == len(FILES)
+    check_and_clear()
+
+def test_cut_short(stream):
+    # A client that goes away mid-file leaves only what was complete.
+    assert parse([stream[:len(stream) // 2]]) < len(FILES)
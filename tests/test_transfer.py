@@ -0,0 +1,179 @@
+"""
+Whole transfers over a socketpair, against both server engines.
+"""
+
+import os
+import random
+import socket
+
+import pytest
+
+from compression import CODEC_LZMA, CODEC_ZLIB
+from chunkstore import ChunkStore, file_recipe
+from frameheader import FrameHeader, read_reply
+
+def make_files(files):
+    for name, data in files.items():
+        os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(data)
+
+def assert_arrived(dst, files):
+    for name, data in files.items():
+        assert (dst / name).read_bytes() == data, name
+
+def text(size, seed=0):
+    words = random.Random(seed).choices([b"alpha", b"beta", b"gamma", b"delta", b"\n"], k=size // 4)
+    return b" ".join(words)[:size]
+
+def noise(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+def query_signatures(writer, replies, filename):
+    query = FrameHeader(filename, 0)
+    query.delta = query.query = True
+    writer.writer.write(query.encode(writer.header_version))
+    writer.writer.flush()
+    return read_reply(replies)
+
+@pytest.mark.parametrize("codec", [CODEC_ZLIB, CODEC_LZMA], ids=["zlib", "lzma"])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_compressed(dirs, transfer, codec, threads):
+    files = {"text.txt": text(700000), "noise.bin": noise(300000), "small.txt": text(2000, 1), "empty": b""}
+    make_files(files)
+    transfer(lambda writer, replies: [writer.write_file(name) for name in files],
+             codec=codec, compress_threads=threads)
+    assert_arrived(dirs[1], files)
+
+def test_compressed_legacy_headers(dirs, transfer):
+    files = {"text.txt": text(300000)}
+    make_files(files)
+    transfer(lambda writer, replies: writer.write_file("text.txt"), header_version=1, codec=CODEC_ZLIB)
+    assert_arrived(dirs[1], files)
+
+def test_delta(dirs, transfer, capfd):
+    old = noise(300000)
+    files = {"edited.bin": old[:100000] + b"inserted" + old[100000:250000] + noise(20000, 1),
+             "fresh.bin": noise(100000, 2), "small.txt": text(500)}
+    (dirs[1] / "edited.bin").write_bytes(old)
+    make_files(files)
+    transfer(lambda writer, replies: [writer.write_file_delta(name, replies) for name in files])
+    assert_arrived(dirs[1], files)
+    sent = [line for line in capfd.readouterr().err.splitlines() if line.startswith("Archiving: edited.bin (delta:")]
+    assert sent and int(sent[0].split()[3]) < 50000
+
+def test_delta_refuses_paths_outside(dirs, transfer):
+    # Signatures are only handed out for relative paths below the server's directory.
+    outside = dirs[1].parent / "secret.bin"
+    outside.write_bytes(noise(100000))
+    answers = transfer(lambda writer, replies: [query_signatures(writer, replies, name)
+                                                for name in (str(outside), "../secret.bin")])
+    assert answers == [["SIGS", "0", "0"]] * 2
+
+def dedup_sent(capfd, filename):
+    """How many chunks the client had to send for filename (from its log line)."""
+    for line in capfd.readouterr().err.splitlines():
+        if line.startswith(f"Archiving: {filename} (dedup:"):
+            return int(line.split()[3])
+    return None
+
+def test_dedup(dirs, transfer, capfd, tmp_path):
+    store = str(tmp_path / "store")
+    original = noise(1000000)
+    make_files({"a.bin": original})
+    transfer(lambda writer, replies: writer.write_file_dedup("a.bin", replies), store_dir=store)
+    assert dedup_sent(capfd, "a.bin") > 5
+
+    files = {"copy.bin": original, "edit.bin": original[:500000] + b"edit" + original[500000:]}
+    make_files(files)
+    transfer(lambda writer, replies: writer.write_file_dedup("copy.bin", replies), store_dir=store)
+    assert dedup_sent(capfd, "copy.bin") == 0
+    transfer(lambda writer, replies: writer.write_file_dedup("edit.bin", replies), store_dir=store)
+    assert 0 < dedup_sent(capfd, "edit.bin") <= 2
+    assert_arrived(dirs[1], files)
+
+    # Writing into a received file must not change what the store hands out.
+    with open(dirs[1] / "copy.bin", "r+b") as f:
+        f.write(b"overwritten")
+    make_files({"again.bin": original})
+    transfer(lambda writer, replies: writer.write_file_dedup("again.bin", replies), store_dir=store)
+    assert (dirs[1] / "again.bin").read_bytes() == original
+
+def test_dedup_damaged_store(dirs, transfer, capfd, tmp_path):
+    # Chunks that vanished (another server evicted them) or went bad are asked for again.
+    store = str(tmp_path / "store")
+    original = noise(1000000)
+    make_files({"a.bin": original})
+    transfer(lambda writer, replies: writer.write_file_dedup("a.bin", replies), store_dir=store)
+    fd = os.open("a.bin", os.O_RDONLY)
+    recipe = file_recipe(fd, len(original))
+    os.close(fd)
+    objects = ChunkStore(store, 1 << 30)
+    gone, damaged = objects.path(recipe[1][0]), objects.path(recipe[2][0])
+    os.unlink(gone)
+    with open(damaged, "r+b") as f:
+        f.write(b"rot")
+
+    files = {"longer.bin": original + noise(1000, 1)}
+    make_files(files)
+    transfer(lambda writer, replies: writer.write_file_dedup("longer.bin", replies), store_dir=store)
+    assert dedup_sent(capfd, "longer.bin") >= 2
+    assert_arrived(dirs[1], files)
+    # ...and stored again, intact.
+    for key, offset, length in recipe[1:3]:
+        with open(objects.path(key), "rb") as f:
+            assert f.read() == original[offset:offset + length]
+
+@pytest.mark.parametrize("header_version", [1, 2])
+def test_batch(dirs, transfer, header_version):
+    rng = random.Random(3)
+    files = {f"tree/d{i % 7}/f{i}.txt": noise(rng.choice([0, 1, 100, 5000, 40000]), i) for i in range(400)}
+    files["tree/big.bin"] = noise(200000)
+    make_files(files)
+    transfer(lambda writer, replies: writer.write_files_batched(list(files)), header_version=header_version)
+    assert_arrived(dirs[1], files)
+
+def cut_after(writer, budget):
+    """Makes the writer's connection drop once budget bytes have gone out."""
+    left = [budget]
+    real_writev, real_sendfile = writer.writer.writev, writer.sendfile
+    def allowance(out_fd, wanted):
+        if left[0] <= 0:
+            with socket.socket(fileno=os.dup(out_fd)) as s:
+                s.shutdown(socket.SHUT_RDWR)
+            raise BrokenPipeError("connection cut by the test")
+        return min(wanted, left[0])
+    def writev(out_fd, views):
+        sent = real_writev(out_fd, trim(views, allowance(out_fd, sum(len(view) for view in views))))
+        left[0] -= sent
+        return sent
+    def sendfile(out_fd, in_fd, offset, count):
+        sent = real_sendfile(out_fd, in_fd, offset, allowance(out_fd, count))
+        left[0] -= sent
+        return sent
+    writer.writer.writev, writer.sendfile = writev, sendfile
+
+def trim(views, size):
+    """The first size bytes of a list of buffers."""
+    out = []
+    for view in views:
+        if size <= 0:
+            break
+        out.append(view[:size])
+        size -= len(out[-1])
+    return out
+
+def test_resume_after_disconnect(dirs, transfer, capfd):
+    data = noise(3500000)
+    make_files({"big.bin": data})
+    def send_cut(writer, replies):
+        cut_after(writer, 2500000)
+        writer.write_file_resumable("big.bin", "tester", replies)
+    with pytest.raises(ConnectionError):
+        transfer(send_cut)
+    assert not (dirs[1] / "big.bin").exists()
+
+    transfer(lambda writer, replies: writer.write_file_resumable("big.bin", "tester", replies))
+    assert f"(resuming at byte {2 << 20} of {len(data)})" in capfd.readouterr().err
+    assert (dirs[1] / "big.bin").read_bytes() == data
+    assert os.listdir(dirs[1]) == ["big.bin"] # no .part files left behind
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+
+"""
+Buffer sizes: set by hand, or worked out from the link ("auto").
+
+Two kinds of buffer matter.  Our own (BufferedReader/BufferedWriter and
+the chunks the framing code copies through) decide how many system calls
+a transfer takes.  The socket's (SO_SNDBUF/SO_RCVBUF) decide how much data
+can be in flight, which has to be at least the bandwidth-delay product
+(BDP: bytes per second times round-trip time) to keep a long fat pipe full.
+
+In auto mode each connection starts with AUTO_START_SIZE buffers.  Once
+its first file is through, TCP_INFO says what the link looks like: the
+sender reads the delivery rate and RTT, the receiver its receive window
+estimate (rcv_space, about one RTT's worth of data).  Our buffers are then
+sized to a fraction of the BDP.  Linux already grows socket buffers on its
+own up to net.ipv4.tcp_wmem/tcp_rmem, and setting SO_SNDBUF/SO_RCVBUF
+turns that off, so auto mode only sets them when that ceiling is below
+twice the BDP.
+"""
+
+import os
+import socket
+import struct
+
+AUTO_START_SIZE = 65536
+MIN_BUFFER_SIZE = 4096
+MAX_BUFFER_SIZE = 4 << 20
+
+# Offsets into Linux's struct tcp_info
+_TCPI_SND_MSS = 16
+_TCPI_RTT = 68          # microseconds
+_TCPI_SND_CWND = 80     # segments
+_TCPI_RCV_RTT = 92      # microseconds, as the receiver estimates it
+_TCPI_RCV_SPACE = 96    # bytes
+_TCPI_DELIVERY_RATE = 160 # bytes per second (Linux 4.9+)
+_TCP_INFO_SIZE = 168
+
+def parse_size(value):
+    """A size flag: "auto" (None), or bytes with an optional k/m suffix."""
+    value = str(value).strip().lower()
+    if value == "auto":
+        return None
+    scale = {"k": 1 << 10, "m": 1 << 20}.get(value[-1:], 1)
+    size = int(value[:-1] if scale > 1 else value) * scale
+    if size <= 0:
+        raise ValueError(f"buffer size must be positive: {value}")
+    return size
+
+def tcp_info(fd):
+    """The fields of TCP_INFO we use, or None where there is no TCP_INFO (not Linux, not TCP)."""
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        with socket.socket(fileno=os.dup(fd)) as s:
+            raw = s.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO_SIZE)
+    except OSError:
+        return None
+    field = lambda fmt, offset: struct.unpack_from(fmt, raw, offset)[0] if len(raw) >= offset + struct.calcsize(fmt) else 0
+    return {
+        "snd_mss": field("=I", _TCPI_SND_MSS),
+        "rtt_us": field("=I", _TCPI_RTT),
+        "snd_cwnd": field("=I", _TCPI_SND_CWND),
+        "rcv_rtt_us": field("=I", _TCPI_RCV_RTT),
+        "rcv_space": field("=I", _TCPI_RCV_SPACE),
+        "delivery_rate": field("=Q", _TCPI_DELIVERY_RATE),
+    }
+
+def kernel_ceiling(name):
+    """The most Linux grows a socket buffer to on its own (tcp_wmem or tcp_rmem's last field)."""
+    try:
+        with open(f"/proc/sys/net/ipv4/{name}") as f:
+            return int(f.read().split()[-1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+def socket_buffer(fd, option):
+    with socket.socket(fileno=os.dup(fd)) as s:
+        return s.getsockopt(socket.SOL_SOCKET, option)
+
+def set_socket_buffer(fd, option, size):
+    """Sets SO_SNDBUF or SO_RCVBUF. Returns what the kernel actually gave us (it doubles it, and caps it)."""
+    with socket.socket(fileno=os.dup(fd)) as s:
+        s.setsockopt(socket.SOL_SOCKET, option, size)
+        return s.getsockopt(socket.SOL_SOCKET, option)
+
+def buffer_size_for(bdp):
+    """Our buffer size for a link: a quarter of its BDP, as a power of two within limits."""
+    size = MIN_BUFFER_SIZE
+    while size < MAX_BUFFER_SIZE and size < bdp // 4:
+        size *= 2
+    return max(size, AUTO_START_SIZE)
+
+class BufferTuning:
+    """How one side sizes its buffers: fixed by flags, or per connection from TCP_INFO.
+
+    'sending' picks SO_SNDBUF and the sender's view of the link, otherwise
+    SO_RCVBUF and the receiver's.
+    """
+    def __init__(self, buffer_size=None, socket_buffer_size=None, sending=True):
+        self.buffer_size = buffer_size                # None: auto
+        self.socket_buffer_size = socket_buffer_size  # None: auto
+        self.sending = sending
+        self.option = socket.SO_SNDBUF if sending else socket.SO_RCVBUF
+        self.option_name = "SO_SNDBUF" if sending else "SO_RCVBUF"
+        # Whether there is anything to work out once a connection is running
+        self.adaptive = buffer_size is None or socket_buffer_size is None
+
+    @property
+    def auto(self):
+        return self.buffer_size is None
+
+    def initial_buffer_size(self):
+        return self.buffer_size or AUTO_START_SIZE
+
+    def describe(self):
+        """One line for the log saying what we'll do."""
+        buffers = f"{self.buffer_size} bytes" if self.buffer_size else f"auto (from {AUTO_START_SIZE} bytes)"
+        if self.socket_buffer_size:
+            sockets = f"{self.option_name} {self.socket_buffer_size}"
+        else:
+            ceiling = kernel_ceiling("tcp_wmem" if self.sending else "tcp_rmem")
+            sockets = f"{self.option_name} kernel autotuning (up to {ceiling if ceiling else '?'} bytes)"
+        return f"Buffers: {buffers}, {sockets}"
+
+    def prepare_socket(self, fd):
+        """Applies a fixed socket buffer size; best done before connect()/listen(), so the window scale fits."""
+        if self.socket_buffer_size:
+            return set_socket_buffer(fd, self.option, self.socket_buffer_size)
+        return None
+
+    def measure(self, fd):
+        """Returns (BDP estimate in bytes, RTT in seconds) for a connection, or None."""
+        info = tcp_info(fd)
+        if info is None:
+            return None
+        if self.sending:
+            rtt = info["rtt_us"] / 1e6
+            if info["delivery_rate"] and rtt:
+                bdp = int(info["delivery_rate"] * rtt)
+            else: # an older kernel: the congestion window is what fills one RTT
+                bdp = info["snd_cwnd"] * info["snd_mss"]
+        else:
+            rtt = info["rcv_rtt_us"] / 1e6
+            bdp = info["rcv_space"]
+        return (bdp, rtt) if bdp else None
+
+    def tune(self, fd, who):
+        """Sizes a connection's buffers from what its first transfer showed. Returns our new buffer size, or None."""
+        measured = self.measure(fd)
+        if measured is None:
+            os.write(2, f"Tuning {who}: no TCP_INFO, keeping {self.initial_buffer_size()}-byte buffers\n".encode())
+            return None
+        bdp, rtt = measured
+        size = buffer_size_for(bdp) if self.auto else self.buffer_size
+        how = "fixed" if self.socket_buffer_size else "kernel"
+        if not self.socket_buffer_size:
+            ceiling = kernel_ceiling("tcp_wmem" if self.sending else "tcp_rmem")
+            if ceiling is not None and ceiling < 2 * bdp:
+                set_socket_buffer(fd, self.option, 2 * bdp)
+                how = f"raised past the kernel's {ceiling}"
+        os.write(2, f"Tuning {who}: RTT {rtt * 1000:.3f} ms, BDP ~{bdp} bytes; buffers {size} bytes, "
+                    f"{self.option_name} {socket_buffer(fd, self.option)} ({how})\n".encode())
+        return size